@@ -0,0 +1,309 @@
+# وضع ASGI غير متزامن لنقاط /api/ai/* (تطبيق Flask يبقى كخيار احتياطي)
+"""Asynchronous serving mode for the AI service.
+
+Run with ``uvicorn asgi_app:app --host 127.0.0.1 --port 3001`` (or
+``python asgi_app.py``); ``python server.py`` still serves the synchronous
+Flask app. Both share everything in ``server`` (model, catalog, caches).
+
+Under Flask every request holds a worker thread for its whole life, including
+the seconds spent waiting on ``model.generate``. Here the chat, search,
+compare, similar and health endpoints are coroutines:
+
+* generation is queued on the inference scheduler and awaited through its
+  future (``agenerate``), streamed chunks are pushed to the event loop
+  (``astream``), so an idle or streaming connection holds no thread
+* reply cache lookups go to Redis through ``redis.asyncio``
+* products missing from the catalog snapshot are fetched with httpx
+* CPU-bound steps (message analysis and retrieval, vector search, semantic
+  cache embeddings) and the synchronous conversation store run briefly on the
+  thread pool (``ASGI_THREADS``)
+
+The catalog itself is refreshed by its background thread and never fetched on
+the request path. Other routes (``/api/ai/test``, ``/api/ai/extract-product``)
+are served by the Flask app mounted as WSGI.
+"""
+from contextlib import asynccontextmanager
+from datetime import datetime
+import asyncio
+import json
+import logging
+import os
+import time
+from urllib.parse import quote
+
+import anyio
+import redis.asyncio as aioredis
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+try:
+    from a2wsgi import WSGIMiddleware
+except Exception:  # optional; Starlette's own adapter is deprecated but works
+    from starlette.middleware.wsgi import WSGIMiddleware
+
+import server
+from http_client import AsyncPooledHttpClient
+
+logger = logging.getLogger(__name__)
+
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', '40'))  # خيوط الأعمال المتزامنة القصيرة (البحث، التحليل)
+
+# عميل HTTP غير متزامن لطلبات Node API وعميل Redis غير متزامن لكاش الردود
+AHTTP = AsyncPooledHttpClient(
+    pool_size=int(os.getenv('ASYNC_HTTP_POOL_SIZE', '100')),
+    max_retries=int(os.getenv('HTTP_MAX_RETRIES', '2')),
+    timeout=float(os.getenv('HTTP_TIMEOUT', '5')),
+)
+AREDIS = aioredis.Redis(host=server.REDIS_HOST, port=server.REDIS_PORT, db=0) if server.cache is not None else None
+
+
+class JSON(JSONResponse):
+    """Same encoding as the Flask app's responses (UTF-8, NaN allowed, str() for the rest)"""
+
+    def render(self, content) -> bytes:
+        return json.dumps(content, ensure_ascii=False, default=str).encode('utf-8')
+
+
+async def _json_body(request) -> dict:
+    try:
+        data = await request.json()
+    except Exception:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+# توليد رد المبيعات بدون حجز خيط أثناء الانتظار
+async def agenerate_sales(turn: dict) -> str:
+    """hf_generate_sales for the event loop"""
+    if not server.MODEL_LOADER.ready:
+        return server.MODEL_NOT_READY_REPLY
+    system, user, catalog_version, semantic_text = turn["system"], turn["user"], turn["catalog_version"], turn["semantic_text"]
+    cache_key = server._sales_cache_key(system, user, catalog_version)
+    with server.METRICS.span("cache_lookup"):
+        cached = await _sales_cache_get(cache_key, system, semantic_text, catalog_version)
+    if cached:
+        return cached
+
+    prompt, prefix = server._sales_chat_prompt(system, user, turn["shop_header"])
+    with server.METRICS.span("generation"):
+        text = await server.INFERENCE.agenerate(prompt, prefix=prefix, timeout=server.GEN_TIMEOUT)
+    text = server.sanitize_response(text)
+    await _sales_cache_set(cache_key, text, system, semantic_text, catalog_version)
+    return text
+
+
+async def astream_sales(turn: dict):
+    """hf_stream_sales for the event loop"""
+    if not server.MODEL_LOADER.ready:
+        yield server.MODEL_NOT_READY_REPLY
+        return
+    system, user, catalog_version, semantic_text = turn["system"], turn["user"], turn["catalog_version"], turn["semantic_text"]
+    cache_key = server._sales_cache_key(system, user, catalog_version)
+    with server.METRICS.span("cache_lookup"):
+        cached = await _sales_cache_get(cache_key, system, semantic_text, catalog_version)
+    if cached:
+        yield cached
+        return
+
+    parts = []
+    prompt, prefix = server._sales_chat_prompt(system, user, turn["shop_header"])
+    async for chunk in server.INFERENCE.astream(prompt, prefix=prefix, timeout=server.GEN_TIMEOUT):
+        parts.append(chunk)
+        yield chunk
+    await _sales_cache_set(cache_key, server.sanitize_response("".join(parts).strip()), system, semantic_text, catalog_version)
+
+
+async def _sales_cache_get(cache_key: str, system: str, semantic_text: str, catalog_version: str):
+    cached = await server.RESPONSE_CACHE.aget(cache_key, AREDIS)
+    if cached:
+        logger.info("Returning cached response")
+        return cached
+    if not (server.SEMANTIC_CACHE and semantic_text):
+        return None
+    return await run_in_threadpool(server._semantic_cache_get, cache_key, system, semantic_text, catalog_version)
+
+
+async def _sales_cache_set(cache_key: str, text: str, system: str, semantic_text: str, catalog_version: str):
+    await server.RESPONSE_CACHE.aset(cache_key, text, AREDIS)
+    if server.SEMANTIC_CACHE and semantic_text and text:
+        await run_in_threadpool(server._semantic_cache_store, text, system, semantic_text, catalog_version)
+
+
+async def afetch_products_by_id(product_ids: list) -> dict:
+    """fetch_products_by_id over the async client (id -> product)"""
+    async def fetch(pid: str):
+        try:
+            r = await AHTTP.get(f"{server.ZUHALL_BASE}/api/v1/products/{quote(pid, safe='')}")
+            if r.status_code != 200:
+                return None
+            product = r.json().get("data")
+            return product if isinstance(product, dict) else None
+        except Exception as e:
+            logger.warning(f"Failed to fetch product {pid}: {e}")
+            return None
+
+    products = await asyncio.gather(*(fetch(pid) for pid in product_ids))
+    return {pid: product for pid, product in zip(product_ids, products) if product}
+
+
+# نقاط النهاية
+async def api_ai_chat(request):
+    try:
+        data = await _json_body(request)
+        if not data.get('message', '').strip():
+            return JSON({"error": "message is required"}, status_code=400)
+
+        turn = await run_in_threadpool(server._prepare_chat_turn, data)
+        if data.get('stream'):
+            return _stream_chat(turn)
+
+        try:
+            text = server._finish_chat_reply(turn, await agenerate_sales(turn))
+        except Exception as e:
+            logger.error(f"Generation error: {e}")
+            text = server._fallback_chat_reply(turn)
+
+        context_info = await run_in_threadpool(server.get_context_info, turn["session_id"])
+        return JSON({
+            "text": text,
+            **server._chat_picks(turn),
+            "context": context_info,
+            "timestamp": datetime.now().isoformat(),
+        })
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        return JSON({"error": str(e)}, status_code=500)
+
+
+def _stream_chat(turn: dict) -> StreamingResponse:
+    """Same JSON lines as the Flask stream: picks, model tokens, then the composed reply"""
+    async def events():
+        yield server._ndjson({"type": "picks", **server._chat_picks(turn)})
+        model_text = ""
+        try:
+            if turn["intent"] != "complaint":
+                async for chunk in astream_sales(turn):
+                    model_text += chunk
+                    yield server._ndjson({"type": "token", "text": chunk})
+            text = server._finish_chat_reply(turn, model_text)
+        except Exception as e:
+            logger.error(f"Generation error: {e}")
+            text = server._fallback_chat_reply(turn)
+        yield server._ndjson({
+            "type": "done",
+            "text": text,
+            "context": await run_in_threadpool(server.get_context_info, turn["session_id"]),
+            "timestamp": datetime.now().isoformat(),
+        })
+
+    return StreamingResponse(
+        events(),
+        media_type='application/x-ndjson',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def api_ai_search(request):
+    try:
+        payload, status = await run_in_threadpool(server.search_response, await _json_body(request))
+        return JSON(payload, status_code=status)
+    except Exception as e:
+        logger.error(f"Search API error: {e}")
+        return JSON({"error": str(e)}, status_code=500)
+
+
+async def api_ai_compare(request):
+    try:
+        data = await _json_body(request)
+        product_ids = data.get('product_ids', [])
+        fetched = {}
+        if isinstance(product_ids, list) and 2 <= len(product_ids) <= server.MAX_COMPARE_PRODUCTS:
+            ctx = await run_in_threadpool(server.get_shop_context_zuhall)  # may wait for the first catalog load
+            missing = await run_in_threadpool(server.compare_missing_ids, product_ids, ctx)
+            if missing:
+                fetched = await afetch_products_by_id(missing)
+        payload, status = await run_in_threadpool(server.compare_response, data, fetched)
+        return JSON(payload, status_code=status)
+    except Exception as e:
+        logger.error(f"Compare API error: {e}")
+        return JSON({"error": str(e)}, status_code=500)
+
+
+async def api_ai_similar(request):
+    try:
+        payload, status = await run_in_threadpool(server.similar_response, await _json_body(request))
+        return JSON(payload, status_code=status)
+    except Exception as e:
+        logger.error(f"Similar products API error: {e}")
+        return JSON({"error": str(e)}, status_code=500)
+
+
+async def api_ai_health(request):
+    status = server.health_status()
+    status["serving"] = "asgi"
+    status["async_http"] = AHTTP.stats()
+    return JSON(status)
+
+
+async def api_ai_metrics(request):
+    return PlainTextResponse(server.METRICS.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class RequestTimer:
+    """Per-endpoint latency into server.METRICS, up to the response headers (first byte when streaming)"""
+
+    def __init__(self, app, paths: set):
+        self.app = app
+        self.paths = paths  # native routes; the mounted Flask app times its own
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                server.METRICS.observe_request(scope["path"], message["status"], time.perf_counter() - started)
+            await send(message)
+
+        await self.app(scope, receive, timed_send)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    anyio.to_thread.current_default_thread_limiter().total_tokens = ASGI_THREADS
+    yield
+    await AHTTP.aclose()
+    if AREDIS is not None:
+        await AREDIS.aclose()
+
+
+ROUTES = [
+    Route('/api/ai/chat', api_ai_chat, methods=['POST']),
+    Route('/api/ai/search', api_ai_search, methods=['POST']),
+    Route('/api/ai/compare', api_ai_compare, methods=['POST']),
+    Route('/api/ai/similar', api_ai_similar, methods=['POST']),
+    Route('/api/ai/health', api_ai_health, methods=['GET']),
+    Route('/api/ai/metrics', api_ai_metrics, methods=['GET']),
+]
+
+app = Starlette(
+    routes=ROUTES + [Mount('/', WSGIMiddleware(server.app))],  # remaining Flask routes
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=server.CORS_ORIGINS, allow_methods=['*'], allow_headers=['*']),
+        Middleware(RequestTimer, paths={route.path for route in ROUTES}),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    port = int(os.getenv('PORT', '3001'))
+    logger.info(f"Starting Zuhall AI Sales Assistant (ASGI) on http://127.0.0.1:{port}")
+    uvicorn.run(app, host='127.0.0.1', port=port)
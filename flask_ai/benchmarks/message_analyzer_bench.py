@@ -0,0 +1,242 @@
+# قياس أداء محلل الرسائل مقارنة بالدوال القديمة
+"""Microbenchmark: single-pass MessageAnalyzer vs the legacy per-function keyword scans.
+
+Usage (from flask_ai/):
+    python benchmarks/message_analyzer_bench.py --log benchmarks/chat_log_sample.jsonl
+
+The legacy functions below are the implementations the analyzer replaced
+(copied verbatim). Every message is first checked for identical results, then
+both paths are timed on what a chat turn needs: intent + preferences + criteria.
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import normalize_token, tokenize  # noqa: E402
+from message_analyzer import SEARCH_STOPWORDS, SEARCH_SYNONYMS, MessageAnalyzer  # noqa: E402
+from semantic_cache_bench import load_messages  # noqa: E402
+
+EXTRA_MESSAGES = [
+    "بدي موبايل سامسونج رخيص تحت 500",
+    "hello show me cheap phones under 300 please",
+    "أرني لابتوب بين 1000 - 2000",
+    "بدي 700 شي بكاميرا وبطارية وشاشة حلوة",
+    "budget 450 for sony headphones",
+    "ابحث عن سماعات apple أكثر من 200",
+    "less than 90 xiaomi earbuds",
+    "عندي مشكلة بالطلب",
+    "قارن 1 و 2",
+    "ما هي الماركات المتوفرة؟",
+    "show me categories",
+    "شو رأيك فيه؟",
+]
+
+
+# -- legacy implementations ------------------------------------------------
+
+# Enhanced intent detection with implicit/explicit request detection
+def detect_sales_intent(message: str) -> tuple[str, dict]:
+    m = message.strip().lower()
+    intent = "info"
+    preferences = {}
+    
+    # Explicit request indicators
+    explicit_indicators = ["ابحث", "أرني", "عرض", "أظهر", "أريد", "بدي", "محتاج", "search", "show", "find", "want", "need"]
+    implicit_indicators = ["موبايل", "جوال", "لابتوب", "سماعات", "هاتف", "phone", "laptop", "headphones"]
+    
+    # Check for explicit requests
+    is_explicit = any(indicator in m for indicator in explicit_indicators)
+    is_implicit = any(indicator in m for indicator in implicit_indicators)
+    
+    # Price-related intent
+    if any(w in m for w in ["ميزانية", "سعر", "كم", "رخيص", "غالي", "price", "cheap", "expensive", "cost"]):
+        intent, preferences["focus"] = "prices", "price"
+        nums = re.findall(r"\d{2,6}", m)
+        if nums:
+            try:
+                preferences["budget"] = int(nums[0])
+            except Exception:
+                pass
+    # Deals and offers
+    elif any(w in m for w in ["عرض", "عروض", "خصم", "تخفيض", "offer", "deals", "discount", "sale"]):
+        intent, preferences["focus"] = "deals", "discount"
+    # Categories
+    elif any(w in m for w in ["تصنيف", "تصنيفات", "فئات", "قسم", "category", "categories"]):
+        intent = "categories"
+    # Brands
+    elif any(w in m for w in ["ماركة", "ماركات", "براند", "brand", "brands"]):
+        intent = "brands"
+    # Product browsing (implicit or explicit)
+    elif is_implicit or is_explicit:
+        intent, preferences["focus"] = "browse", "product"
+        # Extract product type
+        if any(w in m for w in ["موبايل", "جوال", "هاتف", "phone", "mobile"]):
+            preferences["product_type"] = "phone"
+        elif any(w in m for w in ["لابتوب", "كمبيوتر", "laptop", "computer"]):
+            preferences["product_type"] = "laptop"
+        elif any(w in m for w in ["سماعات", "سماعة", "headphones", "earbuds"]):
+            preferences["product_type"] = "headphones"
+    # Complaints
+    elif any(w in m for w in ["مشكلة", "شكوى", "سيء", "غلط", "مش عاجبني", "complaint", "problem", "bad"]):
+        intent = "complaint"
+    # Comparison requests
+    elif any(w in m for w in ["قارن", "مقارنة", "فرق", "compare", "comparison", "difference"]):
+        intent = "compare"
+    
+    # Set request type
+    preferences["request_type"] = "explicit" if is_explicit else "implicit" if is_implicit else "general"
+    
+    return intent, preferences
+
+# Check if message is an implicit product request
+def is_implicit_product_request(message: str) -> bool:
+    m = message.strip().lower()
+    implicit_indicators = [
+        "بدي", "محتاج", "أريد", "أبحث عن", "أرني", "عرض", "أظهر",
+        "موبايل", "جوال", "لابتوب", "سماعات", "هاتف",
+        "phone", "laptop", "headphones", "mobile"
+    ]
+    return any(indicator in m for indicator in implicit_indicators)
+
+# Extract user preferences from message
+def extract_preferences(message: str) -> dict:
+    m = message.strip().lower()
+    preferences = {}
+    
+    # Extract budget
+    budget_patterns = [
+        r"ميزانية\s*(\d+)", r"سعر\s*(\d+)", r"بدي\s*(\d+)", r"محتاج\s*(\d+)",
+        r"budget\s*(\d+)", r"price\s*(\d+)", r"under\s*(\d+)", r"less\s*than\s*(\d+)"
+    ]
+    for pattern in budget_patterns:
+        match = re.search(pattern, m)
+        if match:
+            preferences["budget"] = int(match.group(1))
+            break
+    
+    # Extract brand preferences
+    brand_indicators = ["سامسونج", "أبل", "هواوي", "شاومي", "samsung", "apple", "huawei", "xiaomi"]
+    for brand in brand_indicators:
+        if brand in m:
+            preferences["brand"] = brand
+            break
+    
+    # Extract product specifications
+    if "كاميرا" in m or "camera" in m:
+        preferences["specs"] = preferences.get("specs", []) + ["camera"]
+    if "بطارية" in m or "battery" in m:
+        preferences["specs"] = preferences.get("specs", []) + ["battery"]
+    if "شاشة" in m or "screen" in m:
+        preferences["specs"] = preferences.get("specs", []) + ["screen"]
+    
+    return preferences
+
+def extract_search_criteria(message: str) -> dict:
+    """Extract search criteria from user message using NLP"""
+    m = message.lower()
+    criteria = {
+        "keywords": [],
+        "concepts": [],
+        "terms": [],
+        "price_range": None,
+        "brand": None,
+        "category": None,
+        "specs": []
+    }
+    
+    # Extract keywords with synonyms
+    for main_word, word_list in SEARCH_SYNONYMS.items():
+        if any(word in m for word in word_list):
+            criteria["keywords"].extend(word_list)
+            criteria["concepts"].append(main_word)
+    
+    # Remaining free-text words are looked up in the catalog vocabulary
+    synonym_tokens = {normalize_token(w) for words in SEARCH_SYNONYMS.values() for w in words}
+    criteria["terms"] = [
+        t for t in dict.fromkeys(tokenize(m))
+        if len(t) > 1 and t not in SEARCH_STOPWORDS and t not in synonym_tokens
+    ]
+    
+    # Extract price range
+    price_patterns = [
+        r"(\d+)\s*-\s*(\d+)",  # range like "100-200"
+        r"تحت\s*(\d+)", r"under\s*(\d+)",  # under X
+        r"أقل\s*من\s*(\d+)", r"less\s*than\s*(\d+)",  # less than X
+        r"أكثر\s*من\s*(\d+)", r"more\s*than\s*(\d+)"  # more than X
+    ]
+    
+    for pattern in price_patterns:
+        match = re.search(pattern, m)
+        if match:
+            if "تحت" in pattern or "under" in pattern or "أقل" in pattern or "less" in pattern:
+                criteria["price_range"] = {"max": int(match.group(1))}
+            elif "أكثر" in pattern or "more" in pattern:
+                criteria["price_range"] = {"min": int(match.group(1))}
+            else:
+                criteria["price_range"] = {"min": int(match.group(1)), "max": int(match.group(2))}
+            break
+    
+    # Extract brand
+    brand_indicators = ["سامسونج", "أبل", "هواوي", "شاومي", "samsung", "apple", "huawei", "xiaomi", "sony", "lg"]
+    for brand in brand_indicators:
+        if brand in m:
+            criteria["brand"] = brand
+            break
+    
+    return criteria
+
+
+def legacy_turn(message: str) -> tuple:
+    intent, preferences = detect_sales_intent(message)
+    return intent, preferences, extract_preferences(message), extract_search_criteria(message), is_implicit_product_request(message)
+
+
+def analyzer_turn(analyzer: MessageAnalyzer, message: str) -> tuple:
+    a = analyzer.analyze(message)
+    return a.intent, a.preferences, a.user_preferences, a.criteria, a.implicit_request
+
+
+def timed(fn, messages: list, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for message in messages:
+            fn(message)
+    return (time.perf_counter() - started) / (rounds * len(messages))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--log", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat_log_sample.jsonl"))
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    messages = load_messages(args.log) + EXTRA_MESSAGES
+    started = time.perf_counter()
+    analyzer = MessageAnalyzer(SEARCH_SYNONYMS, SEARCH_STOPWORDS)
+    build_ms = (time.perf_counter() - started) * 1000
+
+    mismatches = [m for m in messages if legacy_turn(m) != analyzer_turn(analyzer, m)]
+    for message in mismatches:
+        print(f"MISMATCH  {message}")
+        print(f"  legacy:   {legacy_turn(message)}")
+        print(f"  analyzer: {analyzer_turn(analyzer, message)}")
+
+    # A chat turn used to run intent detection and search criteria (each with its own scans)
+    chat_legacy = timed(lambda m: (detect_sales_intent(m), extract_search_criteria(m)), messages, args.rounds)
+    chat_new = timed(analyzer.analyze, messages, args.rounds)
+    all_legacy = timed(legacy_turn, messages, args.rounds)
+
+    print(f"messages:            {len(messages)} ({len(mismatches)} mismatches)")
+    print(f"automaton build:     {build_ms:.1f} ms")
+    print(f"chat turn (legacy):  {chat_legacy * 1e6:.1f} us  (detect_sales_intent + extract_search_criteria)")
+    print(f"all four (legacy):   {all_legacy * 1e6:.1f} us")
+    print(f"analyzer:            {chat_new * 1e6:.1f} us  (all results, one scan)")
+    print(f"speedup:             {chat_legacy / chat_new:.1f}x per chat turn, {all_legacy / chat_new:.1f}x vs all four")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# قياس أداء الكاش الدلالي على سجل محادثات
+"""Replay a chat log through the semantic cache and report hit rate and latency saved.
+
+Usage (from flask_ai/):
+    python benchmarks/semantic_cache_bench.py --log benchmarks/chat_log_sample.jsonl
+    python benchmarks/semantic_cache_bench.py --gen-model Qwen/Qwen2.5-0.5B-Instruct
+
+The log is JSON lines with a ``message`` field. Misses are charged the measured
+``generate`` time of --gen-model when given, otherwise the fixed --gen-ms.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from semantic_cache import SemanticCache, TextEmbedder  # noqa: E402
+
+
+def load_messages(path: str) -> list:
+    messages = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                message = json.loads(line).get("message")
+                if message:
+                    messages.append(message)
+    return messages
+
+
+def make_generator(model_name: str, max_new_tokens: int):
+    """Callable that runs one greedy generate, like the server does on a cache miss"""
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForCausalLM.from_pretrained(model_name).eval()
+
+    def generate(message: str) -> str:
+        prompt = tokenizer.apply_chat_template([{"role": "user", "content": message}], tokenize=False, add_generation_prompt=True)
+        inputs = tokenizer(prompt, return_tensors="pt")
+        with torch.inference_mode():
+            out = model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False, pad_token_id=tokenizer.eos_token_id)
+        return tokenizer.decode(out[0][inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+
+    return generate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--log", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat_log_sample.jsonl"))
+    parser.add_argument("--embed-model", default=os.getenv('SEMANTIC_CACHE_MODEL', 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'))
+    parser.add_argument("--threshold", type=float, default=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.92')))
+    parser.add_argument("--gen-model", default="")
+    parser.add_argument("--gen-ms", type=float, default=1500.0, help="assumed generate latency when --gen-model is not given")
+    parser.add_argument("--max-new-tokens", type=int, default=60)
+    args = parser.parse_args()
+
+    messages = load_messages(args.log)
+    cache = SemanticCache(TextEmbedder(args.embed_model), threshold=args.threshold, max_entries=max(16, len(messages)))
+    generate = make_generator(args.gen_model, args.max_new_tokens) if args.gen_model else None
+    scope = "bench"
+
+    hits, lookup_s, generate_s, saved_s = 0, 0.0, 0.0, 0.0
+    gen_times = []
+    for message in messages:
+        started = time.perf_counter()
+        reply, similarity = cache.lookup(message, scope)
+        lookup_s += time.perf_counter() - started
+        if reply is not None:
+            hits += 1
+            # Charge a hit the average generate time seen so far (or the fixed estimate)
+            saved_s += (sum(gen_times) / len(gen_times)) if gen_times else args.gen_ms / 1000
+            print(f"HIT  {similarity:.3f}  {message}")
+            continue
+        started = time.perf_counter()
+        reply = generate(message) if generate else f"reply to: {message}"
+        elapsed = (time.perf_counter() - started) if generate else args.gen_ms / 1000
+        gen_times.append(elapsed)
+        generate_s += elapsed
+        cache.store(message, scope, reply)
+        print(f"MISS {similarity:.3f}  {message}")
+
+    total = len(messages)
+    print()
+    print(f"messages:          {total}")
+    print(f"hit rate:          {hits / total:.1%} ({hits}/{total})" if total else "hit rate:          n/a")
+    print(f"avg lookup:        {lookup_s / max(total, 1) * 1000:.2f} ms (embedding + vector search)")
+    print(f"generate time:     {generate_s:.2f} s spent on misses")
+    print(f"latency saved:     {saved_s:.2f} s ({saved_s / max(saved_s + generate_s, 1e-9):.1%} of uncached generate time)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+# فهرس الكتالوج الكامل للمساعد
+"""Full-catalog index for the Zuhall AI assistant.
+
+Products are kept both as the raw API dicts (for responses) and as columnar
+NumPy arrays (for ranking), so every search helper in server.py scores the
+whole catalog with vector operations and never touches the dicts on the hot
+path. Score components that do not depend on the query (popularity, discount
+percentage) are computed once per snapshot.
+"""
+from array import array
+from bisect import bisect_left
+from collections import Counter
+import hashlib
+import logging
+import math
+import re
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# تطبيع النص العربي/الإنجليزي قبل الفهرسة
+_ARABIC_DIACRITICS = re.compile(r"[\u0610-\u061a\u064b-\u065f\u0670\u0640]")
+_ARABIC_LETTER_MAP = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ى": "ي", "ة": "ه", "ؤ": "و", "ئ": "ي"})
+_TOKEN_RE = re.compile(r"\w+")
+DESCRIPTION_TOKEN_LIMIT = 200  # long descriptions add little to ranking but a lot to build time
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase, strip tashkeel/tatweel and unify alef/yaa/taa marbuta forms"""
+    return _ARABIC_DIACRITICS.sub("", (text or "").lower()).translate(_ARABIC_LETTER_MAP)
+
+def normalize_token(token: str) -> str:
+    token = normalize_text(token)
+    # Drop the Arabic definite article so "الموبايل" and "موبايل" share a posting list
+    if token.startswith("ال") and len(token) > 4:
+        token = token[2:]
+    return token
+
+def tokenize(text: str) -> list:
+    return [normalize_token(t) for t in _TOKEN_RE.findall(text or "") if not t.isdigit()]
+
+
+def _num(value) -> float:
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def ref_key(value) -> str:
+    """Normalize a category/brand reference (raw id or populated {_id,name}) to a comparable key"""
+    if isinstance(value, dict):
+        value = value.get('_id') or value.get('name') or ''
+    return str(value or '').strip().lower()
+
+def effective_price(product: dict) -> float:
+    """Price the customer actually pays (discounted price when present)"""
+    return _num(product.get("priceAfterDiscount") or product.get("price", 0))
+
+
+class InvertedIndex:
+    """Token -> posting list index with BM25 scoring over title + description.
+
+    Each posting list is a pair of parallel arrays (rows, weighted term
+    frequency). Synonym groups are merged into their own posting lists at build
+    time so a query for any member scores like one term. Scores come back as a
+    dense vector over all rows (0 = no match).
+    """
+
+    def __init__(self, titles: list, descriptions: list, synonyms: dict = None,
+                 title_weight: float = 3.0, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.size = len(titles)
+        postings = {}
+        lengths = array('d')
+        for row, (title, description) in enumerate(zip(titles, descriptions)):
+            counts = Counter()
+            for token in tokenize(title):
+                counts[token] += title_weight
+            for token in tokenize(description)[:DESCRIPTION_TOKEN_LIMIT]:
+                counts[token] += 1
+            lengths.append(sum(counts.values()))
+            for token, tf in counts.items():
+                entry = postings.get(token)
+                if entry is None:
+                    entry = postings[token] = (array('l'), array('d'))
+                entry[0].append(row)
+                entry[1].append(tf)
+        self.postings = {
+            token: (np.array(rows, dtype=np.int64), np.array(tfs, dtype=np.float64))
+            for token, (rows, tfs) in postings.items()
+        }
+        self.vocabulary = sorted(postings)
+
+        lengths = np.array(lengths, dtype=np.float64)
+        avg_length = lengths.mean() if len(lengths) else 0.0
+        # Per-row BM25 length normalization, precomputed once per build
+        self.length_norm = k1 * (1 - b + b * (lengths / avg_length if avg_length else 0))
+
+        self.synonym_groups = {}
+        for name, words in (synonyms or {}).items():
+            tokens = self.expand({normalize_token(w) for w in words})
+            self.synonym_groups[name] = self._merge(tokens)
+
+    def expand(self, tokens) -> set:
+        """Add vocabulary terms that extend a query token (phone -> phones)"""
+        expanded = set()
+        for token in tokens:
+            if not token:
+                continue
+            if len(token) < 3:
+                if token in self.postings:
+                    expanded.add(token)
+                continue
+            start = bisect_left(self.vocabulary, token)
+            for term in self.vocabulary[start:start + 50]:
+                if not term.startswith(token):
+                    break
+                expanded.add(term)
+        return expanded
+
+    def _merge(self, tokens) -> tuple:
+        """(unique rows, summed tf) over the posting lists of the tokens"""
+        # Sorted so sums are bit-identical in every worker (set order depends on the hash seed)
+        entries = [self.postings[t] for t in sorted(tokens) if t in self.postings]
+        if not entries:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        if len(entries) == 1:
+            return entries[0]
+        rows, inverse = np.unique(np.concatenate([e[0] for e in entries]), return_inverse=True)
+        return rows, np.bincount(inverse, weights=np.concatenate([e[1] for e in entries]))
+
+    def score(self, groups: list) -> np.ndarray:
+        """Dense BM25 scores over all rows; each group is a synonym name or a set of tokens"""
+        scores = np.zeros(self.size, dtype=np.float64)
+        k1 = self.k1
+        for group in groups:
+            if isinstance(group, str):
+                rows, tfs = self.synonym_groups.get(group) or self._merge(())
+            else:
+                rows, tfs = self._merge(self.expand(group))
+            df = len(rows)
+            if not df:
+                continue
+            idf = math.log(1 + (self.size - df + 0.5) / (df + 0.5))
+            scores[rows] += idf * tfs * (k1 + 1) / (tfs + self.length_norm[rows])
+        return scores
+
+    def rows_with(self, tokens) -> np.ndarray:
+        """Boolean row mask: rows containing any of the tokens (prefix-expanded)"""
+        mask = np.zeros(self.size, dtype=bool)
+        mask[self._merge(self.expand(tokens))[0]] = True
+        return mask
+
+
+class CatalogIndex:
+    """Columnar, read-only view over one catalog snapshot"""
+
+    def __init__(self, products: list, categories: list = None, brands: list = None, synonyms: dict = None):
+        started = time.perf_counter()
+        self.products = [p for p in (products or []) if isinstance(p, dict)]
+        self.categories = categories or []
+        self.brands = brands or []
+
+        self.ids = []
+        self.titles = []
+        self.descriptions = []
+        self.title_tokens = []
+        prices, discount_prices, effective_prices = [], [], []
+        ratings, ratings_counts, sold = [], [], []
+        category_ids, brand_ids = [], []
+        self.category_keys = []
+        self.brand_keys = []
+        self.category_codes = {}
+        self.brand_codes = {}
+        self.row_by_id = {}
+
+        for row, p in enumerate(self.products):
+            pid = str(p.get("_id", ""))
+            title = (p.get("title") or "").lower()
+            self.ids.append(pid)
+            self.titles.append(title)
+            self.descriptions.append((p.get("description") or "").lower())
+            self.title_tokens.append(frozenset(title.split()))
+            prices.append(_num(p.get("price")))
+            discount_prices.append(_num(p.get("priceAfterDiscount")))
+            effective_prices.append(effective_price(p))
+            ratings.append(_num(p.get("ratingsAverage")))
+            ratings_counts.append(_num(p.get("ratingsQuantity")))
+            sold.append(_num(p.get("sold")))
+            category_ids.append(self._code(ref_key(p.get("category")), self.category_codes, self.category_keys))
+            brand_ids.append(self._code(ref_key(p.get("brand")), self.brand_codes, self.brand_keys))
+            if pid:
+                self.row_by_id.setdefault(pid, row)
+
+        self.prices = np.array(prices, dtype=np.float64)
+        self.discount_prices = np.array(discount_prices, dtype=np.float64)
+        self.effective_prices = np.array(effective_prices, dtype=np.float64)
+        self.ratings = np.array(ratings, dtype=np.float64)
+        self.ratings_counts = np.array(ratings_counts, dtype=np.float64)
+        self.sold = np.array(sold, dtype=np.float64)
+        self.category_ids = np.array(category_ids, dtype=np.int64)
+        self.brand_ids = np.array(brand_ids, dtype=np.int64)
+        self._precompute_scores()
+
+        # Title word -> rows, for shared-word counts (similar products)
+        title_postings = {}
+        for row, words in enumerate(self.title_tokens):
+            for word in words:
+                title_postings.setdefault(word, []).append(row)
+        self._title_postings = {word: np.array(rows, dtype=np.int64) for word, rows in title_postings.items()}
+
+        # One newline-joined blob of titles: substring matches become a single regex scan
+        self._titles_blob = "\n".join(t.replace("\n", " ") for t in self.titles)
+        self._title_masks = {}
+        self._title_starts = np.cumsum([0] + [len(t) + 1 for t in self.titles[:-1]]) if self.titles else np.zeros(0, dtype=np.int64)
+
+        self.text = InvertedIndex(self.titles, self.descriptions, synonyms)
+        self.vectors = None  # (rows, dim) unit embeddings, attached once built (see vector_index.py)
+        self.similar = None  # precomputed neighbor table, attached once built (see similar_index.py)
+        self.version = self._snapshot_version()
+        self.built_at = time.time()
+        logger.info(f"Catalog index built: {len(self.products)} products in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    def _precompute_scores(self):
+        """Query-independent score vectors, rebuilt with every snapshot"""
+        # Sales (capped at 5) + rating + review count (capped at 2): the get_popular_products order
+        self.popularity = (
+            np.minimum(5, self.sold / 5)
+            + np.where(self.ratings > 0, self.ratings * 0.5, 0)
+            + np.minimum(2, self.ratings_counts / 10)
+        )
+        self.sales_score = np.minimum(2, self.sold / 10)
+        self.has_discount = (self.discount_prices > 0) & (self.discount_prices < self.prices)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pct = (self.prices - self.discount_prices) / self.prices * 100
+        self.discount_pct = np.where(self.has_discount, pct, 0.0)
+        self.discount_rows = np.flatnonzero(self.has_discount)
+
+    def _snapshot_version(self) -> str:
+        """Content hash of the snapshot; identical across workers that loaded the same catalog"""
+        digest = hashlib.sha1()
+        for p in self.products:
+            digest.update(f"{p.get('_id')}|{p.get('updatedAt')}|{p.get('price')}|{p.get('priceAfterDiscount')}\n".encode())
+        for item in self.categories + self.brands:
+            if isinstance(item, dict):
+                digest.update(f"{item.get('_id')}|{item.get('name')}\n".encode())
+        return digest.hexdigest()[:12]
+
+    @staticmethod
+    def _code(key: str, codes: dict, keys: list) -> int:
+        if not key:
+            return -1
+        code = codes.get(key)
+        if code is None:
+            code = codes[key] = len(keys)
+            keys.append(key)
+        return code
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    def row_of(self, product_id) -> int:
+        """Row of a product id, or None when it is not in the snapshot"""
+        return self.row_by_id.get(str(product_id))
+
+    def get(self, product_id) -> dict:
+        row = self.row_of(product_id)
+        return self.products[row] if row is not None else None
+
+    def take(self, rows) -> list:
+        return [self.products[r] for r in rows]
+
+    @staticmethod
+    def top_k(scores: np.ndarray, limit: int, rows: np.ndarray = None) -> list:
+        """Rows with the highest scores via argpartition; ties keep row order like a stable reverse sort.
+
+        ``scores`` is aligned with ``rows`` when rows are given, otherwise with the whole catalog.
+        """
+        count = len(scores)
+        if not count or limit <= 0:
+            return []
+        if count > limit:
+            kth = np.partition(scores, count - limit)[count - limit]
+            candidates = np.flatnonzero(scores >= kth)
+        else:
+            candidates = np.arange(count)
+        order = candidates[np.lexsort((candidates, -scores[candidates]))][:limit]
+        return (rows[order] if rows is not None else order).tolist()
+
+    def title_overlap(self, words) -> np.ndarray:
+        """Number of title words each row shares with ``words``"""
+        postings = [self._title_postings[w] for w in words if w in self._title_postings]
+        if not postings:
+            return np.zeros(len(self.products), dtype=np.int64)
+        return np.bincount(np.concatenate(postings), minlength=len(self.products))
+
+    def titles_containing(self, words) -> np.ndarray:
+        """Boolean row mask: title contains any of the (lowercase) words as a substring (memoized per snapshot)"""
+        key = tuple(sorted({w for w in words if w}))
+        mask = self._title_masks.get(key)
+        if mask is not None:
+            return mask
+        mask = np.zeros(len(self.titles), dtype=bool)
+        if key and self.titles:
+            pattern = re.compile("|".join(re.escape(w) for w in sorted(key, key=len, reverse=True)))
+            positions = [match.start() for match in pattern.finditer(self._titles_blob)]
+            if positions:
+                mask[np.searchsorted(self._title_starts, positions, side='right') - 1] = True
+        mask.flags.writeable = False
+        if len(self._title_masks) >= 64:
+            self._title_masks.clear()
+        self._title_masks[key] = mask
+        return mask
@@ -0,0 +1,230 @@
+# تحديث كتالوج المتجر في الخلفية
+"""Background refresher for the shop catalog snapshot.
+
+Requests always read the current snapshot and never wait on the Node API
+(stale-while-revalidate); a daemon thread rebuilds the snapshot every
+``interval`` seconds. Between periodic full reloads only products changed since
+the last sync are pulled (``updatedAt[gte]``), and every page request carries
+the ETag from the previous response so unchanged pages come back as 304.
+Products, categories and brands are fetched concurrently, and once the first
+page reports ``numberOfPages`` the remaining pages are fetched concurrently too.
+A failed refresh keeps serving the previous snapshot.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogFetchError(Exception):
+    pass
+
+
+class CatalogRefresher:
+    def __init__(self, base_url: str, index_factory, client, interval: int = 60, full_every: int = 10,
+                 page_size: int = 100, max_pages: int = 500, initial_wait: float = 15):
+        self.base_url = base_url.rstrip('/')
+        self.index_factory = index_factory
+        self.client = client
+        self.interval = interval
+        self.full_every = max(1, full_every)
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.initial_wait = initial_wait
+
+        self._snapshot = None
+        self._synced_at = 0.0
+        self._last_updated_at = None  # highest updatedAt seen, in the API's own clock
+        self._etags = {}  # url -> (etag, payload)
+        self._cycles = 0
+        self._last_error = None
+        self._ready = threading.Event()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        # Resource-level fan-out; page requests go to the HTTP client's own pool
+        self._resources = ThreadPoolExecutor(max_workers=3, thread_name_prefix='catalog-resource')
+
+    # -- public API ---------------------------------------------------------
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='catalog-refresher', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """Stop the refresh thread and resource pool, keeping the snapshot (gunicorn master after preload)"""
+        with self._lock:
+            thread = self._thread
+            self._stop.set()
+            self._wake.set()
+        if thread is not None:
+            thread.join(timeout)
+        self._resources.shutdown(wait=True)
+
+    def after_fork(self):
+        """Fresh locks, pool and refresh thread in a forked worker; the snapshot itself is kept"""
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._resources = ThreadPoolExecutor(max_workers=3, thread_name_prefix='catalog-resource')
+        self._thread = None
+        if self._snapshot is not None:
+            self.start()
+
+    def snapshot(self) -> dict:
+        """Current shop context; only the very first call waits for the initial load"""
+        if self._snapshot is None:
+            self.start()
+            self._ready.wait(self.initial_wait)
+        return self._snapshot or self._empty_snapshot()
+
+    def _empty_snapshot(self) -> dict:
+        return {"products": [], "categories": [], "brands": [], "index": self.index_factory([], [], [])}
+
+    def refresh_soon(self):
+        self._wake.set()
+
+    def status(self) -> dict:
+        snap = self._snapshot
+        return {
+            "products": len(snap["products"]) if snap else 0,
+            "version": snap["index"].version if snap else None,
+            "age_seconds": round(time.time() - self._synced_at, 1) if snap else None,
+            "last_error": self._last_error,
+        }
+
+    # -- refresh loop -------------------------------------------------------
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.perf_counter()
+            full = self._snapshot is None or self._cycles % self.full_every == 0
+            try:
+                self._refresh(full)
+                self._last_error = None
+                logger.info(f"Catalog {'full' if full else 'incremental'} refresh done in {(time.perf_counter() - started) * 1000:.0f} ms")
+            except Exception as e:
+                # Keep serving the previous snapshot; never blank out the cache
+                self._last_error = str(e)
+                logger.warning(f"Catalog refresh failed, serving stale snapshot: {e}")
+            finally:
+                self._ready.set()
+            self._cycles += 1
+            # Retry the initial load quickly; afterwards follow the regular interval
+            self._wake.wait(self.interval if self._snapshot else min(self.interval, 5))
+            self._wake.clear()
+
+    def _refresh(self, full: bool):
+        previous = self._snapshot
+        categories_job = self._resources.submit(self._fetch_or_keep, "categories", previous)
+        brands_job = self._resources.submit(self._fetch_or_keep, "brands", previous)
+
+        if full or previous is None:
+            products = self._fetch_all("products")
+            self._track_updated_at(products)
+        else:
+            updates = []
+            if self._last_updated_at:
+                updates = self._fetch_all("products", f"&updatedAt[gte]={self._last_updated_at}&sort=updatedAt")
+            self._track_updated_at(updates)
+            products = self._merge(previous["products"], updates)
+        categories, brands = categories_job.result(), brands_job.result()
+
+        lists = {"products": products, "categories": categories, "brands": brands}
+        if previous is None or any(lists[key] is not previous[key] for key in lists):
+            index = self.index_factory(products, categories, brands)
+            if previous is None or index.version != previous["index"].version:
+                self._snapshot = dict(lists, index=index)
+        self._synced_at = time.time()
+
+    def _fetch_or_keep(self, resource: str, previous: dict) -> list:
+        try:
+            return self._fetch_all(resource)
+        except CatalogFetchError:
+            if previous is None:
+                raise
+            logger.warning(f"Keeping previous {resource} after fetch failure")
+            return previous[resource]
+
+    def _fetch_all(self, resource: str, extra_query: str = "") -> list:
+        """Every page of a Node API list endpoint; raises instead of returning a partial list"""
+        # Incremental URLs change every cycle, so only full-list pages are revalidated
+        revalidate = not extra_query
+
+        def fetch(page: int) -> tuple:
+            return self._fetch_page(f"{self.base_url}/api/v1/{resource}?limit={self.page_size}&page={page}{extra_query}", revalidate)
+
+        first, fresh = fetch(1)
+        pages = [first]
+        unchanged = not fresh
+        pagination = first.get("paginationResult") or {}
+        if len(first.get("data") or []) >= self.page_size and pagination.get("next"):
+            if revalidate:
+                # numberOfPages is exact for unfiltered lists: fetch the rest in parallel
+                last = min(int(pagination.get("numberOfPages") or 1), self.max_pages)
+                for payload, fresh in self.client.map(fetch, range(2, last + 1)):
+                    pages.append(payload)
+                    unchanged = unchanged and not fresh
+                if last == self.max_pages:
+                    logger.warning(f"Stopped paging {resource} after {self.max_pages} pages")
+            else:
+                # The API counts all documents, not the filtered ones, so walk filtered pages in order
+                for page in range(2, self.max_pages + 1):
+                    payload, _ = fetch(page)
+                    pages.append(payload)
+                    if len(payload.get("data") or []) < self.page_size or not (payload.get("paginationResult") or {}).get("next"):
+                        break
+        if unchanged and self._snapshot is not None and revalidate:
+            return self._snapshot[resource]  # every page was a 304: keep the same list object
+        return [item for payload in pages for item in (payload.get("data") or [])]
+
+    def _fetch_page(self, url: str, revalidate: bool = True) -> tuple:
+        """(payload, fresh) for one page, revalidating with If-None-Match when possible"""
+        cached = self._etags.get(url) if revalidate else None
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        try:
+            r = self.client.get(url, headers=headers)
+            if r.status_code == 304 and cached:
+                return cached[1], False
+            r.raise_for_status()
+            payload = r.json()
+        except Exception as e:
+            raise CatalogFetchError(f"Failed to fetch {url}: {e}") from e
+        if not isinstance(payload, dict):
+            raise CatalogFetchError(f"Unexpected payload from {url}")
+        etag = r.headers.get("ETag")
+        if etag and revalidate:
+            self._etags[url] = (etag, payload)
+        return payload, True
+
+    # -- helpers ------------------------------------------------------------
+
+    @staticmethod
+    def _merge(products: list, updates: list) -> list:
+        """Apply changed products to the previous list; new ones go first (API order is newest first).
+
+        Returns the previous list object itself when nothing actually changed
+        (``updatedAt[gte]`` always re-sends the newest product).
+        """
+        known = {str(p.get("_id")): p.get("updatedAt") for p in products}
+        by_id = {
+            str(p.get("_id")): p for p in updates
+            if str(p.get("_id")) not in known or known[str(p.get("_id"))] != p.get("updatedAt")
+        }
+        if not by_id:
+            return products
+        merged = [by_id.pop(str(p.get("_id")), p) for p in products]
+        return list(by_id.values())[::-1] + merged
+
+    def _track_updated_at(self, products: list):
+        stamps = [p.get("updatedAt") for p in products if isinstance(p, dict) and p.get("updatedAt")]
+        if stamps:
+            latest = max(stamps)
+            if not self._last_updated_at or latest > self._last_updated_at:
+                self._last_updated_at = latest
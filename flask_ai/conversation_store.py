@@ -0,0 +1,305 @@
+# تخزين سياق المحادثة (ذاكرة العملية أو Redis)
+"""Conversation context and its stores.
+
+``ConversationContext`` uses ``__slots__`` and round-trips through a plain
+state dict so it can be serialized compactly. Recently shown products are kept
+as ``ProductRef`` records (id, title, price, discount price), not full product
+dicts; the full product is resolved against the catalog index when needed.
+Two stores share one interface:
+
+* ``LocalContextStore``: per-process LRU with a sliding TTL and a hard cap on
+  sessions, so memory stays bounded however many anonymous sessions arrive.
+* ``RedisContextStore``: one Redis hash per session (a msgpack value per field)
+  with a sliding EXPIRE, shared by every worker and surviving restarts. If
+  Redis is unreachable it falls back to a local store for a while.
+
+``update`` is an atomic read-modify-write per session: striped locks locally,
+WATCH/MULTI with retries in Redis. So two concurrent requests of one session
+cannot overwrite each other's changes.
+"""
+from collections import OrderedDict
+from datetime import datetime
+import copy
+import logging
+import threading
+import time
+import zlib
+
+import msgpack
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+def _price(value) -> float:
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class ProductRef:
+    """Immutable projection of a product kept in conversation context"""
+    __slots__ = ("id", "title", "price", "price_after_discount")
+
+    def __init__(self, product_id: str, title: str, price: float, price_after_discount: float = 0.0):
+        object.__setattr__(self, "id", product_id)
+        object.__setattr__(self, "title", title)
+        object.__setattr__(self, "price", price)
+        object.__setattr__(self, "price_after_discount", price_after_discount)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ProductRef is immutable")
+
+    @classmethod
+    def from_product(cls, product: dict) -> "ProductRef":
+        return cls(str(product.get("_id", "")), product.get("title") or "",
+                   _price(product.get("price")), _price(product.get("priceAfterDiscount")))
+
+    @classmethod
+    def from_state(cls, state) -> "ProductRef":
+        # Contexts saved before refs were introduced hold whole product dicts
+        return cls.from_product(state) if isinstance(state, dict) else cls(*state)
+
+    def to_state(self) -> list:
+        return [self.id, self.title, self.price, self.price_after_discount]
+
+    def to_dict(self) -> dict:
+        product = {"_id": self.id, "title": self.title, "price": self.price}
+        if self.price_after_discount:
+            product["priceAfterDiscount"] = self.price_after_discount
+        return product
+
+
+class ConversationContext:
+    __slots__ = (
+        "user_preferences", "last_products", "last_categories", "last_brands",
+        "conversation_history", "current_budget", "favorite_brands", "product_interest",
+    )
+
+    def __init__(self):
+        self.user_preferences = {}
+        self.last_products = []
+        self.last_categories = []
+        self.last_brands = []
+        self.conversation_history = []
+        self.current_budget = None
+        self.favorite_brands = []
+        self.product_interest = []
+
+    def to_state(self) -> dict:
+        state = {name: getattr(self, name) for name in self.__slots__}
+        state["last_products"] = [ref.to_state() for ref in self.last_products]
+        return state
+
+    def copy(self) -> "ConversationContext":
+        """Independent copy; ProductRefs are immutable and shared"""
+        context = ConversationContext()
+        for name in self.__slots__:
+            value = getattr(self, name)
+            setattr(context, name, list(value) if name == "last_products" else copy.deepcopy(value))
+        return context
+
+    @classmethod
+    def from_state(cls, state: dict) -> "ConversationContext":
+        context = cls()
+        for name in cls.__slots__:
+            if name in state:
+                setattr(context, name, state[name])
+        context.last_products = [ProductRef.from_state(ref) for ref in context.last_products or []]
+        return context
+
+    def update_context(self, message: str, intent: str, preferences: dict, products: list = None):
+        """Update conversation context with new information"""
+        # Update user preferences
+        if preferences.get("budget"):
+            self.current_budget = preferences["budget"]
+        if preferences.get("brand"):
+            if preferences["brand"] not in self.favorite_brands:
+                self.favorite_brands.append(preferences["brand"])
+        if preferences.get("product_type"):
+            if preferences["product_type"] not in self.product_interest:
+                self.product_interest.append(preferences["product_type"])
+
+        # Update last viewed items
+        if products:
+            self.last_products = [ProductRef.from_product(p) for p in products[:5]]  # Keep last 5 products
+        if intent == "categories":
+            self.last_categories = preferences.get("categories", [])
+        if intent == "brands":
+            self.last_brands = preferences.get("brands", [])
+
+        # Add to conversation history
+        self.conversation_history.append({
+            "message": message,
+            "intent": intent,
+            "timestamp": datetime.now().isoformat()
+        })
+
+        # Keep only last 10 interactions
+        if len(self.conversation_history) > 10:
+            self.conversation_history = self.conversation_history[-10:]
+
+    def get_context_info(self) -> dict:
+        """Get current context information"""
+        return {
+            "user_preferences": self.user_preferences,
+            "last_products": [ref.to_dict() for ref in self.last_products],
+            "current_budget": self.current_budget,
+            "favorite_brands": self.favorite_brands,
+            "product_interest": self.product_interest,
+            "recent_intents": [h["intent"] for h in self.conversation_history[-3:]]
+        }
+
+    def resolve_products(self, index, positions: list = None) -> list:
+        """Full catalog products for the last shown refs, optionally by 1-based position (gone products are dropped)"""
+        refs = self.last_products
+        if positions is not None:
+            refs = [refs[p - 1] for p in positions if 0 < p <= len(refs)]
+        products = (index.get(ref.id) for ref in refs)
+        return [p for p in products if p is not None]
+
+    def resolve_context_references(self, message: str) -> str:
+        """Resolve context references in user message"""
+        m = message.lower()
+
+        # Handle "شو رأيك فيه؟" (what do you think about it?)
+        if "شو رأيك" in m or "what do you think" in m:
+            if self.last_products:
+                return f"شو رأيك في {self.last_products[0].title or 'هذا المنتج'}؟"
+
+        # Handle "أرني غيره" (show me others)
+        if "أرني غيره" in m or "show me others" in m:
+            if self.last_products:
+                return f"أرني منتجات مشابهة لـ {self.last_products[0].title or 'هذا المنتج'}"
+
+        # Handle "نفس السعر" (same price)
+        if "نفس السعر" in m or "same price" in m:
+            if self.current_budget:
+                return f"أرني منتجات بنفس السعر {self.current_budget}$"
+
+        return message
+
+
+class LocalContextStore:
+    def __init__(self, max_sessions: int = 10000, ttl: float = 1800, lock_stripes: int = 64):
+        self.max_sessions = max(1, max_sessions)
+        self.ttl = ttl
+        self._contexts = OrderedDict()  # session_id -> (expires_at, context), least recently used first
+        self._lock = threading.Lock()
+        self._stripes = [threading.Lock() for _ in range(lock_stripes)]
+        self._evicted = 0
+
+    def get(self, session_id: str) -> ConversationContext:
+        """A copy of the session's context, or a fresh one (not stored until the first update)"""
+        with self._lock:
+            self._expire()
+            entry = self._contexts.get(session_id)
+            if entry is None:
+                return ConversationContext()
+            self._contexts[session_id] = (time.monotonic() + self.ttl, entry[1])
+            self._contexts.move_to_end(session_id)
+            return entry[1].copy()  # the stored context is only ever replaced, never mutated
+
+    def update(self, session_id: str, mutate) -> ConversationContext:
+        """Apply mutate(context) atomically for this session and store the result"""
+        with self._stripe(session_id):
+            context = self.get(session_id)
+            mutate(context)  # on a copy: readers see the previous context or this one, never half of it
+            with self._lock:
+                self._contexts[session_id] = (time.monotonic() + self.ttl, context)
+                self._contexts.move_to_end(session_id)
+                while len(self._contexts) > self.max_sessions:
+                    self._contexts.popitem(last=False)
+                    self._evicted += 1
+            return context
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"backend": "memory", "sessions": len(self._contexts), "max_sessions": self.max_sessions, "evicted": self._evicted}
+
+    def _stripe(self, session_id: str) -> threading.Lock:
+        # Stable across processes, unlike hash(); only needs to spread sessions over the locks
+        return self._stripes[zlib.crc32(session_id.encode('utf-8')) % len(self._stripes)]
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._contexts:
+            session_id, (expires_at, _) = next(iter(self._contexts.items()))
+            if expires_at > now:
+                break
+            del self._contexts[session_id]
+            self._evicted += 1
+
+
+class RedisContextStore:
+    def __init__(self, client, ttl: int = 1800, prefix: str = "ctx:", max_retries: int = 5,
+                 fallback: LocalContextStore = None, retry_after: float = 30):
+        self.client = client
+        self.ttl = int(ttl)
+        self.prefix = prefix
+        self.max_retries = max_retries
+        self.fallback = fallback or LocalContextStore(ttl=ttl)
+        self.retry_after = retry_after
+        self._down_until = 0.0
+        self._counters = {"conflicts": 0, "errors": 0}
+
+    def get(self, session_id: str) -> ConversationContext:
+        if not self._available():
+            return self.fallback.get(session_id)
+        try:
+            return self._decode(self.client.hgetall(self._key(session_id)))
+        except redis.RedisError as e:
+            self._failed(e)
+            return self.fallback.get(session_id)
+
+    def update(self, session_id: str, mutate) -> ConversationContext:
+        if not self._available():
+            return self.fallback.update(session_id, mutate)
+        key = self._key(session_id)
+        try:
+            with self.client.pipeline() as pipe:
+                for _ in range(self.max_retries):
+                    try:
+                        # Optimistic lock: the transaction aborts if another request wrote this session meanwhile
+                        pipe.watch(key)
+                        context = self._decode(pipe.hgetall(key))
+                        mutate(context)
+                        pipe.multi()
+                        pipe.hset(key, mapping=self._encode(context))
+                        pipe.expire(key, self.ttl)
+                        pipe.execute()
+                        return context
+                    except redis.WatchError:
+                        self._counters["conflicts"] += 1
+                        continue
+            raise redis.RedisError(f"too many concurrent updates for session {session_id}")
+        except redis.RedisError as e:
+            self._failed(e)
+            return self.fallback.update(session_id, mutate)
+
+    def stats(self) -> dict:
+        return dict(self._counters, backend="redis", available=self._available(), fallback=self.fallback.stats())
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.prefix}{session_id}"
+
+    @staticmethod
+    def _encode(context: ConversationContext) -> dict:
+        return {name: msgpack.packb(value, use_bin_type=True) for name, value in context.to_state().items()}
+
+    @staticmethod
+    def _decode(fields: dict) -> ConversationContext:
+        state = {}
+        for name, value in (fields or {}).items():
+            name = name.decode('utf-8') if isinstance(name, bytes) else name
+            state[name] = msgpack.unpackb(value, raw=False)
+        return ConversationContext.from_state(state)
+
+    def _available(self) -> bool:
+        return time.time() >= self._down_until
+
+    def _failed(self, error: Exception):
+        self._counters["errors"] += 1
+        self._down_until = time.time() + self.retry_after
+        logger.warning(f"Context store Redis error, using in-process contexts for {self.retry_after:.0f}s: {error}")
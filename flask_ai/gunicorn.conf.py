@@ -0,0 +1,67 @@
+# تشغيل الإنتاج بعدة عمليات: النموذج يُحمّل مرة واحدة في العملية الأم ويُشارك مع العمال
+"""Production multi-worker launcher.
+
+    gunicorn -c gunicorn.conf.py server:app
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi_app:app
+
+``preload_app`` imports the app once in the master process: the model is
+loaded there (``MODEL_BACKGROUND_LOAD=0``), the catalog snapshot and its
+similar/vector tables are built, the catalog refresher and table builders are
+stopped, the heap is frozen (``gc.freeze``) and only then are workers forked. Workers share the weights and catalog pages
+copy-on-write, so adding workers adds throughput, not another copy of the
+model. After the fork each worker re-creates its own threads, HTTP pool and
+generation queue, and PyTorch gets ``cores // workers`` intra-op threads so
+workers do not oversubscribe the CPU.
+
+In-process caches and conversation contexts are per worker; set
+``CONTEXT_STORE=redis`` so a session's context follows it across workers.
+
+CPU only: CUDA cannot be used again in a forked process once the master has
+initialized it, so GPUs are hidden from the app (``CUDA_VISIBLE_DEVICES``) and
+the master refuses to fork if CUDA was initialized anyway. On a GPU host run a
+single ``python server.py`` / ``uvicorn asgi_app:app`` process instead.
+"""
+import gc
+import multiprocessing
+import os
+import sys
+
+os.environ.setdefault('MODEL_BACKGROUND_LOAD', '0')  # load in the master, before forking
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')  # fast tokenizers are not fork-safe once used
+os.environ['CUDA_VISIBLE_DEVICES'] = ''  # workers cannot use a CUDA context created in the master
+
+bind = os.getenv('BIND', f"127.0.0.1:{os.getenv('PORT', '3001')}")
+workers = int(os.getenv('WEB_WORKERS', str(multiprocessing.cpu_count())))
+worker_class = os.getenv('WEB_WORKER_CLASS', 'gthread')  # -k uvicorn.workers.UvicornWorker for asgi_app:app
+threads = int(os.getenv('WEB_THREADS', '8'))  # per worker (gthread)
+preload_app = True
+timeout = int(os.getenv('WEB_TIMEOUT', '180'))  # longer than GEN_TIMEOUT
+graceful_timeout = 30
+keepalive = 5
+
+PRELOAD_TIMEOUT = float(os.getenv('PRELOAD_TIMEOUT', '900'))
+
+
+def _app_module():
+    return sys.modules.get('server')  # imported by preload_app (directly or through asgi_app)
+
+
+def when_ready(arbiter):
+    """Master, after the app was imported and before the first fork"""
+    app = _app_module()
+    if app is None:
+        return
+    if app.torch.cuda.is_initialized():
+        raise RuntimeError("CUDA was initialized in the gunicorn master; forked workers cannot use it (CPU only launcher)")
+    app.prepare_for_fork(PRELOAD_TIMEOUT)
+    gc.collect()
+    gc.freeze()  # keep the collector from touching (and copying) the preloaded objects in workers
+    arbiter.log.info(f"Preloaded model {app.MODEL_NAME} ({app.MODEL_LOADER.state}); forking {workers} workers")
+
+
+def post_fork(arbiter, worker):
+    app = _app_module()
+    if app is None:
+        return
+    torch_threads = int(os.getenv('TORCH_NUM_THREADS', '0')) or max(1, multiprocessing.cpu_count() // max(1, workers))
+    app.after_fork(torch_threads)
@@ -0,0 +1,174 @@
+# عميل HTTP مشترك مع تجميع الاتصالات
+"""Pooled HTTP client for calls to the Node API.
+
+One keep-alive ``requests.Session`` per process, bounded retries with full
+jitter for transient failures, and a shared thread pool so independent pages
+and resources can be fetched concurrently. ``AsyncPooledHttpClient`` is the
+httpx counterpart for the ASGI app, with the same retry policy.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except Exception:  # optional dependency (ASGI mode only)
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class PooledHttpClient:
+    def __init__(self, pool_size: int = 16, max_retries: int = 2, backoff: float = 0.2,
+                 backoff_cap: float = 2.0, timeout: float = 5, max_workers: int = 8):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.max_workers = max_workers
+        self._open()
+
+        self._lock = threading.Lock()
+        self._counters = {"requests": 0, "retries": 0, "failures": 0, "not_modified": 0}
+        self._latency_total = 0.0
+
+    def _open(self):
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=0)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='http-fetch')
+
+    def close(self):
+        """Join the pool threads and drop keep-alive sockets (gunicorn master after preload)"""
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def after_fork(self):
+        """New session and pool in a forked worker (keep-alive sockets and pool threads belong to the parent)"""
+        self._lock = threading.Lock()
+        self._open()
+
+    def get(self, url: str, headers: dict = None) -> requests.Response:
+        """GET with retries on connection errors, timeouts and 429/5xx gateway statuses"""
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    self._record(started, not_modified=response.status_code == 304)
+                    return response
+                error = f"HTTP {response.status_code}"
+                response.close()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    self._record(started, failed=True)
+                    raise
+                error = e
+            self._record(started, retried=True)
+            attempt += 1
+            # Full jitter keeps several workers from retrying against the API in lockstep
+            delay = random.uniform(0, min(self.backoff_cap, self.backoff * (2 ** attempt)))
+            logger.info(f"Retrying {url} in {delay:.2f}s after: {error}")
+            time.sleep(delay)
+
+    def map(self, fn, items) -> list:
+        """Run fn over items on the shared pool, preserving order (exceptions propagate)"""
+        return list(self.executor.map(fn, items))
+
+    def _record(self, started: float, retried: bool = False, failed: bool = False, not_modified: bool = False):
+        with self._lock:
+            self._counters["requests"] += 1
+            self._latency_total += time.perf_counter() - started
+            if retried:
+                self._counters["retries"] += 1
+            if failed:
+                self._counters["failures"] += 1
+            if not_modified:
+                self._counters["not_modified"] += 1
+
+    def stats(self) -> dict:
+        """Request counters plus per-host connection pool usage"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats["avg_latency_ms"] = round(self._latency_total / stats["requests"] * 1000, 1) if stats["requests"] else 0.0
+        pools = {}
+        manager = self.adapter.poolmanager
+        for key in list(manager.pools.keys()):
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            idle = sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0
+            pools[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+                "idle": idle,
+                "maxsize": pool.pool.maxsize if pool.pool else 0,
+            }
+        stats["pools"] = pools
+        return stats
+
+
+class AsyncPooledHttpClient:
+    def __init__(self, pool_size: int = 100, max_retries: int = 2, backoff: float = 0.2,
+                 backoff_cap: float = 2.0, timeout: float = 5):
+        if httpx is None:
+            raise RuntimeError("httpx is not installed")
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+        self._counters = {"requests": 0, "retries": 0, "failures": 0}
+        self._latency_total = 0.0
+
+    async def get(self, url: str, headers: dict = None):
+        """GET with retries on transport errors and 429/5xx gateway statuses"""
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                response = await self.client.get(url, headers=headers)
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    self._record(started)
+                    return response
+                error = f"HTTP {response.status_code}"
+            except httpx.TransportError as e:
+                if attempt >= self.max_retries:
+                    self._record(started, failed=True)
+                    raise
+                error = e
+            self._record(started, retried=True)
+            attempt += 1
+            delay = random.uniform(0, min(self.backoff_cap, self.backoff * (2 ** attempt)))
+            logger.info(f"Retrying {url} in {delay:.2f}s after: {error}")
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def _record(self, started: float, retried: bool = False, failed: bool = False):
+        # Only touched from the event loop thread
+        self._counters["requests"] += 1
+        self._latency_total += time.perf_counter() - started
+        if retried:
+            self._counters["retries"] += 1
+        if failed:
+            self._counters["failures"] += 1
+
+    def stats(self) -> dict:
+        stats = dict(self._counters)
+        stats["avg_latency_ms"] = round(self._latency_total / stats["requests"] * 1000, 1) if stats["requests"] else 0.0
+        return stats
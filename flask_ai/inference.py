@@ -0,0 +1,358 @@
+# جدولة التوليد على دفعات
+"""Dynamic batching for ``model.generate``.
+
+Request threads tokenize their prompt and enqueue it; a single worker thread
+owns the model, collects waiting prompts for up to ``max_wait_ms`` (or until
+``max_batch_size`` are waiting), groups prompts of similar length so left
+padding stays small, and resolves each caller's future with its own text.
+Streaming prompts run on their own (``TextIteratorStreamer`` only supports a
+batch of one) and hand decoded chunks to the caller as they are produced.
+
+Callers may also pass the static head of the prompt (system prompt + shop
+context). Its ``past_key_values`` are computed once and kept in a small LRU
+keyed by the prefix content, so prefill only runs over the per-request suffix.
+Jobs sharing a prefix are batched together with their suffixes left-padded
+after the shared prefix.
+
+With an ``assistant_model`` (a small draft model sharing the tokenizer) every
+prompt runs alone through assisted decoding: the draft proposes a few tokens
+and the target verifies them in one forward pass. Output is identical to plain
+greedy decoding. Forward passes of both models are counted to report how many
+drafted tokens were accepted and the tokens/sec of each request.
+
+``agenerate`` / ``astream`` are the asyncio entry points (ASGI mode): the
+caller awaits the job's future, and streamed chunks are handed to the event
+loop instead of a blocking queue, so waiting requests hold no threads.
+"""
+import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+import hashlib
+import logging
+import queue
+import threading
+import time
+
+import torch
+from transformers import DynamicCache, TextIteratorStreamer, TextStreamer
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTextStreamer(TextStreamer):
+    """Decoded chunks go to an asyncio queue on the caller's loop; None marks the end"""
+
+    def __init__(self, tokenizer, loop: asyncio.AbstractEventLoop):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, text)
+        if stream_end:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+
+class GenerationJob:
+    __slots__ = ("input_ids", "prefix_key", "prefix_len", "streamer", "future", "enqueued_at")
+
+    def __init__(self, input_ids: list, prefix_key: str = None, prefix_len: int = 0, streamer: TextIteratorStreamer = None):
+        self.input_ids = input_ids
+        self.prefix_key = prefix_key
+        self.prefix_len = prefix_len
+        self.streamer = streamer
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+    @property
+    def suffix_len(self) -> int:
+        return len(self.input_ids) - self.prefix_len
+
+
+class BatchScheduler:
+    def __init__(self, model, tokenizer, max_batch_size: int = 8, max_wait_ms: float = 10,
+                 pad_ratio: float = 1.3, generation_kwargs: dict = None, prefix_cache_size: int = 4,
+                 assistant_model=None, observe=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.assistant_model = assistant_model
+        # Assisted decoding only supports a batch of one
+        self.max_batch_size = 1 if assistant_model is not None else max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.pad_ratio = max(1.0, pad_ratio)
+        self.generation_kwargs = generation_kwargs or {}
+        self.observe = observe  # (stage, seconds) for tokenize / queue_wait / model_generate timings
+        # Decoder-only models must be left-padded so every row continues from its last real token
+        self.tokenizer.padding_side = 'left'
+        if self.tokenizer.pad_token_id is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        self.prefix_cache_size = max(0, prefix_cache_size)
+        self._prefix_ids = OrderedDict()  # prefix key -> token ids (request threads)
+        self._prefix_kv = OrderedDict()  # prefix key -> legacy past_key_values (worker thread only)
+        self._prefix_lock = threading.Lock()
+
+        self._queue = queue.Queue()
+        self._pending = deque()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "requests": 0, "batches": 0, "generated_tokens": 0, "generate_seconds": 0.0,
+            "prefill_tokens": 0, "prefix_hits": 0, "prefix_misses": 0, "prefix_tokens_reused": 0,
+        }
+        if assistant_model is not None:
+            self._forwards = {"target": 0, "draft": 0}
+            model.register_forward_hook(lambda *_: self._forwards.__setitem__("target", self._forwards["target"] + 1))
+            assistant_model.register_forward_hook(lambda *_: self._forwards.__setitem__("draft", self._forwards["draft"] + 1))
+            self._stats.update(target_passes=0, draft_tokens=0, accepted_draft_tokens=0)
+
+    def submit(self, prompt: str, prefix: str = None) -> Future:
+        """Queue a chat-templated prompt; the future resolves to the generated text.
+
+        ``prefix`` is the leading part of ``prompt`` shared by many requests;
+        its KV cache is reused across calls.
+        """
+        self._ensure_started()
+        job = self._make_job(prompt, prefix)
+        self._queue.put(job)
+        return job.future
+
+    def generate(self, prompt: str, prefix: str = None, timeout: float = None) -> str:
+        return self.submit(prompt, prefix).result(timeout=timeout)
+
+    def stream(self, prompt: str, prefix: str = None, timeout: float = None):
+        """Queue a prompt to run on its own and yield decoded text chunks as they are generated"""
+        self._ensure_started()
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=timeout)
+        job = self._make_job(prompt, prefix, streamer)
+        self._queue.put(job)
+        for chunk in streamer:
+            if chunk:
+                yield chunk
+        job.future.result(timeout=timeout)  # surface generation errors after the streamer closes
+
+    async def agenerate(self, prompt: str, prefix: str = None, timeout: float = None) -> str:
+        return await asyncio.wait_for(asyncio.wrap_future(self.submit(prompt, prefix)), timeout)
+
+    async def astream(self, prompt: str, prefix: str = None, timeout: float = None):
+        """stream() for asyncio callers"""
+        self._ensure_started()
+        streamer = AsyncTextStreamer(self.tokenizer, asyncio.get_running_loop())
+        job = self._make_job(prompt, prefix, streamer)
+        self._queue.put(job)
+        while True:
+            chunk = await asyncio.wait_for(streamer.queue.get(), timeout)
+            if chunk is None:
+                break
+            if chunk:
+                yield chunk
+        if not job.future.cancelled():
+            await asyncio.wait_for(asyncio.wrap_future(job.future), timeout)
+
+    def after_fork(self):
+        """Empty queue and fresh locks in a forked worker; the worker thread restarts on first use"""
+        self._queue = queue.Queue()
+        self._pending = deque()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._prefix_lock = threading.Lock()
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() + len(self._pending)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self.queue_depth()
+        stats["avg_batch_size"] = round(stats["requests"] / stats["batches"], 2) if stats["batches"] else 0.0
+        stats["tokens_per_sec"] = round(stats["generated_tokens"] / stats["generate_seconds"], 1) if stats["generate_seconds"] else 0.0
+        stats["generate_seconds"] = round(stats["generate_seconds"], 2)
+        if self.assistant_model is not None:
+            stats["acceptance_rate"] = round(stats["accepted_draft_tokens"] / stats["draft_tokens"], 3) if stats["draft_tokens"] else 0.0
+        return stats
+
+    def _encode(self, text: str) -> list:
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def _make_job(self, prompt: str, prefix: str = None, streamer: TextIteratorStreamer = None) -> GenerationJob:
+        started = time.perf_counter()
+        job = self._tokenize_job(prompt, prefix, streamer)
+        self._observe("tokenize", time.perf_counter() - started)
+        return job
+
+    def _tokenize_job(self, prompt: str, prefix: str = None, streamer: TextIteratorStreamer = None) -> GenerationJob:
+        if not prefix or not self.prefix_cache_size or not prompt.startswith(prefix):
+            return GenerationJob(self._encode(prompt), streamer=streamer)
+        key = hashlib.sha1(prefix.encode('utf-8')).hexdigest()[:16]
+        with self._prefix_lock:
+            prefix_ids = self._prefix_ids.get(key)
+            if prefix_ids is not None:
+                self._prefix_ids.move_to_end(key)
+        if prefix_ids is None:
+            prefix_ids = self._encode(prefix)
+            with self._prefix_lock:
+                self._prefix_ids[key] = prefix_ids
+                while len(self._prefix_ids) > self.prefix_cache_size:
+                    self._prefix_ids.popitem(last=False)
+        # Tokenized separately so the prefix ids are identical on every request
+        return GenerationJob(prefix_ids + self._encode(prompt[len(prefix):]), key, len(prefix_ids), streamer)
+
+    # -- worker -------------------------------------------------------------
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if not (self._thread and self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run, name='inference-worker', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            if not self._pending:
+                self._pending.append(self._queue.get())
+            self._collect()
+            batch = self._take_batch()
+            if not batch:
+                continue
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                logger.error(f"Batched generation failed ({len(batch)} prompts): {e}")
+                for job in batch:
+                    if job.streamer is not None:
+                        job.streamer.end()
+                    if not job.future.done():
+                        job.future.set_exception(e)
+
+    def _collect(self):
+        """Wait briefly for more prompts so they can share one generate call"""
+        deadline = self._pending[0].enqueued_at + self.max_wait
+        while len(self._pending) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                job = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self._pending.append(job)
+
+    def _take_batch(self) -> list:
+        """Oldest job plus the waiting jobs closest to its length, within pad_ratio"""
+        head = self._pending.popleft()
+        if head.streamer is not None:
+            return [head] if head.future.set_running_or_notify_cancel() else []
+        # Only jobs with the same cached prefix can share it; padding then only depends on suffix length
+        head_len = head.suffix_len
+        candidates = sorted(
+            (j for j in self._pending if j.streamer is None and j.prefix_key == head.prefix_key),
+            key=lambda j: abs(j.suffix_len - head_len),
+        )
+        batch = [head]
+        for job in candidates:
+            if len(batch) >= self.max_batch_size:
+                break
+            lengths = [job.suffix_len] + [j.suffix_len for j in batch]
+            if max(lengths) <= min(lengths) * self.pad_ratio:
+                batch.append(job)
+        for job in batch[1:]:
+            self._pending.remove(job)
+        # Futures cancelled by their caller (timeout, disconnect) are skipped; the rest can no longer be cancelled
+        return [job for job in batch if job.future.set_running_or_notify_cancel()]
+
+    def _prefix_cache(self, job: GenerationJob) -> tuple:
+        """Legacy past_key_values for the job's prefix, computing them on first use"""
+        kv = self._prefix_kv.get(job.prefix_key)
+        if kv is not None:
+            self._prefix_kv.move_to_end(job.prefix_key)
+            self._count(prefix_hits=1, prefix_tokens_reused=job.prefix_len)
+            return kv
+        prefix_ids = torch.tensor([job.input_ids[:job.prefix_len]], device=self.model.device)
+        with torch.inference_mode():
+            out = self.model(input_ids=prefix_ids, past_key_values=DynamicCache(), use_cache=True)
+        kv = out.past_key_values.to_legacy_cache()
+        self._prefix_kv[job.prefix_key] = kv
+        while len(self._prefix_kv) > self.prefix_cache_size:
+            self._prefix_kv.popitem(last=False)
+        self._count(prefix_misses=1, prefill_tokens=job.prefix_len)
+        return kv
+
+    def _prefixed_inputs(self, batch: list) -> dict:
+        """prefix + left-padded suffixes, with the cached prefix KV expanded to the batch"""
+        kv = self._prefix_cache(batch[0])
+        prefix_len = batch[0].prefix_len
+        width = max(j.suffix_len for j in batch)
+        pad_id = self.tokenizer.pad_token_id
+        rows, masks = [], []
+        for j in batch:
+            pad = width - j.suffix_len
+            rows.append(j.input_ids[:prefix_len] + [pad_id] * pad + j.input_ids[prefix_len:])
+            masks.append([1] * prefix_len + [0] * pad + [1] * j.suffix_len)
+        size = len(batch)
+        past = DynamicCache.from_legacy_cache(tuple(
+            (k.expand(size, -1, -1, -1).contiguous(), v.expand(size, -1, -1, -1).contiguous()) for k, v in kv
+        ))
+        device = self.model.device
+        return {
+            "input_ids": torch.tensor(rows, device=device),
+            "attention_mask": torch.tensor(masks, device=device),
+            "past_key_values": past,
+        }
+
+    def _run_batch(self, batch: list):
+        started = time.perf_counter()
+        for job in batch:
+            self._observe("queue_wait", started - job.enqueued_at)
+        if batch[0].prefix_key:
+            inputs = self._prefixed_inputs(batch)
+            self._count(prefill_tokens=sum(j.suffix_len for j in batch))
+        else:
+            inputs = self.tokenizer.pad([{"input_ids": j.input_ids} for j in batch], padding=True, return_tensors="pt").to(self.model.device)
+            self._count(prefill_tokens=sum(len(j.input_ids) for j in batch))
+        streamer = batch[0].streamer if len(batch) == 1 else None
+        if self.assistant_model is not None:
+            inputs["assistant_model"] = self.assistant_model
+            forwards = dict(self._forwards)
+        with torch.inference_mode():
+            outputs = self.model.generate(**inputs, streamer=streamer, **self.generation_kwargs)
+        input_len = inputs["input_ids"].shape[1]
+        eos_id = self.tokenizer.eos_token_id
+        texts, generated = [], 0
+        for row in outputs:
+            new_ids = row[input_len:].tolist()
+            if eos_id in new_ids:
+                new_ids = new_ids[:new_ids.index(eos_id)]
+            generated += len(new_ids)
+            texts.append(self.tokenizer.decode(new_ids, skip_special_tokens=True).strip())
+        elapsed = time.perf_counter() - started
+        if self.assistant_model is not None:
+            self._count_assisted(forwards, generated, elapsed)
+        with self._stats_lock:
+            self._stats["requests"] += len(batch)
+            self._stats["batches"] += 1
+            self._stats["generated_tokens"] += generated
+            self._stats["generate_seconds"] += elapsed
+        self._observe("model_generate", elapsed)
+        for job, text in zip(batch, texts):
+            if not job.future.done():
+                job.future.set_result(text)
+
+    def _count_assisted(self, before: dict, generated: int, elapsed: float):
+        """Each target pass verifies one draft run and keeps the accepted tokens plus one of its own"""
+        passes = self._forwards["target"] - before["target"]
+        drafted = self._forwards["draft"] - before["draft"]
+        accepted = max(0, generated - passes)
+        self._count(target_passes=passes, draft_tokens=drafted, accepted_draft_tokens=accepted)
+        rate = accepted / drafted if drafted else 0.0
+        logger.info(f"Assisted decoding: {generated} tokens, {accepted}/{drafted} drafted accepted ({rate:.0%}), "
+                    f"{passes} target passes, {generated / elapsed if elapsed else 0.0:.1f} tokens/sec")
+
+    def _observe(self, stage: str, seconds: float):
+        if self.observe is not None:
+            self.observe(stage, seconds)
+
+    def _count(self, **deltas):
+        with self._stats_lock:
+            for name, delta in deltas.items():
+                self._stats[name] += delta
@@ -0,0 +1,69 @@
+# كشف لغة الرسالة (عربي/إنجليزي) بعدّ الحروف
+"""Fast ar/en language detection for routing chat prompts.
+
+Only the Arabic vs English system prompt depends on the language, so the
+script of the message decides: the share of Arabic letters among Arabic +
+Latin letters. Arabic messages often name products in Latin letters
+("اريد iphone 15 pro max"), so a small Arabic share is enough for "ar". Clear
+cases cost a couple of regex scans. Only the narrow band in between goes to
+the seeded langdetect profiles, so answers are deterministic, and only "ar" or
+"en" is ever returned. Results are memoized; ``warm()`` loads the langdetect
+profiles at startup instead of on the first ambiguous message.
+"""
+from functools import lru_cache
+import logging
+import re
+
+from langdetect import DetectorFactory, detect, detect_langs
+
+logger = logging.getLogger(__name__)
+
+DetectorFactory.seed = 0  # langdetect is randomized unless seeded
+
+_ARABIC_RE = re.compile(r"[\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF\uFB50-\uFDFF\uFE70-\uFEFF]")
+_LATIN_RE = re.compile(r"[A-Za-z\u00C0-\u024F]")
+
+ARABIC_MIN_SHARE = 0.15  # at least this share of Arabic letters -> "ar"
+LATIN_MIN_SHARE = 0.95  # at least this share of Latin letters -> "en"
+DEFAULT_LANG = 'ar'  # no letters at all (numbers, emoji)
+
+
+def _letter_counts(text: str) -> tuple:
+    return len(_ARABIC_RE.findall(text)), len(_LATIN_RE.findall(text))
+
+
+def script_language(text: str):
+    """'ar' / 'en' from letter counts, or None when the scripts are too mixed to tell"""
+    arabic, latin = _letter_counts(text)
+    letters = arabic + latin
+    if not letters:
+        return DEFAULT_LANG
+    if arabic >= ARABIC_MIN_SHARE * letters:
+        return 'ar'
+    if latin >= LATIN_MIN_SHARE * letters:
+        return 'en'
+    return None
+
+
+@lru_cache(maxsize=4096)
+def detect_language(text: str) -> str:
+    """'ar' or 'en' for the message (mixed scripts: the likelier of the two per langdetect)"""
+    lang = script_language(text)
+    if lang is not None:
+        return lang
+    try:
+        for guess in detect_langs(text):
+            if guess.lang in ('ar', 'en'):
+                return guess.lang
+    except Exception:
+        pass
+    arabic, latin = _letter_counts(text)
+    return 'ar' if arabic >= latin else 'en'
+
+
+def warm():
+    """Load langdetect profiles now rather than on the first mixed-script message"""
+    try:
+        detect("warm up the language profiles")
+    except Exception as e:
+        logger.warning(f"langdetect warm-up failed: {e}")
@@ -0,0 +1,163 @@
+# محرك llama.cpp (ملفات GGUF) بنفس واجهة جدولة التوليد
+"""llama.cpp generation engine for GGUF models.
+
+Selected with ``INFERENCE_ENGINE=llama_cpp``. It exposes the calls
+``hf_generate_sales`` uses on the transformers side: ``apply_chat_template``
+(the GGUF's own chat template, ChatML when it has none) and ``generate`` /
+``stream`` / ``stats``. One ``Llama`` context is not thread-safe, so calls are
+serialized; ``timeout`` bounds both the wait for the engine and the completion
+itself (``TimeoutError``, so the caller falls back like on the transformers side). llama.cpp keeps the previous prompt's KV cache and only evaluates
+the part after the longest common prefix, so the static system prompt + shop
+header is not re-evaluated between requests (the ``prefix`` argument is
+accepted for interface parity). The asyncio variants run a whole completion on
+one worker thread and stop it when the caller times out or disconnects.
+"""
+import asyncio
+import logging
+import threading
+import time
+
+try:
+    from llama_cpp import Llama
+    from llama_cpp.llama_chat_format import Jinja2ChatFormatter
+except Exception:  # optional dependency
+    Llama = None
+    Jinja2ChatFormatter = None
+
+logger = logging.getLogger(__name__)
+
+
+class LlamaCppEngine:
+    def __init__(self, model_path: str, n_ctx: int = 4096, n_threads: int = None, n_gpu_layers: int = 0,
+                 generation_kwargs: dict = None):
+        if Llama is None:
+            raise RuntimeError("llama-cpp-python is not installed")
+        self.model_path = model_path
+        self.llm = Llama(model_path=model_path, n_ctx=n_ctx, n_threads=n_threads or None,
+                         n_gpu_layers=n_gpu_layers, verbose=False)
+        kwargs = generation_kwargs or {}
+        self.max_tokens = int(kwargs.get("max_new_tokens", 60))
+        self.repeat_penalty = float(kwargs.get("repetition_penalty", 1.0))
+        self._formatter = self._chat_formatter()
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._waiting = 0
+        self._stats = {"requests": 0, "generated_tokens": 0, "generate_seconds": 0.0}
+
+    def apply_chat_template(self, messages: list, tokenize: bool = False, add_generation_prompt: bool = True) -> str:
+        if self._formatter is not None:
+            return self._formatter(messages=messages).prompt
+        prompt = "".join(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages)
+        return prompt + ("<|im_start|>assistant\n" if add_generation_prompt else "")
+
+    def encode(self, text: str, add_special_tokens: bool = False) -> list:
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=add_special_tokens, special=False)
+
+    def generate(self, prompt: str, prefix: str = None, timeout: float = None) -> str:
+        return "".join(self.stream(prompt, prefix, timeout)).strip()
+
+    def stream(self, prompt: str, prefix: str = None, timeout: float = None):
+        """Yield text chunks; raises TimeoutError when the engine stays busy or the completion runs past timeout"""
+        deadline = time.monotonic() + timeout if timeout else None
+        with self._stats_lock:
+            self._waiting += 1
+        try:
+            acquired = self._lock.acquire(timeout=timeout if timeout else -1)
+        finally:
+            with self._stats_lock:
+                self._waiting -= 1
+        if not acquired:
+            raise TimeoutError(f"llama.cpp engine busy for more than {timeout}s")
+        started = time.perf_counter()
+        generated = 0
+        completion = None
+        try:
+            completion = self.llm.create_completion(
+                prompt, max_tokens=self.max_tokens, temperature=0.0, repeat_penalty=self.repeat_penalty,
+                stop=["<|im_end|>", "<|endoftext|>"], stream=True,
+            )
+            for chunk in completion:
+                generated += 1  # one chunk per sampled token
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError(f"llama.cpp completion took more than {timeout}s")
+                text = chunk["choices"][0]["text"]
+                if text:
+                    yield text
+        finally:
+            if completion is not None:
+                completion.close()  # stop sampling before the next caller takes the engine
+            self._lock.release()
+            self._count(requests=1, generated_tokens=generated, generate_seconds=time.perf_counter() - started)
+
+    async def agenerate(self, prompt: str, prefix: str = None, timeout: float = None) -> str:
+        return "".join([chunk async for chunk in self.astream(prompt, prefix, timeout)]).strip()
+
+    async def astream(self, prompt: str, prefix: str = None, timeout: float = None):
+        """stream() on one worker thread feeding the event loop; stops generating when the caller goes away"""
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        cancelled = threading.Event()
+
+        def push(item):
+            try:
+                loop.call_soon_threadsafe(chunks.put_nowait, item)
+            except RuntimeError:  # event loop already closed
+                cancelled.set()
+
+        def produce():
+            stream = self.stream(prompt, prefix, timeout)
+            try:
+                for chunk in stream:
+                    if cancelled.is_set():
+                        break
+                    push(chunk)
+                push(None)
+            except Exception as e:
+                push(e)
+            finally:
+                stream.close()  # releases the engine lock right away
+
+        loop.run_in_executor(None, produce)
+        try:
+            while True:
+                chunk = await asyncio.wait_for(chunks.get(), timeout)
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            cancelled.set()
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._waiting = 0
+
+    def queue_depth(self) -> int:
+        return self._waiting
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self.queue_depth()
+        stats["tokens_per_sec"] = round(stats["generated_tokens"] / stats["generate_seconds"], 1) if stats["generate_seconds"] else 0.0
+        stats["generate_seconds"] = round(stats["generate_seconds"], 2)
+        return stats
+
+    def _chat_formatter(self):
+        template = (self.llm.metadata or {}).get("tokenizer.chat_template")
+        if not template or Jinja2ChatFormatter is None:
+            return None
+        try:
+            eos = self.llm.detokenize([self.llm.token_eos()], special=True).decode("utf-8", errors="ignore")
+            bos = self.llm.detokenize([self.llm.token_bos()], special=True).decode("utf-8", errors="ignore")
+            return Jinja2ChatFormatter(template=template, eos_token=eos, bos_token=bos, add_generation_prompt=True)
+        except Exception as e:
+            logger.warning(f"GGUF chat template unusable, falling back to ChatML: {e}")
+            return None
+
+    def _count(self, **deltas):
+        with self._stats_lock:
+            for key, value in deltas.items():
+                self._stats[key] += value
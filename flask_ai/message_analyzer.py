@@ -0,0 +1,263 @@
+# تحليل رسالة العميل بمرور واحد (النية + التفضيلات + معايير البحث)
+"""Single-pass analysis of a customer message.
+
+Intent detection, preference extraction and search criteria all used to
+lower-case the message and run their own keyword scans. ``MessageAnalyzer``
+builds one Aho–Corasick automaton over every keyword list (intents, product
+types, brands, specs, search synonyms and the words that precede a budget or
+price range) and scans the message once. The precompiled budget and price
+regexes only run when the automaton found the word they start with.
+
+Results match the legacy functions exactly, including the order rules: the
+first rule *in list order* wins, not the first keyword in the text.
+"""
+from collections import deque
+import re
+
+from catalog import normalize_token, tokenize
+
+# Synonym groups; each group is also a merged posting list in the catalog index
+SEARCH_SYNONYMS = {
+    "موبايل": ["جوال", "هاتف", "موبايل", "phone", "mobile", "smartphone"],
+    "لابتوب": ["لابتوب", "كمبيوتر", "laptop", "computer", "notebook"],
+    "سماعات": ["سماعات", "سماعة", "headphones", "earbuds", "earphones"],
+    "كاميرا": ["كاميرا", "camera", "تصوير", "photo"],
+    "بطارية": ["بطارية", "battery", "شحن", "charge"],
+    "شاشة": ["شاشة", "screen", "عرض", "display"]
+}
+
+# Filler words that should not become free-text search terms
+SEARCH_STOPWORDS = {normalize_token(w) for w in [
+    "بدي", "ابي", "أبي", "أريد", "محتاج", "ابحث", "أبحث", "عن", "أرني", "عرض", "أظهر", "شو", "وش", "في", "من",
+    "على", "إلى", "مع", "تحت", "أقل", "أكثر", "رخيص", "غالي", "سعر", "ميزانية", "كم", "عندكم", "لو", "سمحت",
+    "i", "me", "a", "an", "the", "for", "of", "to", "with", "and", "or", "show", "find", "search", "want",
+    "need", "under", "less", "more", "than", "cheap", "price", "budget", "please", "some", "any",
+]}
+
+# Explicit/implicit request indicators
+EXPLICIT_INDICATORS = ["ابحث", "أرني", "عرض", "أظهر", "أريد", "بدي", "محتاج", "search", "show", "find", "want", "need"]
+IMPLICIT_INDICATORS = ["موبايل", "جوال", "لابتوب", "سماعات", "هاتف", "phone", "laptop", "headphones"]
+IMPLICIT_REQUEST_INDICATORS = [
+    "بدي", "محتاج", "أريد", "أبحث عن", "أرني", "عرض", "أظهر",
+    "موبايل", "جوال", "لابتوب", "سماعات", "هاتف",
+    "phone", "laptop", "headphones", "mobile"
+]
+
+# Intent rules in priority order; "browse" sits between brands and complaint
+INTENT_RULES = [
+    ("prices", ["ميزانية", "سعر", "كم", "رخيص", "غالي", "price", "cheap", "expensive", "cost"]),
+    ("deals", ["عرض", "عروض", "خصم", "تخفيض", "offer", "deals", "discount", "sale"]),
+    ("categories", ["تصنيف", "تصنيفات", "فئات", "قسم", "category", "categories"]),
+    ("brands", ["ماركة", "ماركات", "براند", "brand", "brands"]),
+    ("browse", []),
+    ("complaint", ["مشكلة", "شكوى", "سيء", "غلط", "مش عاجبني", "complaint", "problem", "bad"]),
+    ("compare", ["قارن", "مقارنة", "فرق", "compare", "comparison", "difference"]),
+]
+PRODUCT_TYPES = [
+    ("phone", ["موبايل", "جوال", "هاتف", "phone", "mobile"]),
+    ("laptop", ["لابتوب", "كمبيوتر", "laptop", "computer"]),
+    ("headphones", ["سماعات", "سماعة", "headphones", "earbuds"]),
+]
+
+# Brands: preferences know fewer brands than search criteria
+PREFERENCE_BRANDS = ["سامسونج", "أبل", "هواوي", "شاومي", "samsung", "apple", "huawei", "xiaomi"]
+SEARCH_BRANDS = PREFERENCE_BRANDS + ["sony", "lg"]
+SPEC_KEYWORDS = [
+    ("camera", ["كاميرا", "camera"]),
+    ("battery", ["بطارية", "battery"]),
+    ("screen", ["شاشة", "screen"]),
+]
+
+# (keyword the pattern starts with, pattern) in priority order
+BUDGET_PATTERNS = [
+    ("ميزانية", r"ميزانية\s*(\d+)"), ("سعر", r"سعر\s*(\d+)"), ("بدي", r"بدي\s*(\d+)"), ("محتاج", r"محتاج\s*(\d+)"),
+    ("budget", r"budget\s*(\d+)"), ("price", r"price\s*(\d+)"), ("under", r"under\s*(\d+)"), ("less", r"less\s*than\s*(\d+)"),
+]
+# (keyword, pattern, kind) in priority order
+PRICE_RANGE_PATTERNS = [
+    ("-", r"(\d+)\s*-\s*(\d+)", "range"),  # range like "100-200"
+    ("تحت", r"تحت\s*(\d+)", "max"), ("under", r"under\s*(\d+)", "max"),  # under X
+    ("أقل", r"أقل\s*من\s*(\d+)", "max"), ("less", r"less\s*than\s*(\d+)", "max"),  # less than X
+    ("أكثر", r"أكثر\s*من\s*(\d+)", "min"), ("more", r"more\s*than\s*(\d+)", "min"),  # more than X
+]
+_BUDGET_NUMBER_RE = re.compile(r"\d{2,6}")
+
+
+class KeywordAutomaton:
+    """Aho–Corasick automaton: the labels of every phrase occurring in a text, in one pass"""
+
+    def __init__(self, phrases: dict):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for phrase, labels in phrases.items():
+            state = 0
+            for ch in phrase:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                    self._goto[state][ch] = nxt
+                state = nxt
+            self._out[state] = tuple(dict.fromkeys(self._out[state] + tuple(labels)))
+        # Breadth-first failure links; each state also reports the phrases ending in its suffixes
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                if state:
+                    fallback = self._fail[state]
+                    while fallback and ch not in self._goto[fallback]:
+                        fallback = self._fail[fallback]
+                    self._fail[nxt] = self._goto[fallback].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def labels(self, text: str) -> set:
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class MessageAnalysis:
+    __slots__ = ("intent", "preferences", "user_preferences", "criteria", "implicit_request")
+
+    def __init__(self, intent: str, preferences: dict, user_preferences: dict, criteria: dict, implicit_request: bool):
+        self.intent = intent
+        self.preferences = preferences  # detect_sales_intent's focus / budget / product_type / request_type
+        self.user_preferences = user_preferences  # extract_preferences' budget / brand / specs
+        self.criteria = criteria  # extract_search_criteria's result
+        self.implicit_request = implicit_request
+
+
+class MessageAnalyzer:
+    def __init__(self, synonyms: dict = None, stopwords: set = None):
+        self.synonyms = {main: list(words) for main, words in (synonyms or SEARCH_SYNONYMS).items()}
+        self.stopwords = set(SEARCH_STOPWORDS if stopwords is None else stopwords)
+        self.synonym_tokens = {normalize_token(w) for words in self.synonyms.values() for w in words}
+        self.budget_patterns = [(kw, re.compile(p)) for kw, p in BUDGET_PATTERNS]
+        self.price_range_patterns = [(kw, re.compile(p), kind) for kw, p, kind in PRICE_RANGE_PATTERNS]
+
+        phrases = {}
+
+        def add(words, label):
+            for word in words:
+                phrases.setdefault(word, []).append(label)
+
+        add(EXPLICIT_INDICATORS, ("explicit",))
+        add(IMPLICIT_INDICATORS, ("implicit",))
+        add(IMPLICIT_REQUEST_INDICATORS, ("implicit_request",))
+        for intent, words in INTENT_RULES:
+            add(words, ("intent", intent))
+        for product_type, words in PRODUCT_TYPES:
+            add(words, ("product_type", product_type))
+        for brand in SEARCH_BRANDS:
+            add([brand], ("brand", brand))
+        for spec, words in SPEC_KEYWORDS:
+            add(words, ("spec", spec))
+        for main, words in self.synonyms.items():
+            add(words, ("concept", main))
+        for i, (keyword, _) in enumerate(BUDGET_PATTERNS):
+            add([keyword], ("budget", i))
+        for i, (keyword, _, _) in enumerate(PRICE_RANGE_PATTERNS):
+            add([keyword], ("price_range", i))
+        self.automaton = KeywordAutomaton(phrases)
+
+    def analyze(self, message: str) -> MessageAnalysis:
+        m = message.strip().lower()
+        found = self.automaton.labels(m)
+        is_explicit = ("explicit",) in found
+        is_implicit = ("implicit",) in found
+        return MessageAnalysis(
+            *self._intent(m, found, is_explicit, is_implicit),
+            self._user_preferences(m, found),
+            self._criteria(m, found),
+            ("implicit_request",) in found,
+        )
+
+    def _intent(self, m: str, found: set, is_explicit: bool, is_implicit: bool) -> tuple:
+        intent = "info"
+        preferences = {}
+        for rule, _ in INTENT_RULES:
+            if rule == "browse":
+                if is_implicit or is_explicit:
+                    intent, preferences["focus"] = "browse", "product"
+                    for product_type, _ in PRODUCT_TYPES:
+                        if ("product_type", product_type) in found:
+                            preferences["product_type"] = product_type
+                            break
+                    break
+            elif ("intent", rule) in found:
+                intent = rule
+                if rule == "prices":
+                    preferences["focus"] = "price"
+                    number = _BUDGET_NUMBER_RE.search(m)
+                    if number:
+                        preferences["budget"] = int(number.group(0))
+                elif rule == "deals":
+                    preferences["focus"] = "discount"
+                break
+        preferences["request_type"] = "explicit" if is_explicit else "implicit" if is_implicit else "general"
+        return intent, preferences
+
+    def _user_preferences(self, m: str, found: set) -> dict:
+        preferences = {}
+        for i, (_, pattern) in enumerate(self.budget_patterns):
+            if ("budget", i) in found:
+                match = pattern.search(m)
+                if match:
+                    preferences["budget"] = int(match.group(1))
+                    break
+        for brand in PREFERENCE_BRANDS:
+            if ("brand", brand) in found:
+                preferences["brand"] = brand
+                break
+        specs = [spec for spec, _ in SPEC_KEYWORDS if ("spec", spec) in found]
+        if specs:
+            preferences["specs"] = specs
+        return preferences
+
+    def _criteria(self, m: str, found: set) -> dict:
+        criteria = {
+            "keywords": [],
+            "concepts": [],
+            "terms": [],
+            "price_range": None,
+            "brand": None,
+            "category": None,
+            "specs": []
+        }
+        for main, words in self.synonyms.items():
+            if ("concept", main) in found:
+                criteria["keywords"].extend(words)
+                criteria["concepts"].append(main)
+        # Remaining free-text words are looked up in the catalog vocabulary
+        criteria["terms"] = [
+            t for t in dict.fromkeys(tokenize(m))
+            if len(t) > 1 and t not in self.stopwords and t not in self.synonym_tokens
+        ]
+        for i, (_, pattern, kind) in enumerate(self.price_range_patterns):
+            if ("price_range", i) in found:
+                match = pattern.search(m)
+                if match:
+                    if kind == "max":
+                        criteria["price_range"] = {"max": int(match.group(1))}
+                    elif kind == "min":
+                        criteria["price_range"] = {"min": int(match.group(1))}
+                    else:
+                        criteria["price_range"] = {"min": int(match.group(1)), "max": int(match.group(2))}
+                    break
+        for brand in SEARCH_BRANDS:
+            if ("brand", brand) in found:
+                criteria["brand"] = brand
+                break
+        return criteria
@@ -0,0 +1,170 @@
+# قياس زمن الطلبات ومراحلها وعرضها بصيغة Prometheus
+"""Request latency instrumentation and Prometheus text exposition.
+
+``Metrics`` keeps fixed-bucket histograms: one per endpoint for whole
+requests and one per stage (language detection, catalog snapshot, message
+analysis, search, cache lookup, tokenization, queue wait, generation, reply
+composition). Recording a sample is a bisect and three additions under a lock,
+about a microsecond, so spans can stay on every request.
+
+``render()`` writes the Prometheus text format (version 0.0.4): cumulative
+``_bucket`` / ``_sum`` / ``_count`` series, p50/p95/p99 per endpoint estimated
+from the buckets the way ``histogram_quantile`` does, and the gauges and
+counters collected at scrape time (cache hits, tokens/sec, queue depth).
+Metrics are per process; under gunicorn each worker reports its own.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+# Upper bounds in seconds; stages are mostly sub-millisecond, generation takes seconds
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Linear interpolation inside the bucket holding the q-th sample (as histogram_quantile)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                if i == len(self.buckets):
+                    return self.buckets[-1]  # beyond the last bound
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Metrics:
+    def __init__(self, namespace: str = "zuhall_ai", buckets: tuple = DEFAULT_BUCKETS):
+        self.namespace = namespace
+        self.buckets = buckets
+        self._requests = {}  # endpoint -> Histogram
+        self._statuses = {}  # (endpoint, status) -> count
+        self._stages = {}  # stage -> Histogram
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def observe_request(self, endpoint: str, status: int, seconds: float):
+        with self._lock:
+            histogram = self._requests.get(endpoint)
+            if histogram is None:
+                histogram = self._requests[endpoint] = Histogram(self.buckets)
+            histogram.observe(seconds)
+            key = (endpoint, int(status))
+            self._statuses[key] = self._statuses.get(key, 0) + 1
+
+    def observe_stage(self, stage: str, seconds: float):
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, stage: str):
+        """Time a block into the stage histogram (also when it raises)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - started)
+
+    def add_collector(self, collect):
+        """collect() -> [(name, type, help, [(labels dict, value), ...])], evaluated at scrape time"""
+        self._collectors.append(collect)
+
+    def summary(self) -> dict:
+        """p50/p95/p99 in milliseconds per endpoint and stage (for the health endpoint)"""
+        with self._lock:
+            groups = {"endpoints": dict(self._requests), "stages": dict(self._stages)}
+            return {
+                group: {
+                    name: {"count": h.count, **{f"p{int(q * 100)}_ms": round(h.quantile(q) * 1000, 2) for q in QUANTILES}}
+                    for name, h in histograms.items()
+                }
+                for group, histograms in groups.items()
+            }
+
+    def render(self) -> str:
+        ns = self.namespace
+        lines = []
+        with self._lock:
+            self._render_histograms(lines, f"{ns}_request_duration_seconds", "Request latency per endpoint", "endpoint", self._requests)
+            self._render_quantiles(lines, f"{ns}_request_duration_quantile_seconds", self._requests)
+            lines.append(f"# HELP {ns}_requests_total Requests per endpoint and status")
+            lines.append(f"# TYPE {ns}_requests_total counter")
+            for (endpoint, status), count in sorted(self._statuses.items()):
+                lines.append(f'{ns}_requests_total{{endpoint="{_label(endpoint)}",status="{status}"}} {count}')
+            self._render_histograms(lines, f"{ns}_stage_duration_seconds", "Latency per request stage", "stage", self._stages)
+        for collect in self._collectors:
+            try:
+                families = collect()
+            except Exception as e:
+                lines.append(f"# collector failed: {_label(str(e))}")
+                continue
+            for name, kind, help_text, samples in families:
+                lines.append(f"# HELP {ns}_{name} {help_text}")
+                lines.append(f"# TYPE {ns}_{name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{ns}_{name}{_labels(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+    def _render_histograms(self, lines: list, name: str, help_text: str, label: str, histograms: dict):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for key, h in sorted(histograms.items()):
+            base = f'{label}="{_label(key)}"'
+            cumulative = 0
+            for bound, n in zip(h.buckets, h.counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{{{base},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{base},le="+Inf"}} {h.count}')
+            lines.append(f"{name}_sum{{{base}}} {_number(h.total)}")
+            lines.append(f"{name}_count{{{base}}} {h.count}")
+
+    def _render_quantiles(self, lines: list, name: str, histograms: dict):
+        lines.append(f"# HELP {name} Request latency quantiles estimated from the histogram buckets")
+        lines.append(f"# TYPE {name} gauge")
+        for key, h in sorted(histograms.items()):
+            for q in QUANTILES:
+                lines.append(f'{name}{{endpoint="{_label(key)}",quantile="{q}"}} {_number(h.quantile(q))}')
+
+
+def _label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_label(v)}"' for k, v in labels.items()) + "}"
+
+
+def _number(value) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(round(float(value), 6))
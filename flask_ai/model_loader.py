@@ -0,0 +1,134 @@
+# تحميل نموذج التوليد في الخلفية مع حالات الجاهزية
+"""Background loading of the generation model.
+
+Loading a multi-GB checkpoint used to block the import of ``server.py``, so
+nothing (not even health or search) was served until it finished. The loader
+walks the candidate models on its own thread and reports a state:
+
+* ``loading``: still trying candidates (chat answers with templated replies)
+* ``ready``: the preferred (first) candidate is loaded
+* ``degraded``: only a fallback candidate could be loaded
+* ``failed``: no candidate loaded; chat stays templated
+
+``on_loaded`` runs on the loader thread before the state flips, so anything it
+sets up (scheduler, caches, warmup) is in place by the time callers see
+``ready``. ``StartupTimer`` logs how long each startup phase took, to track
+cold-start regressions.
+"""
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+IDLE, LOADING, READY, DEGRADED, FAILED = "idle", "loading", "ready", "degraded", "failed"
+
+
+class ModelLoader:
+    def __init__(self, candidates: list, load_candidate, on_loaded=None):
+        self.candidates = list(dict.fromkeys(c for c in candidates if c))  # keep order, drop duplicates
+        self.load_candidate = load_candidate  # model id -> (tokenizer, model)
+        self.on_loaded = on_loaded  # (model id, tokenizer, model) -> None
+        self.state = IDLE
+        self.model_name = None
+        self._attempts = []
+        self._started_at = None
+        self._seconds = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.state in (READY, DEGRADED)
+
+    def start(self, background: bool = True):
+        """Begin loading once; background=False loads on the calling thread"""
+        with self._lock:
+            if self.state != IDLE:
+                return
+            self.state = LOADING
+            self._started_at = time.perf_counter()
+        if background:
+            threading.Thread(target=self._load, name='model-loader', daemon=True).start()
+        else:
+            self._load()
+
+    def wait(self, timeout: float = None) -> bool:
+        """Block until loading finished (ready, degraded or failed); True when a model is usable"""
+        self._done.wait(timeout)
+        return self.ready
+
+    def after_fork(self):
+        """In a forked worker: a load still running in the parent's thread is restarted here"""
+        self._lock = threading.Lock()
+        if self.state == LOADING:
+            logger.warning("Model was still loading when the worker forked; loading it again in this worker")
+            self.state = IDLE
+            self._done = threading.Event()
+            self.start(background=True)
+
+    def status(self) -> dict:
+        elapsed = self._seconds
+        if elapsed is None and self._started_at is not None:
+            elapsed = time.perf_counter() - self._started_at
+        return {
+            "state": self.state,
+            "model": self.model_name,
+            "candidates": self.candidates,
+            "attempts": list(self._attempts),
+            "seconds": round(elapsed, 1) if elapsed is not None else None,
+        }
+
+    def _load(self):
+        try:
+            for position, name in enumerate(self.candidates):
+                started = time.perf_counter()
+                try:
+                    tokenizer, model = self.load_candidate(name)
+                    if self.on_loaded:
+                        self.on_loaded(name, tokenizer, model)
+                except Exception as e:
+                    logger.warning(f"Failed to load model {name}: {e}")
+                    self._attempts.append({"model": name, "error": str(e), "seconds": round(time.perf_counter() - started, 1)})
+                    continue
+                self._attempts.append({"model": name, "error": None, "seconds": round(time.perf_counter() - started, 1)})
+                self.model_name = name
+                self.state = READY if position == 0 else DEGRADED
+                logger.info(f"Model loaded successfully: {name} ({self.state})")
+                return
+            self.state = FAILED
+            logger.error(f"All candidate models failed to load: {self._attempts[-1]['error'] if self._attempts else 'no candidates'}")
+        finally:
+            self._seconds = time.perf_counter() - self._started_at
+            self._done.set()
+
+
+class StartupTimer:
+    """Durations of named startup phases, logged as each one finishes"""
+
+    def __init__(self):
+        self._origin = time.perf_counter()
+        self._phases = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, time.perf_counter() - started)
+
+    def mark(self, name: str):
+        """Record the time from process start-up (timer creation) to now"""
+        self._record(name, time.perf_counter() - self._origin)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return dict(self._phases)
+
+    def _record(self, name: str, seconds: float):
+        with self._lock:
+            self._phases[name] = round(seconds, 3)
+        logger.info(f"Startup phase {name}: {seconds:.2f}s")
@@ -0,0 +1,182 @@
+# تجميع نص المحادثة للنموذج ضمن ميزانية رموز ثابتة
+"""Token-budgeted assembly of the sales chat user turn.
+
+The user turn used to inline 10 categories, 10 brands, 10 sample products
+and up to 6 history messages however long they were, so prefill size varied
+with the catalog and the conversation. ``PromptAssembler`` builds it from
+measured segments:
+
+* the shop header (categories, brands, generic product samples) is built once
+  per catalog version and cut to ``header_budget`` tokens (at most half of
+  ``budget``); it is identical for
+  every request on that snapshot, so its KV cache stays reusable
+* the rest of ``budget`` goes, in order, to the customer message, the
+  retrieved product candidates and the most recent history lines; whatever
+  does not fit is dropped
+
+Token counts of header segments and product lines are cached, so a request
+only tokenizes its own message and history.
+"""
+from collections import OrderedDict
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+UNAVAILABLE = "غير متاح"
+
+
+class PromptSegment:
+    __slots__ = ("text", "token_ids")
+
+    def __init__(self, text: str, token_ids: tuple):
+        self.text = text
+        self.token_ids = token_ids
+
+    @property
+    def tokens(self) -> int:
+        return len(self.token_ids)
+
+
+class PromptAssembler:
+    def __init__(self, encode, budget: int = 1024, header_budget: int = 384, max_candidates: int = 8,
+                 max_history: int = 6, max_headers: int = 4, max_lines: int = 4096):
+        self.encode = encode  # text -> token ids (no special tokens)
+        self.budget = budget
+        self.header_budget = min(header_budget, budget // 2)  # the rest is kept for the request
+        self.max_candidates = max_candidates
+        self.max_history = max_history
+        self.max_headers = max(1, max_headers)
+        self.max_lines = max(0, max_lines)
+        self._headers = OrderedDict()  # catalog version -> PromptSegment
+        self._lines = OrderedDict()  # product line -> token count
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "prompt_tokens": 0, "dropped_candidates": 0, "dropped_history": 0, "truncated_messages": 0}
+
+    def set_encoder(self, encode):
+        """Switch tokenizers (e.g. once the model loaded); cached counts are dropped"""
+        with self._lock:
+            self.encode = encode
+            self._headers.clear()
+            self._lines.clear()
+
+    def header(self, ctx: dict, catalog_version: str, price_text) -> PromptSegment:
+        """Shop header for a catalog snapshot, tokenized once and kept within header_budget"""
+        with self._lock:
+            segment = self._headers.get(catalog_version)
+            if segment is not None:
+                self._headers.move_to_end(catalog_version)
+                return segment
+        segment = self._build_header(ctx, price_text)
+        with self._lock:
+            self._headers[catalog_version] = segment
+            while len(self._headers) > self.max_headers:
+                self._headers.popitem(last=False)
+        return segment
+
+    def user_turn(self, header: PromptSegment, message: str, candidates: list = None, history: list = None,
+                  price_text=None) -> str:
+        """header + candidate products + recent history + message, within the token budget"""
+        remaining = self.budget - header.tokens
+        has_history = bool(history)
+        message_line = f"رسالة العميل الحالية: {message}" if has_history else f"رسالة العميل: {message}"
+        message_tokens = self._count(message_line)
+        if message_tokens > remaining:
+            message_line, message_tokens = self._truncate(message_line, max(remaining, 0))
+            self._count_stat(truncated_messages=1)
+        remaining -= message_tokens
+
+        sample_titles = {line for line in header.text.splitlines() if line.startswith("- ")}
+        product_lines = []
+        candidates = (candidates or [])[:self.max_candidates]
+        heading = self._count("منتجات مطابقة لطلب العميل:\n\n") if candidates else 0
+        for p in candidates:
+            line = f"- {p.get('title', '')} | السعر: {price_text(p)}"
+            if line in sample_titles:
+                continue
+            tokens = self._line_tokens(line) + (0 if product_lines else heading)
+            if tokens > remaining:
+                self._count_stat(dropped_candidates=1)
+                continue
+            product_lines.append(line)
+            remaining -= tokens
+
+        history_lines = []
+        heading = self._count("الرسائل السابقة (مختصر):\n\n") if has_history else 0
+        for line in reversed((history or [])[-self.max_history:]):  # newest first
+            tokens = self._count(line + "\n") + (0 if history_lines else heading)
+            if tokens > remaining:
+                self._count_stat(dropped_history=1)
+                break
+            history_lines.insert(0, line)
+            remaining -= tokens
+
+        parts = [header.text]
+        if product_lines:
+            parts.append("منتجات مطابقة لطلب العميل:\n" + "\n".join(product_lines) + "\n\n")
+        if history_lines:
+            parts.append("الرسائل السابقة (مختصر):\n" + "\n".join(history_lines) + "\n\n")
+        parts.append(message_line)
+        self._count_stat(requests=1, prompt_tokens=self.budget - remaining)
+        return "".join(parts)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cached_headers"] = len(self._headers)
+            stats["cached_lines"] = len(self._lines)
+        stats["avg_prompt_tokens"] = round(stats["prompt_tokens"] / stats["requests"], 1) if stats["requests"] else 0.0
+        stats["budget"] = self.budget
+        return stats
+
+    def _build_header(self, ctx: dict, price_text) -> PromptSegment:
+        cat_list = ", ".join([c.get('name', '') for c in ctx.get("categories", [])[:10]]) or UNAVAILABLE
+        brand_list = ", ".join([b.get('name', '') for b in ctx.get("brands", [])[:10]]) or UNAVAILABLE
+        head = f"سياق المتجر:\nالتصنيفات: {cat_list}\nالماركات: {brand_list}\nعينات منتجات:\n"
+        prod_lines = []
+        used = self._count(head + UNAVAILABLE + "\n\n")
+        for p in ctx.get("products", [])[:10]:
+            line = f"- {p.get('title', '')} | السعر: {price_text(p)}"
+            tokens = self._line_tokens(line)
+            if used + tokens > self.header_budget:
+                break
+            prod_lines.append(line)
+            used += tokens
+        text = head + ("\n".join(prod_lines) or UNAVAILABLE) + "\n\n"
+        if used > self.header_budget:  # categories/brands alone are over budget
+            text, _ = self._truncate(text, self.header_budget)
+            text += "\n\n"
+        return PromptSegment(text, tuple(self.encode(text)))
+
+    def _line_tokens(self, line: str) -> int:
+        """Token count of a product line plus its newline, cached across requests"""
+        with self._lock:
+            tokens = self._lines.get(line)
+            if tokens is not None:
+                self._lines.move_to_end(line)
+                return tokens
+        tokens = self._count(line + "\n")
+        if self.max_lines:
+            with self._lock:
+                self._lines[line] = tokens
+                while len(self._lines) > self.max_lines:
+                    self._lines.popitem(last=False)
+        return tokens
+
+    def _count(self, text: str) -> int:
+        return len(self.encode(text))
+
+    def _truncate(self, text: str, budget: int) -> tuple:
+        """Longest prefix of text (cut at a character) within budget tokens"""
+        if budget <= 0:
+            return "", 0
+        tokens = self._count(text)
+        while tokens > budget and text:
+            text = text[:max(1, int(len(text) * budget / tokens)) - 1] if len(text) > 1 else ""
+            tokens = self._count(text)
+        return text, tokens
+
+    def _count_stat(self, **deltas):
+        with self._lock:
+            for key, value in deltas.items():
+                self._stats[key] += value
@@ -0,0 +1,136 @@
+# كاش الردود (ذاكرة العملية + Redis)
+"""Two-tier cache for generated replies.
+
+Keys are content hashes over everything that determines a reply (model,
+system prompt, user turn, generation config and catalog version), so they are
+identical across workers and restarts and change as soon as any input does.
+Lookups hit a per-process LRU first and fall back to the shared Redis; Redis
+hits are copied into the LRU. If Redis is unreachable it is skipped for
+``redis_retry_after`` seconds instead of paying a failed round trip per request.
+``aget`` / ``aset`` do the same with an asyncio Redis client (ASGI mode).
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def content_key(namespace: str, **parts) -> str:
+    """Stable key: sha256 over the canonical JSON of the parts"""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return f"{namespace}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+
+class ResponseCache:
+    def __init__(self, redis_client=None, max_entries: int = 1024, ttl: int = 7200, redis_retry_after: float = 30):
+        self.redis = redis_client
+        self.max_entries = max(0, max_entries)
+        self.ttl = ttl
+        self.redis_retry_after = redis_retry_after
+        self._local = OrderedDict()  # key -> (expires_at, text)
+        self._lock = threading.Lock()
+        self._redis_down_until = 0.0
+        self._counters = {"local_hits": 0, "redis_hits": 0, "misses": 0, "sets": 0, "redis_errors": 0}
+
+    def get(self, key: str):
+        text = self._get_local(key)
+        if text is not None:
+            return text
+        cached = None
+        if self._redis_available():
+            try:
+                cached = self.redis.get(key)
+            except Exception as e:
+                self._redis_failed(f"get failed: {e}")
+        return self._remote_result(key, cached)
+
+    async def aget(self, key: str, client):
+        """get() with an asyncio Redis client for the shared tier"""
+        text = self._get_local(key)
+        if text is not None:
+            return text
+        cached = None
+        if self._redis_available(client):
+            try:
+                cached = await client.get(key)
+            except Exception as e:
+                self._redis_failed(f"get failed: {e}")
+        return self._remote_result(key, cached)
+
+    def set(self, key: str, text: str):
+        if not text:
+            return
+        self._store_local(key, text)
+        with self._lock:
+            self._counters["sets"] += 1
+        if self._redis_available():
+            try:
+                self.redis.setex(key, self.ttl, text)
+            except Exception as e:
+                self._redis_failed(f"set failed: {e}")
+
+    async def aset(self, key: str, text: str, client):
+        if not text:
+            return
+        self._store_local(key, text)
+        with self._lock:
+            self._counters["sets"] += 1
+        if self._redis_available(client):
+            try:
+                await client.setex(key, self.ttl, text)
+            except Exception as e:
+                self._redis_failed(f"set failed: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters)
+            stats["local_entries"] = len(self._local)
+        lookups = stats["local_hits"] + stats["redis_hits"] + stats["misses"]
+        stats["hit_ratio"] = round((stats["local_hits"] + stats["redis_hits"]) / lookups, 3) if lookups else 0.0
+        stats["redis_available"] = self._redis_available()
+        return stats
+
+    def _get_local(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._local.move_to_end(key)
+                    self._counters["local_hits"] += 1
+                    return entry[1]
+                del self._local[key]
+        return None
+
+    def _remote_result(self, key: str, cached):
+        """Count a Redis lookup (bytes or None) and copy hits into the LRU"""
+        with self._lock:
+            if not cached:
+                self._counters["misses"] += 1
+                return None
+            self._counters["redis_hits"] += 1
+        text = cached.decode('utf-8')
+        self._store_local(key, text)
+        return text
+
+    def _store_local(self, key: str, text: str):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._local[key] = (time.time() + self.ttl, text)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+
+    def _redis_available(self, client=None) -> bool:
+        return (client or self.redis) is not None and time.time() >= self._redis_down_until
+
+    def _redis_failed(self, message: str):
+        with self._lock:
+            self._counters["redis_errors"] += 1
+            self._redis_down_until = time.time() + self.redis_retry_after
+        logger.warning(f"Response cache Redis {message}; using in-process cache for {self.redis_retry_after:.0f}s")
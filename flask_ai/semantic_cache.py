@@ -0,0 +1,135 @@
+# كاش دلالي للردود (رسائل متقاربة المعنى)
+"""Semantic reply cache.
+
+Near-duplicate customer messages ("بدي موبايل رخيص" / "ابي جوال رخيص") should
+not each cost a full ``generate``. Messages are normalized and embedded with a
+small CPU encoder (mean-pooled ``AutoModel`` hidden states, L2-normalized);
+replies are stored in a fixed-size in-memory matrix and a lookup is a single
+matrix-vector product. A hit needs cosine similarity above ``threshold`` and
+the same scope (system prompt + catalog version), so replies never leak across
+languages or outlive the catalog they were written against.
+"""
+from collections import OrderedDict
+import logging
+import re
+import threading
+import time
+
+import numpy as np
+import torch
+from transformers import AutoModel, AutoTokenizer
+
+from catalog import normalize_text
+
+logger = logging.getLogger(__name__)
+
+_PUNCT_RE = re.compile(r"[^\w\s]+")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_message(text: str) -> str:
+    """Normalized form used for embedding (Arabic letter forms, punctuation, spacing)"""
+    return _SPACE_RE.sub(" ", _PUNCT_RE.sub(" ", normalize_text(text))).strip()
+
+
+class TextEmbedder:
+    """Sentence embeddings from a small encoder, memoized per normalized text (also used by vector search)"""
+
+    def __init__(self, model_name: str, max_length: int = 64, memo_size: int = 2048):
+        self.model_name = model_name
+        self.max_length = max_length
+        self.memo_size = memo_size
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name).eval()
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def embed(self, text: str) -> np.ndarray:
+        with self._lock:
+            vector = self._memo.get(text)
+            if vector is not None:
+                self._memo.move_to_end(text)
+                return vector
+        vector = self.embed_batch([text])[0]
+        with self._lock:
+            self._memo[text] = vector
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return vector
+
+    def embed_batch(self, texts: list, batch_size: int = 32) -> np.ndarray:
+        """(len(texts), dim) float32 matrix of unit vectors, without memoization"""
+        chunks = []
+        for start in range(0, len(texts), batch_size):
+            inputs = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=True,
+                                    max_length=self.max_length, return_tensors="pt")
+            with torch.inference_mode():
+                hidden = self.model(**inputs).last_hidden_state
+            mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+            chunks.append(torch.nn.functional.normalize(pooled, dim=-1).float().numpy())
+        return np.concatenate(chunks) if chunks else np.zeros((0, self.dim), dtype=np.float32)
+
+    @property
+    def dim(self) -> int:
+        return int(self.model.config.hidden_size)
+
+
+class SemanticCache:
+    def __init__(self, embedder: TextEmbedder, threshold: float = 0.92, max_entries: int = 2048):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries = max(1, max_entries)
+        self._vectors = None  # (max_entries, dim) float32, allocated on first insert
+        self._scopes = [None] * self.max_entries
+        self._texts = [None] * self.max_entries
+        self._size = 0
+        self._next = 0  # ring buffer: the oldest entry is overwritten first
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "sets": 0}
+        self._lookup_seconds = 0.0
+
+    def lookup(self, message: str, scope: str):
+        """(reply, similarity) for the closest cached message in scope, or (None, best similarity)"""
+        started = time.perf_counter()
+        query = self.embedder.embed(normalize_message(message))
+        reply, best = None, 0.0
+        with self._lock:
+            if self._size:
+                sims = self._vectors[:self._size] @ query
+                best = float(sims.max())
+                # Closest few candidates only; another scope's twin may outrank ours
+                for row in np.argsort(sims)[::-1][:8]:
+                    if sims[row] < self.threshold:
+                        break
+                    if self._scopes[row] == scope:
+                        reply, best = self._texts[row], float(sims[row])
+                        break
+            self._counters["hits" if reply is not None else "misses"] += 1
+            self._lookup_seconds += time.perf_counter() - started
+        return reply, best
+
+    def store(self, message: str, scope: str, reply: str):
+        if not reply:
+            return
+        vector = self.embedder.embed(normalize_message(message))
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+            row = self._next
+            self._vectors[row] = vector
+            self._scopes[row] = scope
+            self._texts[row] = reply
+            self._next = (row + 1) % self.max_entries
+            self._size = min(self._size + 1, self.max_entries)
+            self._counters["sets"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters, entries=self._size, threshold=self.threshold)
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_ratio"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+            stats["avg_lookup_ms"] = round(self._lookup_seconds / lookups * 1000, 2) if lookups else 0.0
+        return stats
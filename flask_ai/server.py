@@ -1,42 +1,108 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from transformers import BitsAndBytesConfig
 import torch
 import json
+import numpy as np
 import os
 import logging
 import redis
-from langdetect import detect
-import requests
 from datetime import datetime
 import re
+import shutil
+import threading
 import time
-from urllib.parse import urlparse
+from urllib.parse import quote, urlparse
+from catalog import CatalogIndex, effective_price, normalize_text, normalize_token, ref_key
+from catalog_refresher import CatalogRefresher
+from conversation_store import ConversationContext, LocalContextStore, RedisContextStore
+from http_client import PooledHttpClient
+from inference import BatchScheduler
+from language import detect_language, warm as warm_language_detection
+from llama_engine import LlamaCppEngine
+from message_analyzer import SEARCH_STOPWORDS, SEARCH_SYNONYMS, MessageAnalyzer
+from metrics import Metrics
+from model_loader import ModelLoader, StartupTimer
+from prompt_builder import PromptAssembler
+from response_cache import ResponseCache, content_key
+from semantic_cache import SemanticCache, TextEmbedder
+from similar_index import SimilarityBuilder, similarity_scores
+from vector_index import ProductVectors
 
 # إعداد التسجيل
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# توقيت مراحل الإقلاع (لتتبع أي تراجع في زمن التشغيل البارد)
+STARTUP = StartupTimer()
+
+# زمن الطلبات ومراحلها (Prometheus على /api/ai/metrics)
+METRICS = Metrics()
+
 app = Flask(__name__)
-CORS(app, origins=['http://localhost:3000', 'http://localhost:3001', 'https://www.zuhall.com', 'https://zuhall.com'])
+CORS_ORIGINS = ['http://localhost:3000', 'http://localhost:3001', 'https://www.zuhall.com', 'https://zuhall.com']
+CORS(app, origins=CORS_ORIGINS)
+
+@app.before_request
+def _start_request_timer():
+    request.environ['zuhall.started'] = time.perf_counter()
+
+@app.after_request
+def _record_request_time(response):
+    started = request.environ.get('zuhall.started')
+    if started is not None:
+        # Streaming responses are timed to their first byte
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        METRICS.observe_request(endpoint, response.status_code, time.perf_counter() - started)
+    return response
 
 # إعداد Redis للتخزين المؤقت (آمن مع منفذ افتراضي 6379)
+REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
 REDIS_PORT = int(os.getenv('REDIS_PORT', '6379'))
 try:
-    cache = redis.Redis(host=os.getenv('REDIS_HOST', 'localhost'), port=REDIS_PORT, db=0)
+    cache = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
 except Exception as e:
     logger.warning(f"Redis init failed: {e}")
     cache = None
 
+# كاش الردود: ذاكرة العملية أولاً ثم Redis المشترك بين العمال
+RESPONSE_CACHE = ResponseCache(
+    cache,
+    max_entries=int(os.getenv('RESPONSE_CACHE_SIZE', '1024')),
+    ttl=int(os.getenv('RESPONSE_CACHE_TTL', '7200')),  # تخزين لمدة ساعتين
+)
+
+# سياق المحادثات: ذاكرة العملية (LRU + TTL) أو Redis المشترك بين العمال
+CONTEXT_TTL = int(os.getenv('CONTEXT_TTL', '1800'))  # تنتهي الجلسة بعد 30 دقيقة من آخر رسالة
+CONTEXT_MAX_SESSIONS = int(os.getenv('CONTEXT_MAX_SESSIONS', '10000'))  # حد الجلسات داخل العملية
+_local_contexts = LocalContextStore(max_sessions=CONTEXT_MAX_SESSIONS, ttl=CONTEXT_TTL)
+if os.getenv('CONTEXT_STORE', 'memory').lower() == 'redis' and cache is not None:
+    CONTEXT_STORE = RedisContextStore(cache, ttl=CONTEXT_TTL, fallback=_local_contexts)
+else:
+    CONTEXT_STORE = _local_contexts
+
 # إعدادات النموذج وAPI
 DEFAULT_MODEL = os.getenv('AI_MODEL', 'Qwen/Qwen2.5-14B-Instruct')  # نموذج قوي لأداء خارق
 ZUHALL_BASE = os.getenv('ZUHALL_BASE', 'https://www.zuhall.com')
 
-# كاش للمتجر داخل العملية لتقليل نداءات الشبكة
-SHOP_CACHE = None
-SHOP_CACHE_TS = 0.0
+# كاش للمتجر داخل العملية لتقليل نداءات الشبكة (يتحدث في الخلفية)
 SHOP_CACHE_TTL = int(os.getenv('SHOP_CACHE_TTL', '60'))
+CATALOG_PAGE_SIZE = int(os.getenv('CATALOG_PAGE_SIZE', '100'))  # Node API caps limit at 100
+CATALOG_MAX_PAGES = int(os.getenv('CATALOG_MAX_PAGES', '500'))
+CATALOG_FULL_REFRESH_EVERY = int(os.getenv('CATALOG_FULL_REFRESH_EVERY', '10'))  # full reload every N refreshes (catches deletions)
+CATALOG_INITIAL_WAIT = float(os.getenv('CATALOG_INITIAL_WAIT', '15'))
+
+# عميل HTTP مشترك (keep-alive + إعادة محاولة) لنداءات Node API
+HTTP = PooledHttpClient(
+    pool_size=int(os.getenv('HTTP_POOL_SIZE', '16')),
+    max_retries=int(os.getenv('HTTP_MAX_RETRIES', '2')),
+    timeout=float(os.getenv('HTTP_TIMEOUT', '5')),
+    max_workers=int(os.getenv('HTTP_FETCH_WORKERS', '8')),
+)
+
+# مقارنة المنتجات: حد أقصى لسلة المقارنة (المفقود من الكتالوج يُجلب من API)
+MAX_COMPARE_PRODUCTS = int(os.getenv('MAX_COMPARE_PRODUCTS', '50'))
 
 # فحص توفر مكتبة bitsandbytes للاستخدام 4-بت
 try:
@@ -45,58 +111,274 @@ try:
 except Exception:
     HAS_BNB = False
 
-# تحميل النموذج مع سلال فشل ذكية + 4-بت اختياري على GPU
-def load_model():
+# محرك التوليد: transformers (افتراضي) أو llama_cpp لملف GGUF من MODEL_PATH
+INFERENCE_ENGINE = os.getenv('INFERENCE_ENGINE', 'transformers').lower()
+CPU_QUANTIZE = os.getenv('CPU_QUANTIZE', '').lower()  # int8 = تكميم ديناميكي لطبقات Linear على CPU
+
+# فك تشفير تخميني: نموذج مسودة صغير بنفس المُرمّز (فارغ = معطل)
+SPECULATIVE_DRAFT_MODEL = os.getenv('SPECULATIVE_DRAFT_MODEL', '').strip()
+SPECULATIVE_DRAFT_TOKENS = int(os.getenv('SPECULATIVE_DRAFT_TOKENS', '5'))
+
+# خيوط PyTorch على CPU (0 = الافتراضي)
+TORCH_NUM_THREADS = int(os.getenv('TORCH_NUM_THREADS', '0'))  # intra-op
+TORCH_INTEROP_THREADS = int(os.getenv('TORCH_INTEROP_THREADS', '0'))  # inter-op
+if TORCH_NUM_THREADS > 0:
+    torch.set_num_threads(TORCH_NUM_THREADS)
+if TORCH_INTEROP_THREADS > 0:
     try:
-        use_gpu = torch.cuda.is_available()
-        device_map = 'auto' if use_gpu else 'cpu'
-        dtype = torch.float16 if use_gpu else torch.float32
-        quantization_config = BitsAndBytesConfig(load_in_4bit=True) if (use_gpu and HAS_BNB) else None
-
-        candidates = []
-        env_model = os.getenv('AI_MODEL')
-        if env_model:
-            candidates.append(env_model)
-        if use_gpu:
-            candidates += [
-                'Qwen/Qwen2.5-14B-Instruct',
-                'Qwen/Qwen2.5-7B-Instruct',
-                'Qwen/Qwen2.5-3B-Instruct',
-                'Qwen/Qwen2.5-1.5B-Instruct',
-            ]
-        else:
-            candidates += [
-                os.getenv('AI_MODEL_CPU', 'Qwen/Qwen2.5-1.5B-Instruct'),
-                'Qwen/Qwen2.5-0.5B-Instruct',
-            ]
+        torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
+    except RuntimeError as e:  # only allowed before the first inter-op parallel work
+        logger.warning(f"Could not set inter-op threads: {e}")
+
+# مرشحات النموذج بالترتيب (الأول هو المفضل) + 4-بت اختياري على GPU
+def model_candidates() -> list:
+    if INFERENCE_ENGINE == 'llama_cpp':
+        return [os.getenv('MODEL_PATH', '')]
+    candidates = []
+    env_model = os.getenv('AI_MODEL')
+    if env_model:
+        candidates.append(env_model)
+    if torch.cuda.is_available():
+        candidates += [
+            'Qwen/Qwen2.5-14B-Instruct',
+            'Qwen/Qwen2.5-7B-Instruct',
+            'Qwen/Qwen2.5-3B-Instruct',
+            'Qwen/Qwen2.5-1.5B-Instruct',
+        ]
+    else:
+        candidates += [
+            os.getenv('AI_MODEL_CPU', 'Qwen/Qwen2.5-1.5B-Instruct'),
+            'Qwen/Qwen2.5-0.5B-Instruct',
+        ]
+    return candidates
 
-        last_err = None
-        for mid in candidates:
-            try:
-                logger.info(f"Loading model: {mid} on {device_map} (4-bit={'on' if quantization_config else 'off'})")
-                tok = AutoTokenizer.from_pretrained(mid, use_fast=True)
-                mdl = AutoModelForCausalLM.from_pretrained(
-                    mid,
-                    device_map=device_map,
-                    torch_dtype=dtype,
-                    quantization_config=quantization_config,
-                    low_cpu_mem_usage=True,
-                )
-                mdl.eval()
-                logger.info(f"Model loaded successfully: {mid}")
-                return tok, mdl
-            except Exception as e:
-                last_err = e
-                logger.warning(f"Failed to load model {mid}: {e}")
-                continue
-        logger.error(f"All candidate models failed to load: {last_err}")
-        return None, None
+# نسخة محلية من النموذج بصيغة safetensors (تُقرأ بـ mmap عند الإقلاع بدون تحويل الأوزان)
+MODEL_ARTIFACT_DIR = os.getenv('MODEL_ARTIFACT_DIR', '')  # فارغ = تعطيل
+MODEL_WARMUP_TOKENS = int(os.getenv('MODEL_WARMUP_TOKENS', '8'))  # 0 = بدون تسخين
+MODEL_WARMUP_PROMPT = os.getenv('MODEL_WARMUP_PROMPT', 'مرحبا')
+
+def _artifact_path(mid: str) -> str:
+    return os.path.join(MODEL_ARTIFACT_DIR, re.sub(r"[^\w.-]+", "_", mid.strip("/")))
+
+def save_model_artifact(mid: str, tok, mdl):
+    """Write tokenizer + weights (already in the serving dtype) as safetensors; the directory appears atomically"""
+    path = _artifact_path(mid)
+    tmp = f"{path}.tmp"
+    try:
+        shutil.rmtree(tmp, ignore_errors=True)
+        tok.save_pretrained(tmp)
+        mdl.save_pretrained(tmp, safe_serialization=True)
+        os.replace(tmp, path)
+        logger.info(f"Saved model artifact for {mid} to {path}")
+    except Exception as e:
+        shutil.rmtree(tmp, ignore_errors=True)
+        logger.warning(f"Could not save model artifact for {mid}: {e}")
+
+def load_candidate(mid: str) -> tuple:
+    """(tokenizer, model) for one candidate; raises when it cannot be loaded"""
+    if INFERENCE_ENGINE == 'llama_cpp':
+        logger.info(f"Loading GGUF model with llama.cpp: {mid}")
+        with STARTUP.phase(f"model_load:{mid}"):
+            engine = LlamaCppEngine(
+                mid,
+                n_ctx=int(os.getenv('N_CTX', '4096')),
+                n_threads=int(os.getenv('N_THREADS', '0')) or None,
+                n_gpu_layers=int(os.getenv('N_GPU_LAYERS', '0')),
+                generation_kwargs=GENERATION_KWARGS,
+            )
+        return engine, engine  # the engine also renders the chat template
+    use_gpu = torch.cuda.is_available()
+    device_map = 'auto' if use_gpu else 'cpu'
+    dtype = torch.float16 if use_gpu else torch.float32
+    quantization_config = BitsAndBytesConfig(load_in_4bit=True) if (use_gpu and HAS_BNB) else None
+    artifact = _artifact_path(mid) if MODEL_ARTIFACT_DIR else None
+    if artifact and os.path.isfile(os.path.join(artifact, 'config.json')):
+        logger.info(f"Loading model: {mid} from local artifact {artifact} on {device_map}")
+        with STARTUP.phase(f"model_load:{mid}"):
+            tok = AutoTokenizer.from_pretrained(artifact, use_fast=True, local_files_only=True)
+            mdl = AutoModelForCausalLM.from_pretrained(
+                artifact,
+                device_map=device_map,
+                torch_dtype=dtype,
+                low_cpu_mem_usage=True,
+                use_safetensors=True,
+                local_files_only=True,
+            )
+        mdl.eval()
+    else:
+        logger.info(f"Loading model: {mid} on {device_map} (4-bit={'on' if quantization_config else 'off'})")
+        with STARTUP.phase(f"model_load:{mid}"):
+            tok = AutoTokenizer.from_pretrained(mid, use_fast=True)
+            mdl = AutoModelForCausalLM.from_pretrained(
+                mid,
+                device_map=device_map,
+                torch_dtype=dtype,
+                quantization_config=quantization_config,
+                low_cpu_mem_usage=True,
+            )
+        mdl.eval()
+        if artifact:
+            with STARTUP.phase("artifact_save"):
+                save_model_artifact(mid, tok, mdl)
+    if CPU_QUANTIZE == 'int8' and not use_gpu:
+        # Artifacts keep float weights; int8 Linear layers are rebuilt at load time (takes seconds)
+        with STARTUP.phase("quantize_int8"):
+            mdl = torch.ao.quantization.quantize_dynamic(mdl, {torch.nn.Linear}, dtype=torch.qint8)
+        logger.info(f"Applied dynamic int8 quantization to {mid}")
+    return tok, mdl
+
+def warmup_model(tok, mdl):
+    """One short generate so the first real request does not pay one-off setup costs"""
+    if MODEL_WARMUP_TOKENS <= 0 or INFERENCE_ENGINE == 'llama_cpp':  # llama.cpp warms up while loading
+        return
+    try:
+        with STARTUP.phase("model_warmup"):
+            messages = [{"role": "user", "content": MODEL_WARMUP_PROMPT}]
+            prompt = tok.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            inputs = tok(prompt, return_tensors="pt").to(mdl.device)
+            with torch.inference_mode():
+                mdl.generate(**inputs, max_new_tokens=MODEL_WARMUP_TOKENS, do_sample=False, pad_token_id=tok.eos_token_id)
     except Exception as e:
-        logger.error(f"Failed to load model: {e}")
-        return None, None
+        logger.warning(f"Model warmup failed: {e}")
+
+# تحميل ملفات لغات langdetect عند الإقلاع بدل أول رسالة مختلطة
+with STARTUP.phase("langdetect_warmup"):
+    warm_language_detection()
+
+# النموذج يُحمّل في الخلفية: البحث والصحة يعملان فوراً والشات يرد بقوالب جاهزة حتى يجهز
+tokenizer, model = None, None
+MODEL_NAME = "None"
+
+# عامل توليد واحد يجمع الطلبات المتزامنة في دفعات
+GENERATION_KWARGS = {
+    "max_new_tokens": int(os.getenv('GEN_MAX_NEW_TOKENS', '60')),  # قصير لسرعة وذكاء
+    "do_sample": False,
+    "repetition_penalty": 1.2,
+    "pad_token_id": None,  # set from the tokenizer once the model is loaded
+    "eos_token_id": None,
+}
+GEN_TIMEOUT = float(os.getenv('GEN_TIMEOUT', '120'))
+INFERENCE = None
+
+def _prompt_token_ids(text: str) -> list:
+    if tokenizer is None:  # model still loading: ~4 bytes per token
+        return [0] * (len(text.encode('utf-8')) // 4 + 1)
+    return tokenizer.encode(text, add_special_tokens=False)
+
+# ميزانية رموز رسالة المستخدم (الرأس الثابت + المنتجات المطابقة + التاريخ + الرسالة)
+PROMPT_ASSEMBLER = PromptAssembler(
+    _prompt_token_ids,
+    budget=int(os.getenv('PROMPT_TOKEN_BUDGET', '1024')),
+    header_budget=int(os.getenv('PROMPT_HEADER_TOKENS', '384')),
+    max_candidates=int(os.getenv('PROMPT_MAX_CANDIDATES', '8')),
+    max_history=int(os.getenv('PROMPT_HISTORY_LINES', '6')),
+)
+
+def load_draft_model(target_name: str):
+    """Small draft model for assisted decoding, or None when disabled or unusable"""
+    if not SPECULATIVE_DRAFT_MODEL or INFERENCE_ENGINE == 'llama_cpp':
+        return None
+    if SPECULATIVE_DRAFT_MODEL == target_name:
+        logger.warning(f"Draft model {SPECULATIVE_DRAFT_MODEL} is the loaded model itself; speculative decoding disabled")
+        return None
+    try:
+        draft = load_candidate(SPECULATIVE_DRAFT_MODEL)[1]
+        draft.generation_config.num_assistant_tokens = SPECULATIVE_DRAFT_TOKENS
+        logger.info(f"Speculative decoding enabled with draft {SPECULATIVE_DRAFT_MODEL} ({SPECULATIVE_DRAFT_TOKENS} tokens per round)")
+        return draft
+    except Exception as e:
+        logger.warning(f"Failed to load draft model {SPECULATIVE_DRAFT_MODEL}, generating without it: {e}")
+        return None
 
-tokenizer, model = load_model()
-MODEL_NAME = DEFAULT_MODEL if model else "None"
+def _on_model_loaded(name: str, tok, mdl):
+    """Wire a loaded model into generation (runs on the loader thread before it reports ready)"""
+    global tokenizer, model, MODEL_NAME, INFERENCE, SEMANTIC_CACHE
+    warmup_model(tok, mdl)
+    if INFERENCE_ENGINE == 'llama_cpp':
+        scheduler = mdl
+    else:
+        GENERATION_KWARGS.update(pad_token_id=tok.eos_token_id, eos_token_id=tok.eos_token_id)
+        scheduler = BatchScheduler(
+            mdl,
+            tok,
+            max_batch_size=int(os.getenv('GEN_MAX_BATCH_SIZE', '8')),
+            max_wait_ms=float(os.getenv('GEN_MAX_WAIT_MS', '10')),
+            pad_ratio=float(os.getenv('GEN_PAD_RATIO', '1.3')),
+            generation_kwargs=GENERATION_KWARGS,
+            prefix_cache_size=int(os.getenv('GEN_PREFIX_CACHE_SIZE', '4')),  # 0 يعطل إعادة استخدام KV للبادئة الثابتة
+            assistant_model=load_draft_model(name),  # يفرض دفعة من طلب واحد
+            observe=METRICS.observe_stage,
+        )
+    semantic = load_semantic_cache()
+    tokenizer, model, MODEL_NAME, INFERENCE, SEMANTIC_CACHE = tok, mdl, name, scheduler, semantic
+    PROMPT_ASSEMBLER.set_encoder(_prompt_token_ids)  # re-measure cached segments with the real tokenizer
+    STARTUP.mark("model_ready")
+
+MODEL_LOADER = ModelLoader(model_candidates(), load_candidate, _on_model_loaded)
+
+# نموذج التضمين الصغير (مشترك بين الكاش الدلالي والبحث المتجهي)
+DEFAULT_EMBEDDING_MODEL = 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'
+_TEXT_EMBEDDERS = {}
+_TEXT_EMBEDDERS_LOCK = threading.Lock()
+
+def load_text_embedder(model_name: str) -> TextEmbedder:
+    """One shared embedder per model, also when the model loader thread and requests ask at the same time"""
+    embedder = _TEXT_EMBEDDERS.get(model_name)
+    if embedder is None:
+        with _TEXT_EMBEDDERS_LOCK:
+            embedder = _TEXT_EMBEDDERS.get(model_name)
+            if embedder is None:
+                embedder = _TEXT_EMBEDDERS[model_name] = TextEmbedder(model_name)
+    return embedder
+
+# كاش دلالي: رسائل متقاربة المعنى تعيد نفس الرد بدون توليد
+def load_semantic_cache():
+    if os.getenv('SEMANTIC_CACHE', '0') != '1':
+        return None
+    model_name = os.getenv('SEMANTIC_CACHE_MODEL', DEFAULT_EMBEDDING_MODEL)
+    try:
+        semantic = SemanticCache(
+            load_text_embedder(model_name),
+            threshold=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.92')),
+            max_entries=int(os.getenv('SEMANTIC_CACHE_SIZE', '2048')),
+        )
+        logger.info(f"Semantic cache enabled with {model_name}")
+        return semantic
+    except Exception as e:
+        logger.warning(f"Semantic cache disabled, failed to load {model_name}: {e}")
+        return None
+
+SEMANTIC_CACHE = None  # created with the model (only generated replies are cached)
+
+# MODEL_BACKGROUND_LOAD=0 يحمّل النموذج قبل استقبال الطلبات (السلوك القديم)
+MODEL_LOADER.start(background=os.getenv('MODEL_BACKGROUND_LOAD', '1') == '1')
+
+# البحث المتجهي: تضمين المنتجات مرة لكل نسخة كتالوج (محفوظ على القرص)
+SEARCH_MODE = os.getenv('SEARCH_MODE', 'hybrid')  # lexical | vector | hybrid
+VECTOR_SEARCH_WEIGHT = float(os.getenv('VECTOR_SEARCH_WEIGHT', '0.5'))  # share of the vector score in hybrid mode
+VECTOR_MIN_SIMILARITY = float(os.getenv('VECTOR_MIN_SIMILARITY', '0.35'))
+VECTOR_CANDIDATES = int(os.getenv('VECTOR_CANDIDATES', '200'))
+
+def load_product_vectors():
+    if os.getenv('VECTOR_SEARCH', '0') != '1':
+        return None
+    model_name = os.getenv('VECTOR_SEARCH_MODEL', DEFAULT_EMBEDDING_MODEL)
+    cache_dir = os.getenv('VECTOR_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vector_cache'))
+    try:
+        vectors = ProductVectors(load_text_embedder(model_name), cache_dir)
+        logger.info(f"Vector search enabled with {model_name} (cache: {cache_dir})")
+        return vectors
+    except Exception as e:
+        logger.warning(f"Vector search disabled, failed to load {model_name}: {e}")
+        return None
+
+PRODUCT_VECTORS = load_product_vectors()
+
+# جدول المنتجات المشابهة: يُحسب في الخلفية مع كل نسخة كتالوج
+SIMILAR_PRODUCTS = SimilarityBuilder(
+    top_n=int(os.getenv('SIMILAR_TOP_N', '10')),
+    exact_limit=int(os.getenv('SIMILAR_EXACT_LIMIT', '20000')),  # larger catalogs use category/brand/LSH candidates
+)
 
 # Enhanced System Prompt for intelligent sales assistant
 ZUHALL_SALES_SYSTEM_PROMPT = """
@@ -163,425 +445,187 @@ You: "Sorry, nothing at that price. But here are close alternatives:\n1) Product
 """
 
 # جلب سياق المتجر
-def _fetch_shop_safe(url: str):
-    try:
-        r = requests.get(url, timeout=5)
-        r.raise_for_status()
-        return r.json()
-    except Exception as e:
-        logger.error(f"Failed to fetch {url}: {e}")
-        return None
+def _build_catalog_index(products: list, categories: list, brands: list) -> CatalogIndex:
+    index = CatalogIndex(products, categories, brands, SEARCH_SYNONYMS)
+    if PRODUCT_VECTORS:
+        PRODUCT_VECTORS.attach(index)
+    SIMILAR_PRODUCTS.attach(index)
+    return index
+
+CATALOG = CatalogRefresher(
+    ZUHALL_BASE,
+    _build_catalog_index,
+    HTTP,
+    interval=SHOP_CACHE_TTL,
+    full_every=CATALOG_FULL_REFRESH_EVERY,
+    page_size=CATALOG_PAGE_SIZE,
+    max_pages=CATALOG_MAX_PAGES,
+    initial_wait=CATALOG_INITIAL_WAIT,
+)
 
 def get_shop_context_zuhall():
-    global SHOP_CACHE, SHOP_CACHE_TS
-    now = time.time()
-    if SHOP_CACHE and (now - SHOP_CACHE_TS) < SHOP_CACHE_TTL:
-        return SHOP_CACHE
-    products = _fetch_shop_safe(f"{ZUHALL_BASE}/api/v1/products?limit=50")
-    categories = _fetch_shop_safe(f"{ZUHALL_BASE}/api/v1/categories?limit=100")
-    brands = _fetch_shop_safe(f"{ZUHALL_BASE}/api/v1/brands?limit=100")
-    data = {
-        "products": products.get("data", []) if isinstance(products, dict) else [],
-        "categories": categories.get("data", []) if isinstance(categories, dict) else [],
-        "brands": brands.get("data", []) if isinstance(brands, dict) else [],
-    }
-    SHOP_CACHE, SHOP_CACHE_TS = data, now
-    return data
+    """Current catalog snapshot; refreshed by a background thread, never blocks after startup"""
+    return CATALOG.snapshot()
+
+def _catalog_index(ctx: dict) -> CatalogIndex:
+    """Index attached to a shop context (built on the fly for ad-hoc contexts)"""
+    index = ctx.get("index")
+    if index is None:
+        index = ctx["index"] = _build_catalog_index(ctx.get("products", []), ctx.get("categories", []), ctx.get("brands", []))
+    return index
+
+# Message analysis: intent, preferences and search criteria from one keyword scan
+MESSAGE_ANALYZER = MessageAnalyzer(SEARCH_SYNONYMS, SEARCH_STOPWORDS)
 
 # Enhanced intent detection with implicit/explicit request detection
 def detect_sales_intent(message: str) -> tuple[str, dict]:
-    m = message.strip().lower()
-    intent = "info"
-    preferences = {}
-    
-    # Explicit request indicators
-    explicit_indicators = ["ابحث", "أرني", "عرض", "أظهر", "أريد", "بدي", "محتاج", "search", "show", "find", "want", "need"]
-    implicit_indicators = ["موبايل", "جوال", "لابتوب", "سماعات", "هاتف", "phone", "laptop", "headphones"]
-    
-    # Check for explicit requests
-    is_explicit = any(indicator in m for indicator in explicit_indicators)
-    is_implicit = any(indicator in m for indicator in implicit_indicators)
-    
-    # Price-related intent
-    if any(w in m for w in ["ميزانية", "سعر", "كم", "رخيص", "غالي", "price", "cheap", "expensive", "cost"]):
-        intent, preferences["focus"] = "prices", "price"
-        nums = re.findall(r"\d{2,6}", m)
-        if nums:
-            try:
-                preferences["budget"] = int(nums[0])
-            except Exception:
-                pass
-    # Deals and offers
-    elif any(w in m for w in ["عرض", "عروض", "خصم", "تخفيض", "offer", "deals", "discount", "sale"]):
-        intent, preferences["focus"] = "deals", "discount"
-    # Categories
-    elif any(w in m for w in ["تصنيف", "تصنيفات", "فئات", "قسم", "category", "categories"]):
-        intent = "categories"
-    # Brands
-    elif any(w in m for w in ["ماركة", "ماركات", "براند", "brand", "brands"]):
-        intent = "brands"
-    # Product browsing (implicit or explicit)
-    elif is_implicit or is_explicit:
-        intent, preferences["focus"] = "browse", "product"
-        # Extract product type
-        if any(w in m for w in ["موبايل", "جوال", "هاتف", "phone", "mobile"]):
-            preferences["product_type"] = "phone"
-        elif any(w in m for w in ["لابتوب", "كمبيوتر", "laptop", "computer"]):
-            preferences["product_type"] = "laptop"
-        elif any(w in m for w in ["سماعات", "سماعة", "headphones", "earbuds"]):
-            preferences["product_type"] = "headphones"
-    # Complaints
-    elif any(w in m for w in ["مشكلة", "شكوى", "سيء", "غلط", "مش عاجبني", "complaint", "problem", "bad"]):
-        intent = "complaint"
-    # Comparison requests
-    elif any(w in m for w in ["قارن", "مقارنة", "فرق", "compare", "comparison", "difference"]):
-        intent = "compare"
-    
-    # Set request type
-    preferences["request_type"] = "explicit" if is_explicit else "implicit" if is_implicit else "general"
-    
-    return intent, preferences
+    analysis = MESSAGE_ANALYZER.analyze(message)
+    return analysis.intent, analysis.preferences
 
 # Check if message is an implicit product request
 def is_implicit_product_request(message: str) -> bool:
-    m = message.strip().lower()
-    implicit_indicators = [
-        "بدي", "محتاج", "أريد", "أبحث عن", "أرني", "عرض", "أظهر",
-        "موبايل", "جوال", "لابتوب", "سماعات", "هاتف",
-        "phone", "laptop", "headphones", "mobile"
-    ]
-    return any(indicator in m for indicator in implicit_indicators)
+    return MESSAGE_ANALYZER.analyze(message).implicit_request
 
 # Extract user preferences from message
 def extract_preferences(message: str) -> dict:
-    m = message.strip().lower()
-    preferences = {}
-    
-    # Extract budget
-    budget_patterns = [
-        r"ميزانية\s*(\d+)", r"سعر\s*(\d+)", r"بدي\s*(\d+)", r"محتاج\s*(\d+)",
-        r"budget\s*(\d+)", r"price\s*(\d+)", r"under\s*(\d+)", r"less\s*than\s*(\d+)"
-    ]
-    for pattern in budget_patterns:
-        match = re.search(pattern, m)
-        if match:
-            preferences["budget"] = int(match.group(1))
-            break
-    
-    # Extract brand preferences
-    brand_indicators = ["سامسونج", "أبل", "هواوي", "شاومي", "samsung", "apple", "huawei", "xiaomi"]
-    for brand in brand_indicators:
-        if brand in m:
-            preferences["brand"] = brand
-            break
-    
-    # Extract product specifications
-    if "كاميرا" in m or "camera" in m:
-        preferences["specs"] = preferences.get("specs", []) + ["camera"]
-    if "بطارية" in m or "battery" in m:
-        preferences["specs"] = preferences.get("specs", []) + ["battery"]
-    if "شاشة" in m or "screen" in m:
-        preferences["specs"] = preferences.get("specs", []) + ["screen"]
-    
-    return preferences
+    return MESSAGE_ANALYZER.analyze(message).user_preferences
 
 # Advanced intelligent search engine
 def extract_search_criteria(message: str) -> dict:
     """Extract search criteria from user message using NLP"""
-    m = message.lower()
-    criteria = {
-        "keywords": [],
-        "price_range": None,
-        "brand": None,
-        "category": None,
-        "specs": []
-    }
-    
-    # Extract keywords with synonyms
-    synonyms = {
-        "موبايل": ["جوال", "هاتف", "موبايل", "phone", "mobile", "smartphone"],
-        "لابتوب": ["لابتوب", "كمبيوتر", "laptop", "computer", "notebook"],
-        "سماعات": ["سماعات", "سماعة", "headphones", "earbuds", "earphones"],
-        "كاميرا": ["كاميرا", "camera", "تصوير", "photo"],
-        "بطارية": ["بطارية", "battery", "شحن", "charge"],
-        "شاشة": ["شاشة", "screen", "عرض", "display"]
-    }
-    
-    for main_word, word_list in synonyms.items():
-        if any(word in m for word in word_list):
-            criteria["keywords"].extend(word_list)
-    
-    # Extract price range
-    price_patterns = [
-        r"(\d+)\s*-\s*(\d+)",  # range like "100-200"
-        r"تحت\s*(\d+)", r"under\s*(\d+)",  # under X
-        r"أقل\s*من\s*(\d+)", r"less\s*than\s*(\d+)",  # less than X
-        r"أكثر\s*من\s*(\d+)", r"more\s*than\s*(\d+)"  # more than X
-    ]
-    
-    for pattern in price_patterns:
-        match = re.search(pattern, m)
-        if match:
-            if "تحت" in pattern or "under" in pattern or "أقل" in pattern or "less" in pattern:
-                criteria["price_range"] = {"max": int(match.group(1))}
-            elif "أكثر" in pattern or "more" in pattern:
-                criteria["price_range"] = {"min": int(match.group(1))}
-            else:
-                criteria["price_range"] = {"min": int(match.group(1)), "max": int(match.group(2))}
-            break
-    
-    # Extract brand
-    brand_indicators = ["سامسونج", "أبل", "هواوي", "شاومي", "samsung", "apple", "huawei", "xiaomi", "sony", "lg"]
-    for brand in brand_indicators:
-        if brand in m:
-            criteria["brand"] = brand
-            break
-    
-    return criteria
-
-def smart_product_search(message: str, ctx: dict) -> list:
-    """Advanced semantic search with NLP"""
-    criteria = extract_search_criteria(message)
-    products = ctx.get("products", [])
-    
-    if not products:
+    return MESSAGE_ANALYZER.analyze(message).criteria
+
+def _blend_text_scores(lexical: np.ndarray, vector: dict, weight: float) -> np.ndarray:
+    """Mix BM25 and cosine scores; similarities are scaled to the best BM25 score (or 10 without lexical hits)"""
+    best = lexical.max() if len(lexical) else 0.0
+    scale = best if best > 0 else 10.0
+    blended = (1 - weight) * lexical
+    rows = np.fromiter(vector.keys(), dtype=np.int64, count=len(vector))
+    blended[rows] += weight * scale * np.fromiter(vector.values(), dtype=np.float64, count=len(vector))
+    return blended
+
+def smart_product_search(message: str, ctx: dict, mode: str = None, criteria: dict = None) -> list:
+    """Advanced semantic search with NLP (mode: lexical, vector or hybrid)"""
+    criteria = criteria or extract_search_criteria(message)
+    index = _catalog_index(ctx)
+    mode = mode or SEARCH_MODE
+    
+    if not len(index):
         return []
+    # Filter by keywords through the inverted index (BM25 scores double as the filter)
+    text_scores = index.text.score(criteria["concepts"] + [{t} for t in criteria["terms"]])
     
-    # Filter by keywords (semantic search)
-    if criteria["keywords"]:
-        filtered_products = []
-        for product in products:
-            title = product.get("title", "").lower()
-            description = product.get("description", "").lower()
-            
-            # Check if any keyword matches title or description
-            for keyword in criteria["keywords"]:
-                if keyword in title or keyword in description:
-                    filtered_products.append(product)
-                    break
-        
-        if filtered_products:
-            products = filtered_products
+    # Dialect/misspelled queries: nearest products by embedding (lexical only until vectors are built)
+    if mode in ("vector", "hybrid") and PRODUCT_VECTORS:
+        try:
+            vector_scores = PRODUCT_VECTORS.scores(index, message, VECTOR_CANDIDATES, VECTOR_MIN_SIMILARITY)
+        except Exception as e:
+            logger.warning(f"Vector search failed, using lexical scores: {e}")
+            vector_scores = {}
+        if vector_scores:
+            lexical = text_scores if mode == "hybrid" else np.zeros(len(index))
+            text_scores = _blend_text_scores(lexical, vector_scores, VECTOR_SEARCH_WEIGHT if lexical.any() else 1.0)
+    matched = np.flatnonzero(text_scores)
+    rows = matched if len(matched) else np.arange(len(index))
     
     # Filter by price range
     if criteria["price_range"]:
-        price_filtered = []
-        for product in products:
-            price = product.get("priceAfterDiscount") or product.get("price", 0)
-            if not price:
-                continue
-                
-            if criteria["price_range"].get("min") and price < criteria["price_range"]["min"]:
-                continue
-            if criteria["price_range"].get("max") and price > criteria["price_range"]["max"]:
-                continue
-                
-            price_filtered.append(product)
-        
-        if price_filtered:
-            products = price_filtered
-    
-    # Filter by brand
+        prices = index.effective_prices[rows]
+        low = criteria["price_range"].get("min")
+        high = criteria["price_range"].get("max")
+        keep = prices > 0
+        if low:
+            keep &= prices >= low
+        if high:
+            keep &= prices <= high
+        if keep.any():
+            rows = rows[keep]
+    
+    # Filter by brand (title token or the product's brand reference)
     if criteria["brand"]:
-        brand_filtered = []
-        for product in products:
-            title = product.get("title", "").lower()
-            if criteria["brand"].lower() in title:
-                brand_filtered.append(product)
-        
-        if brand_filtered:
-            products = brand_filtered
+        brand = normalize_token(criteria["brand"])
+        brand_rows = index.text.rows_with({brand})
+        brand_codes = [code for key, code in index.brand_codes.items() if brand in normalize_text(key)]
+        keep = brand_rows[rows] | np.isin(index.brand_ids[rows], brand_codes)
+        if keep.any():
+            rows = rows[keep]
     
     # Rank by relevance
-    return rank_products_by_relevance(products, criteria)
+    return rank_products_by_relevance(index, rows, criteria, text_scores)
 
-def rank_products_by_relevance(products: list, criteria: dict) -> list:
-    """Rank products by relevance to search criteria"""
-    if not products:
+def rank_products_by_relevance(index: CatalogIndex, rows, criteria: dict, text_scores: np.ndarray = None, limit: int = 10) -> list:
+    """Rank catalog rows by BM25 text relevance, budget fit and popularity"""
+    rows = np.asarray(rows, dtype=np.int64)
+    if not len(rows):
         return []
     
-    # Score each product
-    scored_products = []
-    for product in products:
-        score = 0
-        title = product.get("title", "").lower()
-        description = product.get("description", "").lower()
-        
-        # Keyword matching score
-        for keyword in criteria.get("keywords", []):
-            if keyword in title:
-                score += 3  # Title match is more important
-            elif keyword in description:
-                score += 1  # Description match
-        
-        # Price relevance (closer to budget is better)
-        if criteria.get("price_range"):
-            price = product.get("priceAfterDiscount") or product.get("price", 0)
-            if price:
-                if criteria["price_range"].get("min") and criteria["price_range"].get("max"):
-                    target_price = (criteria["price_range"]["min"] + criteria["price_range"]["max"]) / 2
-                    score += max(0, 2 - abs(price - target_price) / target_price)
-        
-        # Popularity score (sold quantity and ratings)
-        sold = product.get("sold", 0)
-        ratings = product.get("ratingsAverage", 0)
-        score += min(2, sold / 10)  # Cap at 2 points
-        score += ratings * 0.4  # Ratings contribute to score
-        
-        scored_products.append((product, score))
+    price_range = criteria.get("price_range") or {}
+    target_price = None
+    if price_range.get("min") and price_range.get("max"):
+        target_price = (price_range["min"] + price_range["max"]) / 2
+    
+    # Text relevance (dense BM25 / blended scores over the catalog)
+    scores = text_scores[rows] if text_scores is not None else np.zeros(len(rows))
+    
+    # Price relevance (closer to budget is better)
+    if target_price:
+        prices = index.effective_prices[rows]
+        scores += np.where(prices > 0, np.maximum(0, 2 - np.abs(prices - target_price) / target_price), 0)
     
-    # Sort by score (descending) and return top products
-    scored_products.sort(key=lambda x: x[1], reverse=True)
-    return [p[0] for p in scored_products[:10]]
+    # Popularity score: sales (capped at 2 points) + ratings
+    scores += index.sales_score[rows]
+    scores += index.ratings[rows] * 0.4
+    
+    return index.take(index.top_k(scores, limit, rows))
 
 def find_similar_products(target_product: dict, ctx: dict, limit: int = 5) -> list:
     """Find products similar to the target product"""
     if not target_product:
         return []
     
-    products = ctx.get("products", [])
-    if not products:
+    index = _catalog_index(ctx)
+    if not len(index):
         return []
     
-    # Get target product attributes
-    target_title = target_product.get("title", "").lower()
-    target_price = target_product.get("priceAfterDiscount") or target_product.get("price", 0)
-    target_category = target_product.get("category", {})
-    target_brand = target_product.get("brand", {})
-    
-    similar_products = []
-    
-    for product in products:
-        if product.get("_id") == target_product.get("_id"):
-            continue  # Skip the same product
-        
-        score = 0
-        title = product.get("title", "").lower()
-        price = product.get("priceAfterDiscount") or product.get("price", 0)
-        
-        # Category similarity
-        if target_category and product.get("category"):
-            if str(target_category.get("_id")) == str(product.get("category", {}).get("_id")):
-                score += 3
-        
-        # Brand similarity
-        if target_brand and product.get("brand"):
-            if str(target_brand.get("_id")) == str(product.get("brand", {}).get("_id")):
-                score += 2
-        
-        # Price similarity (±20%)
-        if target_price and price:
-            price_diff = abs(price - target_price) / target_price
-            if price_diff <= 0.2:
-                score += 2
-        
-        # Title keyword similarity
-        target_words = set(target_title.split())
-        product_words = set(title.split())
-        common_words = target_words.intersection(product_words)
-        if common_words:
-            score += len(common_words)
-        
-        if score > 0:
-            similar_products.append((product, score))
+    # Catalog products: precomputed neighbor table (O(1) once built for this snapshot)
+    target_id = str(target_product.get("_id"))
+    target_row = index.row_of(target_id)
+    if target_row is not None and index.similar is not None and limit <= index.similar.top_n:
+        return index.take(index.similar.similar(target_row, limit))
+    
+    # Otherwise score the whole catalog: category (+3), brand (+2), price ±20% (+2), shared title words
+    if target_row is not None:
+        scores = similarity_scores(
+            index, index.category_ids[target_row], index.brand_ids[target_row],
+            index.effective_prices[target_row], index.title_tokens[target_row],
+        )
+        scores[target_row] = 0  # Skip the same product
+    else:
+        scores = similarity_scores(
+            index,
+            index.category_codes.get(ref_key(target_product.get("category")), -1),
+            index.brand_codes.get(ref_key(target_product.get("brand")), -1),
+            effective_price(target_product),
+            frozenset((target_product.get("title") or "").lower().split()),
+        )
     
     # Sort by similarity score and return top results
-    similar_products.sort(key=lambda x: x[1], reverse=True)
-    return [p[0] for p in similar_products[:limit]]
+    candidates = np.flatnonzero(scores > 0)
+    return index.take(index.top_k(scores[candidates], limit, candidates))
 
 # Legacy function for backward compatibility
 def filter_products_by_query(message: str, ctx: dict) -> list:
     """Legacy function - now uses smart search"""
     return smart_product_search(message, ctx)
 
-# Conversation Context Management System
-class ConversationContext:
-    def __init__(self):
-        self.user_preferences = {}
-        self.last_products = []
-        self.last_categories = []
-        self.last_brands = []
-        self.conversation_history = []
-        self.current_budget = None
-        self.favorite_brands = []
-        self.product_interest = []
-    
-    def update_context(self, message: str, intent: str, preferences: dict, products: list = None):
-        """Update conversation context with new information"""
-        # Update user preferences
-        if preferences.get("budget"):
-            self.current_budget = preferences["budget"]
-        if preferences.get("brand"):
-            if preferences["brand"] not in self.favorite_brands:
-                self.favorite_brands.append(preferences["brand"])
-        if preferences.get("product_type"):
-            if preferences["product_type"] not in self.product_interest:
-                self.product_interest.append(preferences["product_type"])
-        
-        # Update last viewed items
-        if products:
-            self.last_products = products[:5]  # Keep last 5 products
-        if intent == "categories":
-            self.last_categories = preferences.get("categories", [])
-        if intent == "brands":
-            self.last_brands = preferences.get("brands", [])
-        
-        # Add to conversation history
-        self.conversation_history.append({
-            "message": message,
-            "intent": intent,
-            "timestamp": datetime.now().isoformat()
-        })
-        
-        # Keep only last 10 interactions
-        if len(self.conversation_history) > 10:
-            self.conversation_history = self.conversation_history[-10:]
-    
-    def get_context_info(self) -> dict:
-        """Get current context information"""
-        return {
-            "user_preferences": self.user_preferences,
-            "last_products": self.last_products,
-            "current_budget": self.current_budget,
-            "favorite_brands": self.favorite_brands,
-            "product_interest": self.product_interest,
-            "recent_intents": [h["intent"] for h in self.conversation_history[-3:]]
-        }
-    
-    def resolve_context_references(self, message: str) -> str:
-        """Resolve context references in user message"""
-        m = message.lower()
-        
-        # Handle "شو رأيك فيه؟" (what do you think about it?)
-        if "شو رأيك" in m or "what do you think" in m:
-            if self.last_products:
-                return f"شو رأيك في {self.last_products[0].get('title', 'هذا المنتج')}؟"
-        
-        # Handle "أرني غيره" (show me others)
-        if "أرني غيره" in m or "show me others" in m:
-            if self.last_products:
-                return f"أرني منتجات مشابهة لـ {self.last_products[0].get('title', 'هذا المنتج')}"
-        
-        # Handle "نفس السعر" (same price)
-        if "نفس السعر" in m or "same price" in m:
-            if self.current_budget:
-                return f"أرني منتجات بنفس السعر {self.current_budget}$"
-        
-        return message
-
-# Global context storage (in production, use Redis or database)
-CONVERSATION_CONTEXTS = {}
-
+# Conversation Context Management System (contexts live in CONTEXT_STORE)
 def get_or_create_context(session_id: str) -> ConversationContext:
-    """Get or create conversation context for session"""
-    if session_id not in CONVERSATION_CONTEXTS:
-        CONVERSATION_CONTEXTS[session_id] = ConversationContext()
-    return CONVERSATION_CONTEXTS[session_id]
+    """Get conversation context for session (a fresh one for new sessions)"""
+    return CONTEXT_STORE.get(session_id)
 
 def update_context(session_id: str, message: str, intent: str, preferences: dict, products: list = None):
     """Update conversation context"""
-    context = get_or_create_context(session_id)
-    context.update_context(message, intent, preferences, products)
+    CONTEXT_STORE.update(session_id, lambda context: context.update_context(message, intent, preferences, products))
 
 def get_context_info(session_id: str) -> dict:
     """Get context information for session"""
@@ -600,66 +644,113 @@ def sanitize_response(text: str) -> str:
     return text[:400].rsplit(". ", 1)[0] + "..." if len(text) > 400 else text
 
 # بناء الـ Prompt للمبيعات
-def build_sales_prompt(message: str, ctx: dict, system_prompt: str):
-    cat_list = ", ".join([c.get('name', '') for c in ctx.get("categories", [])[:10]]) or "غير متاح"
-    brand_list = ", ".join([b.get('name', '') for b in ctx.get("brands", [])[:10]]) or "غير متاح"
-    prod_lines = [f"- {p.get('title', '')} | السعر: {_price_text(p)}" for p in ctx.get("products", [])[:10]]
-    prod_list = "\n".join(prod_lines) or "غير متاح"
+def shop_context_header(ctx: dict) -> str:
+    """Static head of the user turn; identical for every request on the same catalog snapshot"""
+    return PROMPT_ASSEMBLER.header(ctx, _catalog_index(ctx).version, _price_text).text
 
+def build_sales_prompt(message: str, ctx: dict, system_prompt: str, candidates: list = None, history_lines: list = None):
     system = system_prompt
-    user = (
-        f"سياق المتجر:\n"
-        f"التصنيفات: {cat_list}\n"
-        f"الماركات: {brand_list}\n"
-        f"عينات منتجات:\n{prod_list}\n\n"
-        f"رسالة العميل: {message}"
-    )
+    header = PROMPT_ASSEMBLER.header(ctx, _catalog_index(ctx).version, _price_text)
+    user = PROMPT_ASSEMBLER.user_turn(header, message, candidates, history_lines, _price_text)
     return system, user
 
 # توليد رد المبيعات
-def hf_generate_sales(system: str, user: str) -> str:
-    if not model or not tokenizer:
-        return "فيه مشكلة تقنية، بس أقدر أساعدك! قولي وش تبغى وأرشح لك أفضل الخيارات."
-    
-    cache_key = f"sales:{abs(hash(user))}"
-    cached = None
-    if cache:
-        try:
-            cached = cache.get(cache_key)
-        except Exception as e:
-            logger.warning(f"Cache get failed: {e}")
+def _sales_cache_key(system: str, user: str, catalog_version: str = "") -> str:
+    """Same inputs -> same key in every worker and across restarts"""
+    return content_key(
+        "sales",
+        model=MODEL_NAME,
+        system=system,
+        user=user,
+        generation={k: v for k, v in GENERATION_KWARGS.items() if k not in ("pad_token_id", "eos_token_id")},
+        catalog=catalog_version,
+    )
+
+def _sales_cache_get(cache_key: str, system: str = "", semantic_text: str = "", catalog_version: str = ""):
+    """Exact-key hit first, then (for stand-alone messages) a semantically close earlier message"""
+    cached = RESPONSE_CACHE.get(cache_key)
     if cached:
         logger.info("Returning cached response")
-        return cached.decode('utf-8')
-    
+        return cached
+    return _semantic_cache_get(cache_key, system, semantic_text, catalog_version)
+
+def _semantic_cache_get(cache_key: str, system: str = "", semantic_text: str = "", catalog_version: str = ""):
+    if not (SEMANTIC_CACHE and semantic_text):
+        return None
+    try:
+        cached, similarity = SEMANTIC_CACHE.lookup(semantic_text, _sales_cache_key(system, "", catalog_version))
+    except Exception as e:
+        logger.warning(f"Semantic cache lookup failed: {e}")
+        return None
+    if cached:
+        logger.info(f"Returning semantically cached response (similarity {similarity:.3f})")
+        RESPONSE_CACHE.set(cache_key, cached)
+    return cached
+
+def _sales_cache_set(cache_key: str, text: str, system: str = "", semantic_text: str = "", catalog_version: str = ""):
+    RESPONSE_CACHE.set(cache_key, text)
+    _semantic_cache_store(text, system, semantic_text, catalog_version)
+
+def _semantic_cache_store(text: str, system: str = "", semantic_text: str = "", catalog_version: str = ""):
+    if SEMANTIC_CACHE and semantic_text and text:
+        try:
+            SEMANTIC_CACHE.store(semantic_text, _sales_cache_key(system, "", catalog_version), text)
+        except Exception as e:
+            logger.warning(f"Semantic cache store failed: {e}")
+
+def _sales_chat_prompt(system: str, user: str, user_prefix: str = "") -> tuple:
+    """(full prompt, static prefix) - the prefix runs through the end of user_prefix so its KV cache can be reused"""
     messages = [
         {"role": "system", "content": system},
         {"role": "user", "content": user},
     ]
     prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    inputs = tokenizer([prompt], return_tensors="pt").to(model.device)
-    
-    with torch.inference_mode():
-        outputs = model.generate(
-            **inputs,
-            max_new_tokens=60,  # قصير لسرعة وذكاء
-            do_sample=False,
-            repetition_penalty=1.2,
-            pad_token_id=tokenizer.eos_token_id,
-            eos_token_id=tokenizer.eos_token_id,
-        )
+    prefix = None
+    if user_prefix and user.startswith(user_prefix):
+        at = prompt.find(user)
+        if at >= 0:
+            prefix = prompt[:at + len(user_prefix)]
+    return prompt, prefix
+
+MODEL_NOT_READY_REPLY = "فيه مشكلة تقنية، بس أقدر أساعدك! قولي وش تبغى وأرشح لك أفضل الخيارات."
+
+def hf_generate_sales(system: str, user: str, user_prefix: str = "", catalog_version: str = "", semantic_text: str = "") -> str:
+    if not MODEL_LOADER.ready:  # still loading (or failed): templated reply
+        return MODEL_NOT_READY_REPLY
+    
+    cache_key = _sales_cache_key(system, user, catalog_version)
+    with METRICS.span("cache_lookup"):
+        cached = _sales_cache_get(cache_key, system, semantic_text, catalog_version)
+    if cached:
+        return cached
     
-    gen_ids = outputs[0]
-    input_len = inputs["input_ids"].shape[1]
-    text = tokenizer.decode(gen_ids[input_len:], skip_special_tokens=True).strip()
+    prompt, prefix = _sales_chat_prompt(system, user, user_prefix)
+    with METRICS.span("generation"):
+        text = INFERENCE.generate(prompt, prefix=prefix, timeout=GEN_TIMEOUT)
     text = sanitize_response(text)
-    if cache:
-        try:
-            cache.setex(cache_key, 7200, text)  # تخزين لمدة ساعتين
-        except Exception as e:
-            logger.warning(f"Cache set failed: {e}")
+    _sales_cache_set(cache_key, text, system, semantic_text, catalog_version)
     return text
 
+def hf_stream_sales(system: str, user: str, user_prefix: str = "", catalog_version: str = "", semantic_text: str = ""):
+    """Same as hf_generate_sales, but yields text chunks as the model produces them"""
+    if not MODEL_LOADER.ready:  # still loading (or failed): templated reply
+        yield MODEL_NOT_READY_REPLY
+        return
+    
+    cache_key = _sales_cache_key(system, user, catalog_version)
+    with METRICS.span("cache_lookup"):
+        cached = _sales_cache_get(cache_key, system, semantic_text, catalog_version)
+    if cached:
+        yield cached
+        return
+    
+    parts = []
+    prompt, prefix = _sales_chat_prompt(system, user, user_prefix)
+    for chunk in INFERENCE.stream(prompt, prefix=prefix, timeout=GEN_TIMEOUT):
+        parts.append(chunk)
+        yield chunk
+    _sales_cache_set(cache_key, sanitize_response("".join(parts).strip()), system, semantic_text, catalog_version)
+
 # Enhanced response formatting with smart no-results handling
 def format_no_results_response(intent: str, preferences: dict, ctx: dict, lang: str = 'ar') -> str:
     """Generate smart response when no products are found"""
@@ -776,167 +867,140 @@ def _price_text(p: dict) -> str:
 
 def get_popular_products(ctx: dict, limit: int = 5) -> list:
     """Get popular products based on sales and ratings"""
-    products = ctx.get("products", [])
-    if not products:
+    index = _catalog_index(ctx)
+    if not len(index):
         return []
     
-    # Score products by popularity
-    scored_products = []
-    for product in products:
-        score = 0
-        sold = product.get("sold", 0)
-        ratings = product.get("ratingsAverage", 0)
-        ratings_count = product.get("ratingsQuantity", 0)
-        
-        # Sales score (higher is better)
-        score += min(5, sold / 5)  # Cap at 5 points
-        
-        # Rating score (higher ratings are better)
-        if ratings > 0:
-            score += ratings * 0.5
-        
-        # Rating count score (more reviews = more reliable)
-        score += min(2, ratings_count / 10)  # Cap at 2 points
-        
-        scored_products.append((product, score))
-    
-    # Sort by popularity score
-    scored_products.sort(key=lambda x: x[1], reverse=True)
-    return [p[0] for p in scored_products[:limit]]
+    # Popularity (sales, rating, review count) is precomputed per catalog snapshot
+    return index.take(index.top_k(index.popularity, limit))
 
 def get_trending_deals(ctx: dict, limit: int = 5) -> list:
     """Get trending deals (products with good discounts)"""
-    products = ctx.get("products", [])
-    if not products:
+    index = _catalog_index(ctx)
+    if not len(index):
         return []
     
-    trending_products = []
-    for product in products:
-        price = product.get("price", 0)
-        discount_price = product.get("priceAfterDiscount", 0)
-        
-        # Only include products with actual discounts
-        if discount_price and discount_price < price:
-            discount_percentage = ((price - discount_price) / price) * 100
-            trending_products.append((product, discount_percentage))
-    
-    # Sort by discount percentage (highest first)
-    trending_products.sort(key=lambda x: x[1], reverse=True)
-    return [p[0] for p in trending_products[:limit]]
+    # Only include products with actual discounts, scored by discount percentage
+    rows = index.discount_rows
+    return index.take(index.top_k(index.discount_pct[rows], limit, rows))
 
 def personalized_recommendations(ctx: dict, user_preferences: dict, limit: int = 5) -> list:
     """Get personalized recommendations based on user preferences"""
-    products = ctx.get("products", [])
-    if not products:
+    index = _catalog_index(ctx)
+    if not len(index):
         return []
     
     # If no preferences, return popular products
     if not user_preferences:
         return get_popular_products(ctx, limit)
     
-    scored_products = []
-    for product in products:
-        score = 0
-        title = product.get("title", "").lower()
-        price = product.get("priceAfterDiscount") or product.get("price", 0)
-        
-        # Brand preference match
-        if user_preferences.get("brand"):
-            if user_preferences["brand"].lower() in title:
-                score += 3
-        
-        # Product type preference match
-        if user_preferences.get("product_type"):
-            product_type = user_preferences["product_type"]
-            if product_type == "phone" and any(word in title for word in ["phone", "mobile", "موبايل", "جوال"]):
-                score += 2
-            elif product_type == "laptop" and any(word in title for word in ["laptop", "computer", "لابتوب", "كمبيوتر"]):
-                score += 2
-            elif product_type == "headphones" and any(word in title for word in ["headphone", "earbud", "سماعات", "سماعة"]):
-                score += 2
-        
-        # Budget preference match
-        if user_preferences.get("budget") and price:
-            budget = user_preferences["budget"]
-            price_diff = abs(price - budget) / budget
-            if price_diff <= 0.2:  # Within 20% of budget
-                score += 2
-        
-        # Add base popularity score
-        sold = product.get("sold", 0)
-        ratings = product.get("ratingsAverage", 0)
-        score += min(2, sold / 10) + (ratings * 0.3)
-        
-        scored_products.append((product, score))
+    brand = (user_preferences.get("brand") or "").lower()
+    type_words = {
+        "phone": ["phone", "mobile", "موبايل", "جوال"],
+        "laptop": ["laptop", "computer", "لابتوب", "كمبيوتر"],
+        "headphones": ["headphone", "earbud", "سماعات", "سماعة"],
+    }.get(user_preferences.get("product_type"), [])
+    budget = user_preferences.get("budget")
     
-    # Sort by personalized score
-    scored_products.sort(key=lambda x: x[1], reverse=True)
-    return [p[0] for p in scored_products[:limit]]
-
-def compare_products(product_ids: list, ctx: dict) -> dict:
-    """Compare multiple products side by side"""
-    products = ctx.get("products", [])
-    if not products:
-        return {"error": "No products available"}
+    # Base popularity score
+    scores = index.sales_score + index.ratings * 0.3
     
-    # Find products by IDs
-    comparison_products = []
-    for product in products:
-        if str(product.get("_id")) in product_ids:
-            comparison_products.append(product)
+    # Brand preference match
+    if brand:
+        scores = scores + 3 * index.titles_containing([brand])
     
-    if len(comparison_products) < 2:
+    # Product type preference match
+    if type_words:
+        scores = scores + 2 * index.titles_containing(type_words)
+    
+    # Budget preference match (within 20% of budget)
+    if budget:
+        prices = index.effective_prices
+        scores = scores + 2 * ((prices > 0) & (np.abs(prices - budget) / budget <= 0.2))
+    
+    return index.take(index.top_k(scores, limit))
+
+def fetch_products_by_id(product_ids: list) -> dict:
+    """Products missing from the snapshot, fetched concurrently from the Node API (id -> product)"""
+    def fetch(pid: str):
+        try:
+            r = HTTP.get(f"{ZUHALL_BASE}/api/v1/products/{quote(pid, safe='')}")
+            if r.status_code != 200:
+                return None
+            product = r.json().get("data")
+            return product if isinstance(product, dict) else None
+        except Exception as e:
+            logger.warning(f"Failed to fetch product {pid}: {e}")
+            return None
+    
+    # The API has no batched id filter, so one pooled keep-alive GET per id, in parallel
+    return {pid: product for pid, product in zip(product_ids, HTTP.map(fetch, product_ids)) if product}
+
+def compare_missing_ids(product_ids: list, ctx: dict) -> list:
+    """Ids of the basket that are not in the catalog snapshot"""
+    index = _catalog_index(ctx)
+    ids = list(dict.fromkeys(str(pid) for pid in product_ids if pid))[:MAX_COMPARE_PRODUCTS]
+    return [pid for pid in ids if index.row_of(pid) is None]
+
+def compare_products(product_ids: list, ctx: dict, fetched: dict = None) -> dict:
+    """Compare multiple products side by side (fetched: products already loaded for the missing ids)"""
+    index = _catalog_index(ctx)
+    
+    # Find products by IDs (snapshot first, then the API for the rest)
+    ids = list(dict.fromkeys(str(pid) for pid in product_ids if pid))[:MAX_COMPARE_PRODUCTS]
+    missing = [pid for pid in ids if index.row_of(pid) is None]
+    if fetched is None:
+        fetched = fetch_products_by_id(missing) if missing else {}
+    products = []
+    for pid in ids:
+        row = index.row_of(pid)
+        product = index.products[row] if row is not None else fetched.get(pid)
+        if product is not None:
+            products.append(product)
+    
+    if len(products) < 2:
         return {"error": "Need at least 2 products to compare"}
     
-    # Create comparison data
+    # One vectorized pass over the price/rating columns of the basket
+    original_prices = np.array([float(p.get("price") or 0) for p in products])
+    discount_prices = np.array([float(p.get("priceAfterDiscount") or 0) for p in products])
+    prices = np.array([effective_price(p) for p in products])
+    ratings = np.array([float(p.get("ratingsAverage") or 0) for p in products])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        discounts = np.where(
+            (discount_prices > 0) & (original_prices > 0),
+            (original_prices - discount_prices) / original_prices * 100,
+            0.0,
+        )
+    
+    # Track best values (first product wins ties)
+    cheapest = int(np.argmin(prices))
+    most_rated = int(np.argmax(ratings))
+    best_discount = int(np.argmax(discounts))
+    
     comparison_data = {
         "products": [],
         "summary": {
-            "cheapest": None,
-            "most_rated": None,
-            "best_discount": None
-        }
+            "cheapest": products[cheapest].get("title", ""),
+            "most_rated": products[most_rated].get("title", "") if ratings[most_rated] > 0 else None,
+            "best_discount": products[best_discount].get("title", "") if discounts[best_discount] > 0 else None,
+        },
+        "missing_ids": [pid for pid in missing if pid not in fetched],
     }
     
-    cheapest_price = float('inf')
-    highest_rating = 0
-    best_discount = 0
-    
-    for product in comparison_products:
-        price = product.get("priceAfterDiscount") or product.get("price", 0)
-        discount_price = product.get("priceAfterDiscount", 0)
-        original_price = product.get("price", 0)
-        discount_percentage = 0
-        
-        if discount_price and original_price:
-            discount_percentage = ((original_price - discount_price) / original_price) * 100
-        
-        product_data = {
+    for product, discount_percentage in zip(products, discounts.tolist()):
+        description = product.get("description") or ""
+        comparison_data["products"].append({
             "id": product.get("_id"),
             "title": product.get("title", ""),
-            "price": price,
-            "original_price": original_price,
+            "price": product.get("priceAfterDiscount") or product.get("price", 0),
+            "original_price": product.get("price", 0),
             "discount_percentage": discount_percentage,
             "rating": product.get("ratingsAverage", 0),
             "ratings_count": product.get("ratingsQuantity", 0),
             "sold": product.get("sold", 0),
-            "description": product.get("description", "")[:100] + "..." if len(product.get("description", "")) > 100 else product.get("description", "")
-        }
-        
-        comparison_data["products"].append(product_data)
-        
-        # Track best values
-        if price < cheapest_price:
-            cheapest_price = price
-            comparison_data["summary"]["cheapest"] = product.get("title", "")
-        
-        if product.get("ratingsAverage", 0) > highest_rating:
-            highest_rating = product.get("ratingsAverage", 0)
-            comparison_data["summary"]["most_rated"] = product.get("title", "")
-        
-        if discount_percentage > best_discount:
-            best_discount = discount_percentage
-            comparison_data["summary"]["best_discount"] = product.get("title", "")
+            "description": description[:100] + "..." if len(description) > 100 else description
+        })
     
     return comparison_data
 
@@ -1028,98 +1092,167 @@ def get_dynamic_suggestions(ctx: dict, intent: str, lang: str = 'ar') -> list:
             suggestions = ["Best deals", "Browse categories", "Latest brands"]
         return suggestions or ["Today’s deals", "Show categories"]
 
-# Enhanced chat endpoint with all new features
-@app.route('/api/ai/chat', methods=['POST'])
-def api_ai_chat():
-    try:
-        data = request.json or {}
-        user_message = data.get('message', '').strip()
-        session_id = data.get('session_id', 'default')  # For context management
-        
-        if not user_message:
-            return jsonify({"error": "message is required"}), 400
+def _prepare_chat_turn(data: dict) -> dict:
+    """Everything a chat reply needs before the model runs (retrieval, intent, prompt)"""
+    user_message = data.get('message', '').strip()
+    session_id = data.get('session_id', 'default')  # For context management
 
-        # كشف اللغة
-        try:
-            lang = detect(user_message)
-        except Exception:
-            lang = 'ar'
-        system_prompt = ZUHALL_SALES_SYSTEM_PROMPT if lang == "ar" else ENG_SALES_SYSTEM_PROMPT
+    # كشف اللغة
+    with METRICS.span("language"):
+        lang = detect_language(user_message)
+    system_prompt = ZUHALL_SALES_SYSTEM_PROMPT if lang == "ar" else ENG_SALES_SYSTEM_PROMPT
 
-        # Get context and resolve references
+    # Get context and resolve references
+    with METRICS.span("context_load"):
         context = get_or_create_context(session_id)
-        resolved_message = context.resolve_context_references(user_message)
-        
+    resolved_message = context.resolve_context_references(user_message)
+    
+    with METRICS.span("catalog_snapshot"):
         ctx = get_shop_context_zuhall()
-        intent, preferences = detect_sales_intent(resolved_message)
-        
-        # Enhanced product search
-        include_products = intent in ("browse", "deals", "prices", "compare")
-        product_candidates = []
-        
-        if include_products:
-            if intent == "compare":
-                # Handle comparison requests
-                product_numbers = re.findall(r'\d+', user_message)
-                if product_numbers:
-                    # This would need product ID mapping in real implementation
-                    pass
-            else:
-                # Use smart search
-                product_candidates = smart_product_search(resolved_message, ctx)
+    with METRICS.span("intent"):
+        analysis = MESSAGE_ANALYZER.analyze(resolved_message)
+    intent, preferences = analysis.intent, analysis.preferences
+    
+    # Enhanced product search
+    include_products = intent in ("browse", "deals", "prices", "compare")
+    product_candidates = []
+    
+    if include_products:
+        if intent == "compare":
+            # Handle comparison requests
+            product_numbers = re.findall(r'\d+', user_message)
+            if product_numbers:
+                # Numbers point at the products shown last ("قارن 1 و 3")
+                positions = [int(n) for n in product_numbers]
+                product_candidates = context.resolve_products(_catalog_index(ctx), positions)
+        else:
+            # Use smart search
+            with METRICS.span("search"):
+                product_candidates = smart_product_search(resolved_message, ctx, criteria=analysis.criteria)
                 
                 # If no results, try similar products
                 if not product_candidates and intent in ("browse", "prices"):
                     # Get popular products as fallback
                     product_candidates = get_popular_products(ctx, 5)
-        
-        # Update conversation context
+    
+    # Update conversation context
+    with METRICS.span("context_update"):
         update_context(session_id, user_message, intent, preferences, product_candidates)
-        
-        # دمج تاريخ محادثة قصير لزيادة الإنسانية في الرد
-        history = data.get('history') or []
-        his_lines = []
-        for msg in history[-6:]:
-            if not isinstance(msg, dict):
-                continue
-            role = (msg.get('type') or msg.get('role') or '').lower()
-            text = (msg.get('text') or '').strip()
-            if not text:
-                continue
-            if role in ('user','human','client'):
-                his_lines.append(f"- العميل: {text}")
-            elif role in ('bot','assistant','ai'):
-                his_lines.append(f"- المساعد: {text}")
-        history_text = "\n".join(his_lines)
-        composed_message = resolved_message
-        if history_text:
-            composed_message = f"الرسائل السابقة (مختصر):\n{history_text}\n\nرسالة العميل الحالية: {resolved_message}"
+    
+    # دمج تاريخ محادثة قصير لزيادة الإنسانية في الرد
+    history = data.get('history') or []
+    his_lines = []
+    for msg in history[-PROMPT_ASSEMBLER.max_history:]:
+        if not isinstance(msg, dict):
+            continue
+        role = (msg.get('type') or msg.get('role') or '').lower()
+        text = (msg.get('text') or '').strip()
+        if not text:
+            continue
+        if role in ('user','human','client'):
+            his_lines.append(f"- العميل: {text}")
+        elif role in ('bot','assistant','ai'):
+            his_lines.append(f"- المساعد: {text}")
+    with METRICS.span("prompt_build"):
+        system, user = build_sales_prompt(resolved_message, ctx, system_prompt, product_candidates, his_lines)
+    return {
+        "session_id": session_id,
+        "lang": lang,
+        "ctx": ctx,
+        "intent": intent,
+        "preferences": preferences,
+        "include_products": include_products,
+        "product_candidates": product_candidates,
+        "system": system,
+        "user": user,
+        "shop_header": shop_context_header(ctx),
+        "catalog_version": _catalog_index(ctx).version,
+        # Replies that depend on earlier turns are not reusable for other conversations
+        "semantic_text": "" if his_lines else resolved_message,
+    }
+
+def _finish_chat_reply(turn: dict, model_text: str) -> str:
+    lang, intent = turn["lang"], turn["intent"]
+    if intent == "complaint":
+        model_text = ("آسفين جدًا على أي إزعاج! قولي وش المشكلة بالضبط وأحلها لك على طول." if lang == 'ar' 
+                      else "Sorry for the trouble! Tell me the issue and I'll fix it right away.")
+    with METRICS.span("compose_reply"):
+        return compose_sales_reply(model_text, turn["ctx"], intent, turn["preferences"], turn["product_candidates"], lang)
+
+def _fallback_chat_reply(turn: dict) -> str:
+    lang = turn["lang"]
+    text = ("فيه مشكلة تقنية، بس أقدر أساعدك! قولي وش تبغى وأرشح لك." if lang == 'ar' 
+            else "Technical hiccup, but I can still help! Tell me what you want and I'll suggest options.")
+    with METRICS.span("compose_reply"):
+        return compose_sales_reply(text, turn["ctx"], turn["intent"], turn["preferences"], turn["product_candidates"], lang)
+
+def _chat_picks(turn: dict) -> dict:
+    """Retrieval part of a chat response; does not depend on the model"""
+    ctx, intent = turn["ctx"], turn["intent"]
+    return {
+        "products": (turn["product_candidates"][:8] if turn["include_products"] else []),
+        "categories": (ctx.get("categories", [])[:12] if intent == "categories" else []),
+        "brands": (ctx.get("brands", [])[:12] if intent == "brands" else []),
+        "suggestions": get_dynamic_suggestions(ctx, intent, turn["lang"]),
+        "intent": intent,
+    }
+
+def _ndjson(event: dict) -> str:
+    return json.dumps(event, ensure_ascii=False, default=str) + "\n"
+
+def _stream_chat(turn: dict) -> Response:
+    """Chunked JSON lines: picks first, then model tokens, then the final composed reply"""
+    def events():
+        yield _ndjson({"type": "picks", **_chat_picks(turn)})
+        model_text = ""
+        try:
+            if turn["intent"] != "complaint":
+                for chunk in hf_stream_sales(turn["system"], turn["user"], turn["shop_header"], turn["catalog_version"], turn["semantic_text"]):
+                    model_text += chunk
+                    yield _ndjson({"type": "token", "text": chunk})
+            text = _finish_chat_reply(turn, model_text)
+        except Exception as e:
+            logger.error(f"Generation error: {e}")
+            text = _fallback_chat_reply(turn)
+        yield _ndjson({
+            "type": "done",
+            "text": text,
+            "context": get_context_info(turn["session_id"]),
+            "timestamp": datetime.now().isoformat(),
+        })
+
+    return Response(
+        stream_with_context(events()),
+        mimetype='application/x-ndjson',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Enhanced chat endpoint with all new features
+@app.route('/api/ai/chat', methods=['POST'])
+def api_ai_chat():
+    try:
+        data = request.json or {}
+        if not data.get('message', '').strip():
+            return jsonify({"error": "message is required"}), 400
+
+        turn = _prepare_chat_turn(data)
+        if data.get('stream'):
+            return _stream_chat(turn)
 
         # توليد الرد المحسّن
-        system, user = build_sales_prompt(composed_message, ctx, system_prompt)
         try:
-            text = hf_generate_sales(system, user)
-            if intent == "complaint":
-                text = ("آسفين جدًا على أي إزعاج! قولي وش المشكلة بالضبط وأحلها لك على طول." if lang == 'ar' 
-                        else "Sorry for the trouble! Tell me the issue and I'll fix it right away.")
-            text = compose_sales_reply(text, ctx, intent, preferences, product_candidates, lang)
+            text = _finish_chat_reply(turn, hf_generate_sales(turn["system"], turn["user"], turn["shop_header"], turn["catalog_version"], turn["semantic_text"]))
         except Exception as e:
             logger.error(f"Generation error: {e}")
-            text = ("فيه مشكلة تقنية، بس أقدر أساعدك! قولي وش تبغى وأرشح لك." if lang == 'ar' 
-                    else "Technical hiccup, but I can still help! Tell me what you want and I'll suggest options.")
-            text = compose_sales_reply(text, ctx, intent, preferences, product_candidates, lang)
+            text = _fallback_chat_reply(turn)
 
         # Get context info for personalized suggestions
-        context_info = get_context_info(session_id)
+        context_info = get_context_info(turn["session_id"])
         
         return jsonify({
             "text": text,
-            "products": (product_candidates[:8] if include_products else []),
-            "categories": (ctx.get("categories", [])[:12] if intent == "categories" else []),
-            "brands": (ctx.get("brands", [])[:12] if intent == "brands" else []),
-            "suggestions": get_dynamic_suggestions(ctx, intent, lang),
+            **_chat_picks(turn),
             "context": context_info,
-            "intent": intent,
             "timestamp": datetime.now().isoformat(),
         })
     except Exception as e:
@@ -1127,105 +1260,123 @@ def api_ai_chat():
         return jsonify({"error": str(e)}), 500
 
 # Advanced search endpoint
+def search_response(data: dict) -> tuple:
+    """(payload, status) for a search request; shared by the Flask and ASGI apps"""
+    query = data.get('query', '').strip()
+    session_id = data.get('session_id', 'default')
+    mode = data.get('mode') or SEARCH_MODE
+    
+    if not query:
+        return {"error": "query is required"}, 400
+    if mode not in ("lexical", "vector", "hybrid"):
+        return {"error": "mode must be lexical, vector or hybrid"}, 400
+    
+    with METRICS.span("catalog_snapshot"):
+        ctx = get_shop_context_zuhall()
+    
+    # Use smart search
+    with METRICS.span("search"):
+        results = smart_product_search(query, ctx, mode)
+    
+    # If no results, get similar products
+    if not results:
+        # Try to find similar products based on query
+        popular_products = get_popular_products(ctx, 5)
+        results = popular_products
+    
+    return {
+        "results": results,
+        "total": len(results),
+        "query": query,
+        "mode": mode,
+        "timestamp": datetime.now().isoformat(),
+    }, 200
+
 @app.route('/api/ai/search', methods=['POST'])
 def api_ai_search():
     try:
-        data = request.json or {}
-        query = data.get('query', '').strip()
-        session_id = data.get('session_id', 'default')
-        
-        if not query:
-            return jsonify({"error": "query is required"}), 400
-        
-        ctx = get_shop_context_zuhall()
-        
-        # Use smart search
-        results = smart_product_search(query, ctx)
-        
-        # If no results, get similar products
-        if not results:
-            # Try to find similar products based on query
-            popular_products = get_popular_products(ctx, 5)
-            results = popular_products
-        
-        return jsonify({
-            "results": results,
-            "total": len(results),
-            "query": query,
-            "timestamp": datetime.now().isoformat(),
-        })
+        payload, status = search_response(request.json or {})
+        return jsonify(payload), status
     except Exception as e:
         logger.error(f"Search API error: {e}")
         return jsonify({"error": str(e)}), 500
 
 # Product comparison endpoint
+def compare_response(data: dict, fetched: dict = None) -> tuple:
+    """(payload, status) for a compare request; fetched: products already loaded for ids missing from the snapshot"""
+    product_ids = data.get('product_ids', [])
+    
+    if not isinstance(product_ids, list) or len(product_ids) < 2:
+        return {"error": "At least 2 product IDs required"}, 400
+    if len(product_ids) > MAX_COMPARE_PRODUCTS:
+        return {"error": f"At most {MAX_COMPARE_PRODUCTS} products can be compared"}, 400
+    
+    ctx = get_shop_context_zuhall()
+    comparison_data = compare_products(product_ids, ctx, fetched)
+    
+    if "error" in comparison_data:
+        return comparison_data, 400
+    
+    # Format as table
+    table = format_comparison_table(comparison_data)
+    
+    return {
+        "comparison": comparison_data,
+        "table": table,
+        "timestamp": datetime.now().isoformat(),
+    }, 200
+
 @app.route('/api/ai/compare', methods=['POST'])
 def api_ai_compare():
     try:
-        data = request.json or {}
-        product_ids = data.get('product_ids', [])
-        
-        if not product_ids or len(product_ids) < 2:
-            return jsonify({"error": "At least 2 product IDs required"}), 400
-        
-        ctx = get_shop_context_zuhall()
-        comparison_data = compare_products(product_ids, ctx)
-        
-        if "error" in comparison_data:
-            return jsonify(comparison_data), 400
-        
-        # Format as table
-        table = format_comparison_table(comparison_data)
-        
-        return jsonify({
-            "comparison": comparison_data,
-            "table": table,
-            "timestamp": datetime.now().isoformat(),
-        })
+        payload, status = compare_response(request.json or {})
+        return jsonify(payload), status
     except Exception as e:
         logger.error(f"Compare API error: {e}")
         return jsonify({"error": str(e)}), 500
 
 # Similar products endpoint
+def similar_response(data: dict) -> tuple:
+    """(payload, status) for a similar-products request"""
+    product_id = data.get('product_id')
+    
+    if not product_id:
+        return {"error": "product_id is required"}, 400
+    
+    ctx = get_shop_context_zuhall()
+    
+    # Find the target product
+    target_product = _catalog_index(ctx).get(product_id)
+    
+    if not target_product:
+        return {"error": "Product not found"}, 404
+    
+    # Find similar products
+    similar = find_similar_products(target_product, ctx, 5)
+    
+    return {
+        "target_product": target_product,
+        "similar_products": similar,
+        "timestamp": datetime.now().isoformat(),
+    }, 200
+
 @app.route('/api/ai/similar', methods=['POST'])
 def api_ai_similar():
     try:
-        data = request.json or {}
-        product_id = data.get('product_id')
-        
-        if not product_id:
-            return jsonify({"error": "product_id is required"}), 400
-        
-        ctx = get_shop_context_zuhall()
-        
-        # Find the target product
-        target_product = None
-        for product in ctx.get("products", []):
-            if str(product.get("_id")) == str(product_id):
-                target_product = product
-                break
-        
-        if not target_product:
-            return jsonify({"error": "Product not found"}), 404
-        
-        # Find similar products
-        similar = find_similar_products(target_product, ctx, 5)
-        
-        return jsonify({
-            "target_product": target_product,
-            "similar_products": similar,
-            "timestamp": datetime.now().isoformat(),
-        })
+        payload, status = similar_response(request.json or {})
+        return jsonify(payload), status
     except Exception as e:
         logger.error(f"Similar products API error: {e}")
         return jsonify({"error": str(e)}), 500
 
 # نقطة نهاية الصحة
-@app.route('/api/ai/health', methods=['GET'])
-def api_ai_health():
-    return jsonify({
-        "ok": model is not None,
+def health_status() -> dict:
+    return {
+        "ok": MODEL_LOADER.ready,
         "model_name": MODEL_NAME,
+        "model": MODEL_LOADER.status(),
+        "inference_engine": INFERENCE_ENGINE,
+        "startup": STARTUP.summary(),
         "features": {
             "smart_search": True,
             "context_management": True,
@@ -1237,10 +1388,76 @@ def api_ai_health():
             "chat": "/api/ai/chat",
             "search": "/api/ai/search", 
             "compare": "/api/ai/compare",
-            "similar": "/api/ai/similar"
+            "similar": "/api/ai/similar",
+            "metrics": "/api/ai/metrics"
         },
+        "catalog": CATALOG.status(),
+        "http_pool": HTTP.stats(),
+        "inference": INFERENCE.stats() if INFERENCE else None,
+        "response_cache": RESPONSE_CACHE.stats(),
+        "semantic_cache": SEMANTIC_CACHE.stats() if SEMANTIC_CACHE else None,
+        "vector_search": PRODUCT_VECTORS.status() if PRODUCT_VECTORS else None,
+        "similar_products": SIMILAR_PRODUCTS.status(),
+        "conversations": CONTEXT_STORE.stats(),
+        "prompt": PROMPT_ASSEMBLER.stats(),
+        "latency": METRICS.summary(),
         "timestamp": datetime.now().isoformat(),
-    })
+    }
+
+@app.route('/api/ai/health', methods=['GET'])
+def api_ai_health():
+    return jsonify(health_status())
+
+# مقاييس Prometheus
+def _metrics_families() -> list:
+    """Scrape-time gauges and counters: cache hit ratios, generation throughput, queue depth"""
+    families = []
+    cache_hits, cache_misses, hit_ratio = [], [], []
+    response = RESPONSE_CACHE.stats()
+    cache_hits += [({"cache": "response", "tier": "local"}, response["local_hits"]), ({"cache": "response", "tier": "redis"}, response["redis_hits"])]
+    cache_misses.append(({"cache": "response"}, response["misses"]))
+    hit_ratio.append(({"cache": "response"}, response["hit_ratio"]))
+    if SEMANTIC_CACHE:
+        semantic = SEMANTIC_CACHE.stats()
+        cache_hits.append(({"cache": "semantic", "tier": "local"}, semantic["hits"]))
+        cache_misses.append(({"cache": "semantic"}, semantic["misses"]))
+        hit_ratio.append(({"cache": "semantic"}, semantic["hit_ratio"]))
+    inference = INFERENCE.stats() if INFERENCE else {}
+    if "prefix_hits" in inference:
+        lookups = inference["prefix_hits"] + inference["prefix_misses"]
+        cache_hits.append(({"cache": "prefix_kv", "tier": "local"}, inference["prefix_hits"]))
+        cache_misses.append(({"cache": "prefix_kv"}, inference["prefix_misses"]))
+        hit_ratio.append(({"cache": "prefix_kv"}, inference["prefix_hits"] / lookups if lookups else 0.0))
+    families += [
+        ("cache_hits_total", "counter", "Cache hits", cache_hits),
+        ("cache_misses_total", "counter", "Cache misses", cache_misses),
+        ("cache_hit_ratio", "gauge", "Hits / lookups since start", hit_ratio),
+        ("model_ready", "gauge", "1 when a generation model is loaded", [({}, MODEL_LOADER.ready)]),
+    ]
+    if inference:
+        families += [
+            ("generation_requests_total", "counter", "Generation requests", [({}, inference["requests"])]),
+            ("generated_tokens_total", "counter", "Generated tokens", [({}, inference["generated_tokens"])]),
+            ("generate_seconds_total", "counter", "Time spent in generate", [({}, inference["generate_seconds"])]),
+            ("tokens_per_second", "gauge", "Generated tokens / generate seconds since start", [({}, inference["tokens_per_sec"])]),
+            ("inference_queue_depth", "gauge", "Prompts waiting for the model", [({}, inference["queue_depth"])]),
+        ]
+    catalog = CATALOG.status()
+    families += [
+        ("catalog_products", "gauge", "Products in the catalog snapshot", [({}, catalog["products"])]),
+        ("catalog_age_seconds", "gauge", "Seconds since the last catalog sync", [({}, catalog["age_seconds"] or 0)]),
+    ]
+    http = HTTP.stats()
+    families.append(("api_http_requests_total", "counter", "Node API requests by outcome", [
+        ({"outcome": "request"}, http["requests"]), ({"outcome": "retry"}, http["retries"]), ({"outcome": "failure"}, http["failures"]),
+    ]))
+    return families
+
+METRICS.add_collector(_metrics_families)
+
+@app.route('/api/ai/metrics', methods=['GET'])
+def api_ai_metrics():
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
 
 # نقطة نهاية للاختبار السريع
 @app.route('/api/ai/test', methods=['POST'])
@@ -1378,6 +1595,11 @@ def api_extract_product():
                     
             except Exception as e:
                 logger.error(f"Error parsing HTML: {e}")
+        
+        return jsonify(extracted)
+    except Exception as e:
+        logger.error(f"Extract product API error: {e}")
+        return jsonify({"error": str(e)}), 500
 
 def extract_shein_data(html, url, soup):
     """Extract product data specifically from Shein"""
@@ -1597,14 +1819,44 @@ def extract_from_json(obj, extracted, seen_urls):
                         extract_from_json(item, extracted, seen_urls)
     except Exception as e:
         logger.warning(f"Error in extract_from_json: {e}")
-        
-        return jsonify(extracted)
-    except Exception as e:
-        logger.error(f"Extract product API error: {e}")
-        return jsonify({"error": str(e)}), 500
+
+# تشغيل متعدد العمليات: التحميل في العملية الأم ثم مشاركة الأوزان مع العمال (copy-on-write)
+def prepare_for_fork(timeout: float = None):
+    """Finish loading the model, catalog and per-snapshot tables, then stop the master's background threads"""
+    with STARTUP.phase("preload"):
+        MODEL_LOADER.wait(timeout)
+        get_shop_context_zuhall()
+        for builder in (SIMILAR_PRODUCTS, PRODUCT_VECTORS):
+            if builder is not None:
+                try:
+                    builder.wait_idle(timeout)
+                except Exception as e:
+                    logger.warning(f"Table build not finished before fork: {e}")
+        # The master only forks from here on: no thread may hold a lock or allocate behind gc.freeze()
+        CATALOG.stop(timeout)
+        for builder in (SIMILAR_PRODUCTS, PRODUCT_VECTORS):
+            if builder is not None:
+                builder.stop()
+        HTTP.close()
+
+def after_fork(torch_threads: int = 0):
+    """Re-create threads, pools and sockets in a forked worker; model and catalog memory stay shared"""
+    if torch_threads > 0:
+        torch.set_num_threads(torch_threads)
+    HTTP.after_fork()
+    CATALOG.after_fork()
+    SIMILAR_PRODUCTS.after_fork()
+    if PRODUCT_VECTORS is not None:
+        PRODUCT_VECTORS.after_fork()
+    if INFERENCE is not None:
+        INFERENCE.after_fork()
+    MODEL_LOADER.after_fork()
+
+# الخادم جاهز لاستقبال الطلبات (النموذج قد يكون ما زال يُحمّل)
+STARTUP.mark("server_import")
 
 if __name__ == '__main__':
     port = int(os.getenv('PORT', '3001'))
     logger.info(f"Starting Zuhall AI Sales Assistant on http://127.0.0.1:{port}")
-    logger.info(f"Model: {MODEL_NAME}")
+    logger.info(f"Model: {MODEL_NAME} ({MODEL_LOADER.state})")
     app.run(host='127.0.0.1', port=port, debug=False)
\ No newline at end of file
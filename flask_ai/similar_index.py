@@ -0,0 +1,209 @@
+# جدول المنتجات المشابهة (محسوب مسبقاً لكل نسخة كتالوج)
+"""Precomputed nearest-neighbor table for similar products.
+
+Similarity is the score find_similar_products has always used: +3 same
+category, +2 same brand, +2 price within 20%, +1 per shared title word. The
+table keeps the top ``top_n`` rows per product so ``/api/ai/similar`` is a
+single row lookup.
+
+Catalogs up to ``exact_limit`` products are scored exactly (one vectorized pass
+per product). Larger catalogs only score candidate pairs: neighbors in price
+within the same category, the same category + brand, and the same MinHash/LSH
+bucket of title words. Tables are built on a background thread per snapshot;
+until one is ready, callers compute similarity on the fly.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_MINHASH_PRIME = (1 << 31) - 1
+
+
+def similarity_scores(index, category: int, brand: int, price: float, words) -> np.ndarray:
+    """Similarity of every catalog row to a product with these attributes"""
+    scores = index.title_overlap(words).astype(np.float64)
+    if category >= 0:
+        scores += 3 * (index.category_ids == category)
+    if brand >= 0:
+        scores += 2 * (index.brand_ids == brand)
+    if price:
+        prices = index.effective_prices
+        scores += 2 * ((prices > 0) & (np.abs(prices - price) / price <= 0.2))
+    return scores
+
+
+class SimilarityTable:
+    def __init__(self, rows: np.ndarray, mode: str, seconds: float):
+        self.rows = rows  # (products, top_n) int32, -1 padded
+        self.top_n = rows.shape[1]
+        self.mode = mode
+        self.seconds = seconds
+
+    def similar(self, row: int, limit: int) -> list:
+        neighbors = self.rows[row, :limit]
+        return neighbors[neighbors >= 0].tolist()
+
+
+class SimilarityBuilder:
+    def __init__(self, top_n: int = 10, exact_limit: int = 20000, window: int = 8,
+                 bands: int = 4, rows_per_band: int = 2, max_title_words: int = 12):
+        self.top_n = max(1, top_n)
+        self.exact_limit = exact_limit
+        self.window = window
+        self.bands = bands
+        self.rows_per_band = rows_per_band
+        self.max_title_words = max_title_words
+        self._latest = None
+        self._last_build = None
+        self._builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix='similar-builder')
+
+    def attach(self, index):
+        index.similar = None
+        if not len(index):
+            return
+        self._latest = index
+        self._builder.submit(self._build, index)
+
+    def wait_idle(self, timeout: float = None):
+        """Block until queued builds finished (before forking workers)"""
+        self._builder.submit(lambda: None).result(timeout)
+
+    def stop(self):
+        """Finish queued builds and end the builder thread (gunicorn master after preload)"""
+        self._builder.shutdown(wait=True)
+
+    def after_fork(self):
+        self._builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix='similar-builder')
+
+    def status(self) -> dict:
+        latest = self._latest
+        return {
+            "ready": latest is not None and latest.similar is not None,
+            "last_build": self._last_build,
+        }
+
+    def _build(self, index):
+        if self._latest is not index:
+            return  # superseded by a newer snapshot
+        started = time.perf_counter()
+        try:
+            exact = len(index) <= self.exact_limit
+            rows = self._build_exact(index) if exact else self._build_candidates(index)
+            elapsed = time.perf_counter() - started
+            index.similar = SimilarityTable(rows, "exact" if exact else "lsh", elapsed)
+            self._last_build = {"products": len(index), "mode": index.similar.mode, "seconds": round(elapsed, 2)}
+            logger.info(f"Similar-products table ready: {len(index)} products ({index.similar.mode}) in {elapsed:.1f}s")
+        except Exception as e:
+            logger.warning(f"Similar-products table build failed, computing on demand: {e}")
+
+    def _build_exact(self, index) -> np.ndarray:
+        table = np.full((len(index), self.top_n), -1, dtype=np.int32)
+        for row in range(len(index)):
+            scores = similarity_scores(
+                index, index.category_ids[row], index.brand_ids[row], index.effective_prices[row], index.title_tokens[row]
+            )
+            scores[row] = 0  # skip the product itself
+            candidates = np.flatnonzero(scores > 0)
+            neighbors = index.top_k(scores[candidates], self.top_n, candidates)
+            table[row, :len(neighbors)] = neighbors
+        return table
+
+    # -- large catalogs ----------------------------------------------------
+
+    def _build_candidates(self, index) -> np.ndarray:
+        count = len(index)
+        words, lengths = self._title_word_ids(index)
+        groupings = [index.category_ids, np.where(
+            (index.category_ids >= 0) & (index.brand_ids >= 0),
+            index.category_ids * (len(index.brand_keys) + 1) + index.brand_ids, -1,
+        )]
+        groupings.extend(self._lsh_buckets(words, lengths))
+
+        src, dst = [], []
+        for groups in groupings:
+            a, b = self._window_pairs(groups, index.effective_prices)
+            src.extend((a, b))
+            dst.extend((b, a))
+        src, dst = np.concatenate(src), np.concatenate(dst)
+        keys = np.unique(src * count + dst)
+        src, dst = keys // count, keys % count
+
+        scores = self._pair_overlap(words, src, dst).astype(np.float64)
+        scores += 3 * ((index.category_ids[src] == index.category_ids[dst]) & (index.category_ids[src] >= 0))
+        scores += 2 * ((index.brand_ids[src] == index.brand_ids[dst]) & (index.brand_ids[src] >= 0))
+        prices_src, prices_dst = index.effective_prices[src], index.effective_prices[dst]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            close = (prices_src > 0) & (prices_dst > 0) & (np.abs(prices_dst - prices_src) / prices_src <= 0.2)
+        scores += 2 * close
+
+        keep = scores > 0
+        src, dst, scores = src[keep], dst[keep], scores[keep]
+        # Best first within each product, ties by row like the exact path
+        order = np.lexsort((dst, -scores, src))
+        src, dst = src[order], dst[order]
+        starts = np.searchsorted(src, src, side='left')
+        rank = np.arange(len(src)) - starts
+        keep = rank < self.top_n
+        table = np.full((count, self.top_n), -1, dtype=np.int32)
+        table[src[keep], rank[keep]] = dst[keep]
+        return table
+
+    def _title_word_ids(self, index) -> tuple:
+        """(products, max_title_words) word ids padded with -1, and per-row word counts"""
+        vocabulary = {}
+        words = np.full((len(index), self.max_title_words), -1, dtype=np.int64)
+        lengths = np.zeros(len(index), dtype=np.int64)
+        for row, tokens in enumerate(index.title_tokens):
+            ids = sorted(vocabulary.setdefault(t, len(vocabulary)) for t in tokens)[:self.max_title_words]
+            words[row, :len(ids)] = ids
+            lengths[row] = len(ids)
+        return words, lengths
+
+    def _lsh_buckets(self, words: np.ndarray, lengths: np.ndarray) -> list:
+        """Per band, a bucket id per row (-1 for rows without title words)"""
+        hashes = self.bands * self.rows_per_band
+        rng = np.random.default_rng(0)
+        a = rng.integers(1, _MINHASH_PRIME, size=hashes, dtype=np.int64)
+        b = rng.integers(0, _MINHASH_PRIME, size=hashes, dtype=np.int64)
+        signature = np.full((len(words), hashes), _MINHASH_PRIME, dtype=np.int64)
+        for col in range(words.shape[1]):
+            present = words[:, col] >= 0
+            if not present.any():
+                break
+            values = (words[present, col, None] * a + b) % _MINHASH_PRIME
+            signature[present] = np.minimum(signature[present], values)
+        buckets = []
+        for band in range(self.bands):
+            part = signature[:, band * self.rows_per_band:(band + 1) * self.rows_per_band]
+            _, ids = np.unique(part, axis=0, return_inverse=True)
+            buckets.append(np.where(lengths > 0, ids.reshape(-1), -1))
+        return buckets
+
+    def _window_pairs(self, groups: np.ndarray, prices: np.ndarray) -> tuple:
+        """Pairs of rows in the same group that are within ``window`` places of each other by price"""
+        rows = np.flatnonzero(groups >= 0)
+        order = rows[np.lexsort((prices[rows], groups[rows]))]
+        src, dst = [], []
+        for offset in range(1, self.window + 1):
+            a, b = order[:-offset], order[offset:]
+            same = groups[a] == groups[b]
+            src.append(a[same])
+            dst.append(b[same])
+        if not src:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(src), np.concatenate(dst)
+
+    @staticmethod
+    def _pair_overlap(words: np.ndarray, src: np.ndarray, dst: np.ndarray, chunk: int = 200000) -> np.ndarray:
+        """Exact shared-word counts for the candidate pairs"""
+        overlap = np.zeros(len(src), dtype=np.int64)
+        for start in range(0, len(src), chunk):
+            left = words[src[start:start + chunk]]
+            right = words[dst[start:start + chunk]]
+            equal = (left[:, :, None] == right[:, None, :]) & (left[:, :, None] >= 0)
+            overlap[start:start + chunk] = equal.sum(axis=(1, 2))
+        return overlap
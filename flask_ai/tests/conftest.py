@@ -0,0 +1,9 @@
+# إعداد اختبارات خدمة الذكاء الاصطناعي
+"""Shared pytest setup: the service modules are flat files next to this folder.
+
+Run from ``flask_ai/`` with ``python -m pytest tests``.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,81 @@
+"""BM25 ranking, synonym/prefix expansion and top-k selection on a fixed catalog."""
+import numpy as np
+
+from catalog import CatalogIndex, InvertedIndex, tokenize
+
+PRODUCTS = [
+    {"_id": "p0", "title": "Samsung Galaxy A15 Phone", "description": "android smartphone with 128GB storage"},
+    {"_id": "p1", "title": "iPhone 15 silicone case", "description": "protective cover for your phone"},
+    {"_id": "p2", "title": "موبايل شاومي ريدمي 13", "description": "هاتف ذكي بشاشة كبيرة"},
+    {"_id": "p3", "title": "Lenovo IdeaPad laptop", "description": "thin notebook for work"},
+    {"_id": "p4", "title": "Phones charging stand", "description": "desk stand"},
+    {"_id": "p5", "title": "جوال نوكيا", "description": ""},
+]
+SYNONYMS = {"mobile": ["موبايل", "جوال", "هاتف", "phone"]}
+
+
+def text_index() -> InvertedIndex:
+    index = CatalogIndex(PRODUCTS)
+    return InvertedIndex(index.titles, index.descriptions, SYNONYMS)
+
+
+def ranked(scores: np.ndarray) -> list:
+    return [f"p{row}" for row in CatalogIndex.top_k(scores, len(scores)) if scores[row] > 0]
+
+
+def test_exact_title_match_ranks_first():
+    scores = text_index().score([set(tokenize("lenovo laptop"))])
+    assert ranked(scores) == ["p3"]
+
+
+def test_title_hits_outrank_description_hits():
+    # "phone" is a title word of p0 (and a prefix of p4's "phones"), only in the description of p1
+    order = ranked(text_index().score([{"phone"}]))
+    assert set(order) == {"p0", "p1", "p4"}
+    assert order.index("p1") == 2
+
+
+def test_synonym_group_scores_every_member():
+    order = ranked(text_index().score(["mobile"]))
+    assert set(order) == {"p0", "p1", "p2", "p4", "p5"}  # موبايل, جوال, هاتف and phone(s)
+    assert "p3" not in order
+
+
+def test_arabic_normalization_and_definite_article():
+    index = text_index()
+    assert ranked(index.score([set(tokenize("الموبايل"))])) == ["p2"]
+    assert ranked(index.score([set(tokenize("شاومى"))])) == ["p2"]  # alef maqsura -> yaa
+
+
+def test_prefix_expands_to_longer_terms_only_from_three_letters():
+    index = text_index()
+    assert index.expand({"phon"}) == {"phone", "phones"}
+    assert ranked(index.score([{"lapt"}])) == ["p3"]
+    assert index.expand({"ip"}) == set()  # short tokens only match exactly
+    assert index.rows_with({"stand"}).tolist() == [False, False, False, False, True, False]
+
+
+def test_unknown_terms_score_nothing():
+    assert not text_index().score([{"television"}, "no-such-group"]).any()
+
+
+def test_top_k_with_k_at_least_n_returns_everything_sorted():
+    scores = np.array([0.5, 2.0, 0.0, 2.0, 1.0])
+    expected = [1, 3, 4, 0, 2]  # descending, ties in row order
+    assert CatalogIndex.top_k(scores, 5) == expected
+    assert CatalogIndex.top_k(scores, 50) == expected
+
+
+def test_top_k_matches_a_stable_reverse_sort():
+    rng = np.random.default_rng(7)
+    scores = rng.integers(0, 20, size=500).astype(np.float64)
+    stable = sorted(range(len(scores)), key=lambda r: -scores[r])
+    for limit in (1, 10, 99, 499):
+        assert CatalogIndex.top_k(scores, limit) == stable[:limit]
+
+
+def test_top_k_maps_back_to_rows():
+    rows = np.array([40, 10, 30])
+    assert CatalogIndex.top_k(np.array([1.0, 3.0, 2.0]), 2, rows) == [10, 30]
+    assert CatalogIndex.top_k(np.array([]), 3) == []
+    assert CatalogIndex.top_k(np.array([1.0]), 0) == []
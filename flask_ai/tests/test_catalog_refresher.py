@@ -0,0 +1,149 @@
+"""Incremental catalog merge, ETag revalidation and keeping the snapshot on failure."""
+import hashlib
+import json
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from catalog import CatalogIndex
+from catalog_refresher import CatalogFetchError, CatalogRefresher
+
+BASE = "http://api.test"
+
+
+class StubResponse:
+    def __init__(self, status_code: int, payload: dict = None, etag: str = None):
+        self.status_code = status_code
+        self._payload = payload
+        self.headers = {"ETag": etag} if etag else {}
+
+    def json(self):
+        return self._payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+
+class StubClient:
+    """PooledHttpClient stand-in serving paginated Node API lists with ETags"""
+
+    def __init__(self, products: list):
+        self.products = products
+        self.categories = [{"_id": "c1", "name": "Phones"}]
+        self.brands = [{"_id": "b1", "name": "Samsung"}]
+        self.failing = set()  # resources answering 500
+        self.urls = []
+
+    def get(self, url: str, headers: dict = None) -> StubResponse:
+        self.urls.append(url)
+        parsed = urlparse(url)
+        resource = parsed.path.rsplit("/", 1)[-1]
+        if resource in self.failing:
+            return StubResponse(500)
+        query = parse_qs(parsed.query)
+        items = getattr(self, resource)
+        if "updatedAt[gte]" in query:
+            since = query["updatedAt[gte]"][0]
+            items = sorted((p for p in items if p["updatedAt"] >= since), key=lambda p: p["updatedAt"])
+        limit, page = int(query["limit"][0]), int(query["page"][0])
+        pages = max(1, -(-len(items) // limit))
+        payload = {
+            "data": items[(page - 1) * limit:page * limit],
+            "paginationResult": {"numberOfPages": pages, **({"next": page + 1} if page < pages else {})},
+        }
+        etag = hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+        if (headers or {}).get("If-None-Match") == etag:
+            return StubResponse(304)
+        return StubResponse(200, payload, etag)
+
+    def map(self, fn, items) -> list:
+        return [fn(item) for item in items]
+
+
+def product(n: int, updated: str, price: float = 100) -> dict:
+    return {"_id": f"p{n}", "title": f"Product {n}", "price": price, "updatedAt": updated}
+
+
+@pytest.fixture
+def client():
+    # API order: newest first
+    return StubClient([product(n, f"2026-01-{10 - n:02d}") for n in range(1, 6)])
+
+
+@pytest.fixture
+def refresher(client):
+    r = CatalogRefresher(BASE, CatalogIndex, client, page_size=2)
+    r._refresh(full=True)
+    return r
+
+
+def ids(snapshot: dict) -> list:
+    return [p["_id"] for p in snapshot["products"]]
+
+
+def test_full_load_walks_every_page(refresher):
+    assert ids(refresher._snapshot) == ["p1", "p2", "p3", "p4", "p5"]
+    assert refresher._last_updated_at == "2026-01-09"
+
+
+def test_updated_product_replaces_the_old_one_in_place(refresher, client):
+    before = refresher._snapshot
+    client.products[2] = product(3, "2026-01-20", price=80)
+    refresher._refresh(full=False)
+    after = refresher._snapshot
+    assert ids(after) == ids(before)
+    assert after["index"].get("p3")["price"] == 80
+    assert after["index"].version != before["index"].version
+    assert refresher._last_updated_at == "2026-01-20"
+
+
+def test_new_products_go_first_newest_first(refresher, client):
+    client.products[:0] = [product(7, "2026-01-22"), product(6, "2026-01-21")]
+    refresher._refresh(full=False)
+    assert ids(refresher._snapshot) == ["p7", "p6", "p1", "p2", "p3", "p4", "p5"]
+
+
+def test_resent_newest_product_is_not_duplicated(refresher, client):
+    before = refresher._snapshot
+    client.urls.clear()
+    refresher._refresh(full=False)  # updatedAt[gte] re-sends p1 every cycle
+    assert any("updatedAt[gte]=2026-01-09" in url for url in client.urls)
+    assert refresher._snapshot is before
+    assert ids(refresher._snapshot).count("p1") == 1
+
+
+def test_unchanged_full_reload_is_revalidated_with_etags(refresher, client):
+    before = refresher._snapshot
+    refresher._refresh(full=True)  # every page answers 304
+    assert refresher._snapshot is before
+    assert refresher._snapshot["products"] is before["products"]
+
+
+def test_failed_product_fetch_keeps_the_previous_snapshot(refresher, client):
+    before = refresher._snapshot
+    version = before["index"].version
+    client.products[0] = product(1, "2026-01-25", price=1)
+    client.failing.add("products")
+    with pytest.raises(CatalogFetchError):
+        refresher._refresh(full=False)
+    assert refresher._snapshot is before
+    assert refresher._snapshot["index"].version == version
+    assert refresher.snapshot()["index"].get("p1")["price"] == 100
+
+
+def test_failed_categories_fetch_keeps_the_previous_categories(refresher, client):
+    before = refresher._snapshot
+    client.failing.add("categories")
+    client.brands = client.brands + [{"_id": "b2", "name": "Xiaomi"}]
+    refresher._refresh(full=True)
+    assert refresher._snapshot["categories"] is before["categories"]
+    assert [b["name"] for b in refresher._snapshot["brands"]] == ["Samsung", "Xiaomi"]
+
+
+def test_first_load_failure_raises_without_a_snapshot(client):
+    client.failing.add("products")
+    r = CatalogRefresher(BASE, CatalogIndex, client, page_size=2)
+    with pytest.raises(CatalogFetchError):
+        r._refresh(full=True)
+    assert r._snapshot is None
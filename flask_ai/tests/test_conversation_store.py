@@ -0,0 +1,191 @@
+"""Atomic context updates, LRU + TTL eviction and the state round-trip."""
+import threading
+import time
+
+import msgpack
+import pytest
+import redis
+
+import conversation_store
+from conversation_store import ConversationContext, LocalContextStore, ProductRef, RedisContextStore
+
+PRODUCTS = [
+    {"_id": "p1", "title": "Galaxy A15", "price": 199, "priceAfterDiscount": 179},
+    {"_id": "p2", "title": "Redmi 13", "price": "149"},
+]
+
+
+def append_turn(n: int):
+    def mutate(context):
+        time.sleep(0.001)  # widen the read-modify-write window
+        context.conversation_history.append({"message": str(n), "intent": "browse", "timestamp": ""})
+        context.favorite_brands.append(n)
+    return mutate
+
+
+class FakeRedis:
+    """Hashes with per-key versions; WATCH/MULTI/EXEC aborts when a watched key changed"""
+
+    def __init__(self, fail_with: Exception = None):
+        self.hashes = {}
+        self.versions = {}
+        self.lock = threading.Lock()
+        self.fail_with = fail_with
+
+    def hgetall(self, key):
+        if self.fail_with:
+            raise self.fail_with
+        with self.lock:
+            return dict(self.hashes.get(key, {}))
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client: FakeRedis):
+        self.client = client
+        self.watched = {}
+        self.commands = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def watch(self, key):
+        with self.client.lock:
+            self.watched = {key: self.client.versions.get(key, 0)}
+        self.commands = None
+
+    def hgetall(self, key):
+        return self.client.hgetall(key)
+
+    def multi(self):
+        self.commands = []
+
+    def hset(self, key, mapping):
+        self.commands.append((key, mapping))
+
+    def expire(self, key, ttl):
+        pass
+
+    def execute(self):
+        with self.client.lock:
+            if any(self.client.versions.get(k, 0) != v for k, v in self.watched.items()):
+                raise redis.WatchError("watched key changed")
+            for key, mapping in self.commands:
+                self.client.hashes.setdefault(key, {}).update(mapping)
+                self.client.versions[key] = self.client.versions.get(key, 0) + 1
+        self.watched, self.commands = {}, None
+
+
+def run_concurrently(store, count: int = 16):
+    threads = [threading.Thread(target=store.update, args=("s1", append_turn(n))) for n in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def test_local_concurrent_updates_are_not_lost():
+    store = LocalContextStore()
+    run_concurrently(store)
+    context = store.get("s1")
+    assert sorted(context.favorite_brands) == list(range(16))
+    assert len(context.conversation_history) == 16
+
+
+def test_local_get_returns_a_copy():
+    store = LocalContextStore()
+    store.update("s1", append_turn(1))
+    seen = store.get("s1")
+    seen.favorite_brands.append("local change")
+    store.update("s1", append_turn(2))
+    assert seen.favorite_brands == [1, "local change"]
+    assert store.get("s1").favorite_brands == [1, 2]
+
+
+def test_local_ttl_expires_idle_sessions(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(conversation_store.time, "monotonic", lambda: clock[0])
+    store = LocalContextStore(ttl=60)
+    store.update("idle", append_turn(1))
+    store.update("active", append_turn(1))
+    clock[0] += 40
+    store.get("active")  # sliding TTL
+    clock[0] += 40
+    assert store.get("idle").favorite_brands == []
+    assert store.get("active").favorite_brands == [1]
+    assert store.stats()["sessions"] == 1
+    assert store.stats()["evicted"] == 1
+
+
+def test_local_max_sessions_evicts_least_recently_used():
+    store = LocalContextStore(max_sessions=2)
+    store.update("a", append_turn(1))
+    store.update("b", append_turn(2))
+    store.get("a")
+    store.update("c", append_turn(3))
+    assert store.get("b").favorite_brands == []
+    assert store.get("a").favorite_brands == [1]
+    assert store.stats() == {"backend": "memory", "sessions": 2, "max_sessions": 2, "evicted": 1}
+
+
+def test_redis_concurrent_updates_retry_on_conflicts():
+    store = RedisContextStore(FakeRedis(), max_retries=100)
+    run_concurrently(store)
+    context = store.get("s1")
+    assert sorted(context.favorite_brands) == list(range(16))
+    assert store.stats()["conflicts"] > 0
+    assert store.stats()["errors"] == 0
+    assert store.fallback.stats()["sessions"] == 0
+
+
+def test_redis_gives_up_after_max_retries_and_falls_back():
+    client = FakeRedis()
+
+    def conflicting(context):
+        client.versions["ctx:s1"] = client.versions.get("ctx:s1", 0) + 1  # someone else always writes first
+        context.favorite_brands.append("x")
+
+    store = RedisContextStore(client, max_retries=3)
+    context = store.update("s1", conflicting)
+    assert context.favorite_brands == ["x"]
+    assert store.stats()["conflicts"] == 3
+    assert store.stats()["errors"] == 1
+    assert store.fallback.get("s1").favorite_brands == ["x"]
+
+
+def test_redis_unreachable_uses_the_local_store_for_a_while():
+    store = RedisContextStore(FakeRedis(fail_with=redis.ConnectionError("down")), retry_after=30)
+    store.update("s1", append_turn(1))
+    assert store.get("s1").favorite_brands == [1]
+    stats = store.stats()
+    assert stats["errors"] == 1 and stats["available"] is False
+    assert stats["fallback"]["sessions"] == 1
+
+
+def test_state_round_trips_through_msgpack_with_product_refs():
+    context = ConversationContext()
+    context.update_context("بدي موبايل", "browse", {"budget": 200, "brand": "Samsung", "product_type": "موبايل"}, PRODUCTS)
+    context.user_preferences = {"color": "أسود"}
+
+    packed = {name: msgpack.packb(value, use_bin_type=True) for name, value in context.to_state().items()}
+    restored = ConversationContext.from_state({name: msgpack.unpackb(value, raw=False) for name, value in packed.items()})
+
+    assert restored.to_state() == context.to_state()
+    assert all(isinstance(ref, ProductRef) for ref in restored.last_products)
+    assert [ref.to_dict() for ref in restored.last_products] == [
+        {"_id": "p1", "title": "Galaxy A15", "price": 199.0, "priceAfterDiscount": 179.0},
+        {"_id": "p2", "title": "Redmi 13", "price": 149.0},
+    ]
+    assert restored.get_context_info() == context.get_context_info()
+
+
+def test_state_with_legacy_product_dicts_becomes_refs():
+    restored = ConversationContext.from_state({"last_products": PRODUCTS})
+    assert [ref.id for ref in restored.last_products] == ["p1", "p2"]
+    with pytest.raises(AttributeError):
+        restored.last_products[0].title = "changed"
@@ -0,0 +1,130 @@
+"""BatchScheduler grouping and the prefix + pads + suffix input layout."""
+from types import SimpleNamespace
+
+import torch
+
+from inference import BatchScheduler, GenerationJob
+
+PAD = 0
+
+
+class FakeTokenizer:
+    pad_token_id = PAD
+    eos_token = "</s>"
+    padding_side = "right"
+
+    def __call__(self, text, add_special_tokens=False):
+        return {"input_ids": [ord(c) for c in text]}
+
+
+class FakeModel:
+    """Prefix forward pass returning one layer of KV with the prefix ids as values"""
+    device = torch.device("cpu")
+
+    def __call__(self, input_ids, past_key_values=None, use_cache=True):
+        values = input_ids.float().view(1, 1, -1, 1)
+        legacy = ((values.clone(), values.clone()),)
+        return SimpleNamespace(past_key_values=SimpleNamespace(to_legacy_cache=lambda: legacy))
+
+
+def scheduler(**kwargs) -> BatchScheduler:
+    return BatchScheduler(FakeModel(), FakeTokenizer(), **kwargs)
+
+
+def job(length: int, prefix_key: str = None, prefix_len: int = 0, streamer=None, start: int = 1) -> GenerationJob:
+    return GenerationJob(list(range(start, start + length)), prefix_key, prefix_len, streamer)
+
+
+def take(s: BatchScheduler, jobs: list) -> list:
+    s._pending.extend(jobs)
+    return s._take_batch()
+
+
+def test_batches_only_jobs_sharing_the_head_prefix():
+    s = scheduler(max_batch_size=8, pad_ratio=1.3)
+    head = job(14, "a", 4)
+    same = job(14, "a", 4)
+    other_prefix = job(14, "b", 4)
+    no_prefix = job(10)
+    batch = take(s, [head, same, other_prefix, no_prefix])
+    assert batch == [head, same]
+    assert list(s._pending) == [other_prefix, no_prefix]
+
+
+def test_pad_ratio_compares_suffix_lengths():
+    s = scheduler(max_batch_size=8, pad_ratio=1.3)
+    head = job(14, "a", 4)  # suffix 10
+    close = job(16, "a", 4)  # suffix 12: 12 <= 10 * 1.3
+    far = job(18, "a", 4)  # suffix 14: 14 > 10 * 1.3
+    batch = take(s, [head, far, close])
+    assert batch == [head, close]
+    assert list(s._pending) == [far]
+
+
+def test_closest_lengths_fill_the_batch_first():
+    s = scheduler(max_batch_size=2, pad_ratio=2.0)
+    head = job(10)
+    near = job(11)
+    nearest = job(10)
+    batch = take(s, [head, near, nearest])
+    assert batch == [head, nearest]
+    assert list(s._pending) == [near]
+
+
+def test_streaming_jobs_run_alone():
+    s = scheduler(max_batch_size=8)
+    streamed = job(10, streamer=object())
+    plain = job(10)
+    assert take(s, [streamed, plain]) == [streamed]
+    assert s._take_batch() == [plain]
+
+
+def test_cancelled_jobs_are_dropped():
+    s = scheduler(max_batch_size=8)
+    head, cancelled, healthy = job(10), job(10), job(10)
+    cancelled.future.cancel()
+    batch = take(s, [head, cancelled, healthy])
+    assert batch == [head, healthy]
+    assert all(j.future.running() for j in batch)
+    assert not s._pending
+
+
+def test_prefixed_inputs_pad_between_prefix_and_suffix():
+    s = scheduler()
+    prefix = [7, 8, 9]
+    short = GenerationJob(prefix + [21, 22], "p", 3)
+    long = GenerationJob(prefix + [31, 32, 33, 34], "p", 3)
+    inputs = s._prefixed_inputs([short, long])
+
+    assert inputs["input_ids"].tolist() == [
+        [7, 8, 9, PAD, PAD, 21, 22],
+        [7, 8, 9, 31, 32, 33, 34],
+    ]
+    assert inputs["attention_mask"].tolist() == [
+        [1, 1, 1, 0, 0, 1, 1],
+        [1, 1, 1, 1, 1, 1, 1],
+    ]
+    # generate() derives positions from the mask: both suffixes continue right after the prefix
+    positions = inputs["attention_mask"].cumsum(-1) - 1
+    assert positions[0, -2:].tolist() == [3, 4]
+    assert positions[1, -4:].tolist() == [3, 4, 5, 6]
+    # The cached prefix KV is expanded to every row of the batch
+    keys, values = inputs["past_key_values"][0]
+    assert keys.shape == (2, 1, 3, 1)
+    assert keys[:, 0, :, 0].tolist() == [[7.0, 8.0, 9.0]] * 2
+
+
+def test_prefix_kv_is_computed_once_per_prefix():
+    s = scheduler()
+    s._prefixed_inputs([GenerationJob([7, 8, 9, 1], "p", 3)])
+    s._prefixed_inputs([GenerationJob([7, 8, 9, 2, 3], "p", 3)])
+    stats = s.stats()
+    assert (stats["prefix_misses"], stats["prefix_hits"], stats["prefix_tokens_reused"]) == (1, 1, 3)
+
+
+def test_make_job_splits_prefix_and_suffix_tokens():
+    s = scheduler()
+    made = s._make_job("SYS:hello", prefix="SYS:")
+    assert made.prefix_len == 4
+    assert made.input_ids == [ord(c) for c in "SYS:hello"]
+    assert s._make_job("hello", prefix="SYS:").prefix_key is None
@@ -0,0 +1,140 @@
+# فهرس متجهات المنتجات للبحث الدلالي
+"""Embedding matrix for product vector search.
+
+Each catalog snapshot gets a float32 ``(products, dim)`` matrix of unit vectors,
+one row per ``CatalogIndex`` row. Matrices are saved as ``.npy`` files named
+after the embedding model and snapshot version and opened memory-mapped, so a
+restart on an unchanged catalog does not re-embed anything. New snapshots are
+embedded on a background thread (reusing vectors of products whose text did not
+change); until a snapshot's matrix is ready, search stays lexical.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import logging
+import os
+import re
+import time
+
+import numpy as np
+
+from semantic_cache import normalize_message
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_TEXT_CHARS = 300  # title + start of the description is enough for retrieval
+
+
+def product_text(title: str, description: str) -> str:
+    return normalize_message(f"{title}. {(description or '')[:PRODUCT_TEXT_CHARS]}")
+
+
+class ProductVectors:
+    def __init__(self, embedder, cache_dir: str, keep_files: int = 2):
+        self.embedder = embedder
+        self.cache_dir = cache_dir
+        self.keep_files = max(1, keep_files)
+        self.slug = re.sub(r"[^\w.-]+", "_", os.path.basename(embedder.model_name.rstrip("/")))
+        os.makedirs(cache_dir, exist_ok=True)
+        self._latest = None  # newest index handed to attach()
+        self._ready = None  # newest index with vectors; its rows are reused by the next build
+        self._builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix='vector-builder')
+        self._last_build = None
+
+    def attach(self, index):
+        """Give index.vectors a matrix: straight from disk when cached, otherwise built in the background"""
+        index.vectors = None
+        if not len(index):
+            return
+        self._latest = index
+        path = self._path(index.version)
+        if os.path.exists(path):
+            try:
+                matrix = np.load(path, mmap_mode='r')
+                if matrix.shape[0] == len(index):
+                    index.vectors = matrix
+                    self._ready = index
+                    return
+            except Exception as e:
+                logger.warning(f"Ignoring unreadable vector file {path}: {e}")
+        self._builder.submit(self._build, index)
+
+    def scores(self, index, text: str, limit: int, min_similarity: float = 0.0) -> dict:
+        """Cosine similarity of the closest rows to the query ({} until the index has vectors)"""
+        matrix = getattr(index, "vectors", None)
+        if matrix is None or not len(index):
+            return {}
+        sims = matrix @ self.embedder.embed(normalize_message(text))
+        if limit < len(sims):
+            top = np.argpartition(sims, -limit)[-limit:]
+        else:
+            top = np.arange(len(sims))
+        return {int(r): float(sims[r]) for r in top if sims[r] >= min_similarity}
+
+    def wait_idle(self, timeout: float = None):
+        """Block until queued builds finished (before forking workers)"""
+        self._builder.submit(lambda: None).result(timeout)
+
+    def stop(self):
+        """Finish queued builds and end the builder thread (gunicorn master after preload)"""
+        self._builder.shutdown(wait=True)
+
+    def after_fork(self):
+        self._builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix='vector-builder')
+
+    def status(self) -> dict:
+        latest = self._latest
+        return {
+            "model": self.embedder.model_name,
+            "ready": latest is not None and getattr(latest, "vectors", None) is not None,
+            "last_build": self._last_build,
+        }
+
+    def _build(self, index):
+        if self._latest is not index:
+            return  # a newer snapshot arrived while this one was queued
+        started = time.perf_counter()
+        try:
+            texts = [product_text(t, d) for t, d in zip(index.titles, index.descriptions)]
+            matrix = np.empty((len(texts), self.embedder.dim), dtype=np.float32)
+            previous = self._ready
+            known = {}
+            if previous is not None and previous.vectors is not None:
+                known = {product_text(t, d): row for row, (t, d) in enumerate(zip(previous.titles, previous.descriptions))}
+            missing = []
+            for row, text in enumerate(texts):
+                old = known.get(text)
+                if old is not None:
+                    matrix[row] = previous.vectors[old]
+                else:
+                    missing.append(row)
+            if missing:
+                matrix[missing] = self.embedder.embed_batch([texts[r] for r in missing])
+            self._save(index.version, matrix)
+            index.vectors = matrix
+            self._ready = index
+            elapsed = time.perf_counter() - started
+            self._last_build = {"products": len(texts), "embedded": len(missing), "seconds": round(elapsed, 2)}
+            logger.info(f"Product vectors ready: {len(missing)}/{len(texts)} embedded in {elapsed:.1f}s")
+        except Exception as e:
+            logger.warning(f"Product vector build failed, search stays lexical: {e}")
+
+    def _path(self, version: str) -> str:
+        return os.path.join(self.cache_dir, f"{self.slug}-{version}.npy")
+
+    def _save(self, version: str, matrix: np.ndarray):
+        path = self._path(version)
+        tmp = f"{path}.tmp"
+        try:
+            with open(tmp, 'wb') as f:
+                np.save(f, matrix)
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.warning(f"Could not persist product vectors to {path}: {e}")
+            return
+        # Keep only the newest few snapshots for this model
+        files = sorted(glob.glob(os.path.join(self.cache_dir, f"{self.slug}-*.npy")), key=os.path.getmtime, reverse=True)
+        for stale in files[self.keep_files:]:
+            try:
+                os.remove(stale)
+            except OSError:
+                pass